@@ -0,0 +1,324 @@
+# djbench.py
+#
+# Benchmarks of the time djmixedcore spends itself, apart from the time
+# SPSS spends fitting.  Every stage is timed on its own:
+#
+#   construction  reparsepredictors, fullfactorial and mixedsyntax for
+#                 designs with 2 to 8 factors
+#   relatedbetas  matching one fixed term against the nonredundant
+#                 parameters of such designs, and every term through one
+#                 betaindex
+#   extraction    fixedeffects_table and randomeffects_table on output
+#                 trees of such designs, from OXML text
+#   nativefit     djnative on synthetic data with the structure of
+#                 tw-set1d-spss.sav, 10^3 up to 10^6 rows
+#   compare       comparemodels end to end (OXML text to pivot table) on
+#                 the native fits of that data
+#   startup       a cold import of djmixedcore in a fresh python, which
+#                 should stay under STARTUPBUDGET
+#
+# djmixedcore runs on the replay stand-in of spss (see replay/spss.py),
+# so no SPSS is needed and no SPSS time is included.  The results are
+# written as JSON, one record per stage and case, with the version of
+# djmixedcore, so runs of different versions can be compared:
+#
+#   python djbench.py --output bench-41c.json [--maxrows 100000] [--quick]
+#
+# The native fits of 10^6 rows take minutes each; --maxrows leaves them out.
+#
+# $Revision$
+
+import sys, os, time, platform, optparse, subprocess
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+import numpy
+
+# the replay stand-in goes first, so djmixedcore gets it as spss
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replay'))
+import spss
+import djmixedcore, djnative, djoxml
+from djterms import fullfactorial, reparsepredictors
+
+
+FACTORS = range(2, 9)
+ROWS = [1000, 10000, 100000, 1000000]
+LEVELS = 3           # levels per factor in the designs of relatedbetas
+TABLELEVELS = 2      # and of extraction, which calls relatedbetas for every term
+MINTIME = 0.2        # seconds per measurement, see timeit
+REPEAT = 5
+STARTUPBUDGET = 0.050
+
+
+def timeit(function, repeat=REPEAT, mintime=MINTIME):
+  """Call function often enough to take mintime, 'repeat' times over;
+  return the seconds per call of every repeat"""
+  number = 1
+  while True:
+    start = time.time()
+    for i in xrange(number):
+      function()
+    elapsed = time.time() - start
+    if elapsed >= mintime or number >= 1000000:
+      break
+    number = number * 10 if elapsed < mintime / 10 else number * 2
+  res = [ elapsed / number ]
+  for r in range(repeat - 1):
+    start = time.time()
+    for i in xrange(number):
+      function()
+    res.append((time.time() - start) / number)
+  return res
+
+
+def record(results, stage, case, times, **params):
+  times = sorted(times)
+  res = dict(stage=stage, case=case, params=params, repeat=len(times),
+             min=times[0], median=times[len(times) // 2])
+  results.append(res)
+  print "%-13s %-22s %12.6f s  %s" % (stage, case, res['min'],
+                                       ' '.join([ '%s=%s' % p for p in sorted(params.items()) ]))
+  return res
+
+
+########## synthetic designs and data
+
+def factornames(nfactors):
+  return [ 'F%d' % (f + 1) for f in range(nfactors) ]
+
+
+def syntheticdata(nrows, nfactors=2, seed=0):
+  """Columns like tw-set1d-spss.sav scaled to nrows: RT, Participant and
+  Word crossed, the first factor varies within participants, the others
+  are properties of the words.  Participants and words grow with the
+  square root of nrows."""
+  randomstate = numpy.random.RandomState(seed)
+  scale = nrows / 2004.0
+  npps = max(2, int(round(34 * scale ** 0.5)))
+  nitems = max(2, int(round(93 * scale ** 0.5)))
+  pps = randomstate.randint(npps, size=nrows)
+  items = randomstate.randint(nitems, size=nrows)
+  rt = 600 + randomstate.normal(0, 70, npps)[pps] + randomstate.normal(0, 40, nitems)[items] \
+       + randomstate.normal(0, 130, nrows)
+  itemlevels = randomstate.randint(2, size=(nitems, nfactors))
+  columns = dict(Participant=pps + 1.0, Word=items + 1.0)
+  for (f, name) in enumerate(factornames(nfactors)):
+    if f == 0:
+      codes = randomstate.randint(2, size=nrows)
+    else:
+      codes = itemlevels[items, f]
+    columns[name] = codes + 1.0
+    rt = rt + 20 * codes
+  columns['RT'] = rt
+  return columns
+
+
+def syntheticoutput(nfactors, nlevels=LEVELS):
+  """The output tree SPSS would give for the full factorial model of
+  nfactors factors with nlevels levels each, with made up numbers: all
+  parameters of a term that involve the last level of a factor are
+  redundant"""
+  import itertools
+  names = factornames(nfactors)
+  terms = [ t.split('*') for t in fullfactorial(' '.join(names)).split() ]
+  output = djoxml.OutputTree()
+  output.commands.append(('Mixed', 'Mixed Model Analysis'))
+  tests = output.addpivot(djoxml.PivotTable('Tests of Fixed Effects'))
+  estimates = output.addpivot(djoxml.PivotTable('Parameter Estimates'))
+  tests.addline(('Intercept',), [('F', '1000.000'), ('Sig.', '.000')])
+  estimates.addline(('Intercept',), [('Estimate', '600.000000'), ('Std. Error', '10.000000')])
+  for term in terms:
+    tests.addline((' * '.join(term),), [('F', '1.000'), ('Sig.', '.500')])
+    for levels in itertools.product(*[ range(1, nlevels + 1) for f in term ]):
+      label = ' * '.join([ '[%s=%d]' % (f, l) for (f, l) in zip(term, levels) ])
+      if nlevels in levels:
+        estimates.addline((label,), [('Estimate', '0', [djnative.REDUNDANTBETA])])
+      else:
+        estimates.addline((label,), [('Estimate', '1.000000'), ('Std. Error', '1.000000')])
+  covparms = output.addpivot(djoxml.PivotTable('Covariance Parameter Estimates'))
+  covparms.addline(('Residual',), [('Estimate', '16000.000000'), ('Wald Z', '30.000'),
+                                   ('Sig.', '.000')])
+  for s in ('Participant', 'Word'):
+    covparms.addline(('Intercept [subject = %s]' % s, 'Variance'),
+                     [('Estimate', '5000.000000'), ('Wald Z', '4.000'), ('Sig.', '.000')])
+  return output
+
+
+def replayoutput(name, output):
+  """make output available as handle 'name', as OXML text, and register it"""
+  spss.handles[name] = output.toxml()
+  djmixedcore.registry.addhandle(name)
+
+
+def forget(*names):
+  """drop the parsed outputs, so the next question parses the OXML again"""
+  for name in names:
+    djmixedcore.registry.outputs.pop(name, None)
+
+
+def inprocedure(function):
+  def run():
+    spss.StartProcedure('DJMIXED.Bench')
+    try:
+      function()
+    finally:
+      spss.EndProcedure()
+      del spss.procedures[:]
+  return run
+
+
+########## stages
+
+def construction(results, factors):
+  for nfactors in factors:
+    predictors = ' '.join(factornames(nfactors))
+    full = fullfactorial(predictors)
+    words = full.replace('*', ' * ').split()
+    record(results, 'construction', 'reparsepredictors',
+           timeit(lambda: reparsepredictors(words)), factors=nfactors)
+    record(results, 'construction', 'fullfactorial',
+           timeit(lambda: fullfactorial(predictors)), factors=nfactors)
+    record(results, 'construction', 'mixedsyntax',
+           timeit(lambda: djmixedcore.mixedsyntax('RT', predictors, 'Participant', 'Word',
+                                                  modeltype='fullfactorial')),
+           factors=nfactors)
+
+
+def relatedbetas(results, factors):
+  for nfactors in factors:
+    output = syntheticoutput(nfactors)
+    nonredundants = [ p for p in output.rowitems('Parameter Estimates')
+                      if not output.rowcells('Parameter Estimates', p)[0].hasnote('redundant') ]
+    fterm = ' * '.join(factornames(nfactors))
+    record(results, 'relatedbetas', 'highest term',
+           timeit(lambda: djmixedcore.relatedbetas(nonredundants, fterm)),
+           factors=nfactors, nonredundants=len(nonredundants))
+    fterms = output.rowitems('Tests of Fixed Effects')
+    def allterms():
+      index = djmixedcore.betaindex(nonredundants)
+      for t in fterms:
+        djmixedcore.relatedbetas(nonredundants, t, index)
+    record(results, 'relatedbetas', 'all terms', timeit(allterms),
+           factors=nfactors, nonredundants=len(nonredundants), terms=len(fterms))
+
+
+def extraction(results, factors):
+  for nfactors in factors:
+    name = 'bench_extraction_%d' % nfactors
+    output = syntheticoutput(nfactors, TABLELEVELS)
+    replayoutput(name, output)
+    size = len(spss.handles[name])
+    def fixed():
+      forget(name)
+      djmixedcore.fixedeffects_table(name)
+    def random():
+      forget(name)
+      djmixedcore.randomeffects_table(name)
+    record(results, 'extraction', 'fixedeffects_table', timeit(inprocedure(fixed)),
+           factors=nfactors, oxmlbytes=size)
+    record(results, 'extraction', 'randomeffects_table', timeit(inprocedure(random)),
+           factors=nfactors, oxmlbytes=size)
+    djmixedcore.removemodel(name, message=False)
+
+
+def nativeandcompare(results, rows):
+  """nativefit and compare share the fits"""
+  for nrows in rows:
+    columns = syntheticdata(nrows)
+    fits = dict()
+    for (name, predictors) in (('bench_main', 'F1 F2'), ('bench_full', 'F1 F2 F1*F2')):
+      def fit():
+        fits[name] = djnative.fitmixedmodel(columns, 'RT', predictors, pps='Participant',
+                                            items='Word')
+      # one repeat is plenty for fits that take seconds
+      record(results, 'nativefit', predictors, timeit(fit, repeat=1 if nrows > 10000 else 3),
+             rows=nrows, iterations=fits[name].iterations)
+      replayoutput(name, fits[name].output)
+    def compare():
+      forget('bench_main', 'bench_full')
+      djmixedcore.comparemodels('bench_main', 'bench_full')
+      del spss.procedures[:]
+    record(results, 'compare', 'comparemodels', timeit(compare), rows=nrows)
+    djmixedcore.removemodel('bench_main', message=False)
+    djmixedcore.removemodel('bench_full', message=False)
+    del spss.procedures[:]
+
+
+STARTUPSCRIPT = """
+import sys, time
+sys.path[:0] = %r
+import spss
+start = time.time()
+import djmixedcore
+print time.time() - start
+"""
+
+def startup(results, repeat=REPEAT):
+  """time 'import djmixedcore' in a fresh interpreter, every time; the
+  import of spss itself is not counted"""
+  here = os.path.dirname(os.path.abspath(__file__))
+  script = STARTUPSCRIPT % [os.path.join(here, 'replay'), here]
+  times = list()
+  for r in range(repeat):
+    child = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE)
+    (out, err) = child.communicate()
+    if child.returncode:
+      raise RuntimeError("Importing djmixedcore failed in a fresh python")
+    times.append(float(out.split()[-1]))
+  res = record(results, 'startup', 'import djmixedcore', times, budget=STARTUPBUDGET)
+  if res['median'] > STARTUPBUDGET:
+    print "WARNING: importing djmixedcore takes longer than %.0f ms" % (1000 * STARTUPBUDGET)
+
+
+def run(output=None, factors=FACTORS, rows=ROWS, stages=None):
+  """Run the stages (all if None) and write the results to 'output' as
+  JSON; returns the results"""
+  results = list()
+  stages = stages or ['startup', 'construction', 'relatedbetas', 'extraction', 'native']
+  if 'startup' in stages:
+    startup(results)
+  if 'construction' in stages:
+    construction(results, factors)
+  if 'relatedbetas' in stages:
+    relatedbetas(results, factors)
+  if 'extraction' in stages:
+    extraction(results, factors)
+  if 'native' in stages:
+    nativeandcompare(results, rows)
+  report = dict(version=djmixedcore.__version__, python=platform.python_version(),
+                platform=platform.platform(), numpy=numpy.__version__,
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'), results=results)
+  if output:
+    stream = open(output, 'w')
+    try:
+      json.dump(report, stream, indent=1, sort_keys=True)
+    finally:
+      stream.close()
+  return report
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage="python djbench.py [options]")
+  parser.add_option('--output', default='djbench.json', help="JSON file for the results")
+  parser.add_option('--maxrows', type='int', default=max(ROWS),
+                    help="largest synthetic dataset for nativefit and compare")
+  parser.add_option('--maxfactors', type='int', default=max(FACTORS),
+                    help="largest design for construction, relatedbetas and extraction")
+  parser.add_option('--stages', default=None,
+                    help="comma separated: startup,construction,relatedbetas,extraction,native")
+  parser.add_option('--quick', action='store_true', help="small sizes only, for a smoke test")
+  (options, args) = parser.parse_args(argv)
+  if options.quick:
+    options.maxrows = min(options.maxrows, 10000)
+    options.maxfactors = min(options.maxfactors, 4)
+  stages = options.stages and options.stages.split(',')
+  run(options.output, [ f for f in FACTORS if f <= options.maxfactors ],
+      [ n for n in ROWS if n <= options.maxrows ], stages)
+  print "Results written to", options.output
+
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
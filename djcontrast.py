@@ -0,0 +1,270 @@
+# djcontrast.py
+#
+# Contrasts on the fixed effects of a fitted model, computed from its
+# output instead of by MIXED: estimated marginal means (EMMEANS),
+# pairwise comparisons of these with a Sidak or Holm adjustment, user
+# contrasts (/TEST) and the Type III tests.
+#
+# All of these are linear functions L beta of the fixed effects, and
+# everything we need is in the output of any model: beta in Parameter
+# Estimates and its covariance matrix in the table that /PRINT=COVB
+# adds (djnative writes the same table).  So a model can get new
+# contrasts without being fitted again, and all comparisons of a
+# factor are evaluated at once, as rows of one L matrix.
+#
+# Beta is in the overparameterized coding of SPSS, with the redundant
+# parameters zero, and every predictor is categorical.  The mean of
+# every cell of the full design (all factors crossed) is then the sum
+# of the parameters whose levels the cell has.  Marginal means average
+# the cell means with equal weights, as EMMEANS does, and the Type III
+# hypotheses are the effect coded contrasts of the same cell means.
+#
+# A native fit carries its df approximation in the output tree (see
+# djdf), which gives every contrast its own Satterthwaite df, all rows
+# of L at once, and the Type III tests their Satterthwaite or
+# Kenward-Roger F and df.  For an SPSS fit the denominator df of a
+# contrast on the levels of some factors is that of the test of their
+# term in Tests of Fixed Effects.
+#
+# Nothing in here needs spss.
+#
+# $Revision$
+
+import re, itertools
+
+import numpy
+
+import djstats
+
+
+# the subtype of the covariance matrix of the fixed effects (/PRINT=COVB)
+COVBTYPE = 'Covariance Matrix for Estimates of Fixed Effects'
+ADJUSTMENTS = ('sidak', 'holm')
+
+re_paramlevel = re.compile(r'^\[(\w+)=(.*)]$')
+
+
+class ContrastError(Exception):
+  pass
+
+
+def paramlevels(label):
+  """the (factor, level) pairs of a parameter label: '[a=1] * [b=x]'
+  gives (('a', '1'), ('b', 'x')) and 'Intercept' ()"""
+  if label == 'Intercept':
+    return ()
+  res = list()
+  for part in label.split(' * '):
+    match = re_paramlevel.match(part.strip())
+    if not match:
+      raise ContrastError("Cannot read the levels of parameter '%s'" % label)
+    res.append((match.group(1), match.group(2)))
+  return tuple(res)
+
+
+def number(text):
+  """the value of a cell, zero for the empty and '.' cells of redundant
+  parameters"""
+  try:
+    return float(text)
+  except (TypeError, ValueError):
+    return 0.0
+
+
+class FixedEffects(object):
+  """beta and its covariance matrix, read from the output tree of a
+  model, with the factors and their levels as the parameter labels
+  give them (in order)"""
+
+  def __init__(self, output):
+    self.labels = output.rowitems('Parameter Estimates')
+    if not self.labels:
+      raise ContrastError("The model has no Parameter Estimates")
+    self.levels = [ paramlevels(label) for label in self.labels ]
+    self.beta = numpy.array([ number((output.texts('Parameter Estimates', row=label,
+                                                   col='Estimate') or [None])[0])
+                              for label in self.labels ])
+    covb = output.tables(COVBTYPE)
+    if not covb:
+      raise ContrastError("The model has no covariance matrix of the fixed effects (COVB)")
+    position = dict([ (label, i) for (i, label) in enumerate(self.labels) ])
+    self.covb = numpy.zeros((len(self.labels), len(self.labels)))
+    for cell in covb[0].cells:
+      (i, j) = (position.get(cell.rows[0]), position.get(cell.cols[-1]))
+      if i is not None and j is not None:
+        self.covb[i, j] = number(cell.text)
+    self.factors = list()
+    self.factorlevels = dict()
+    for levels in self.levels:
+      for (f, level) in levels:
+        if f not in self.factorlevels:
+          self.factors.append(f)
+          self.factorlevels[f] = list()
+        if level not in self.factorlevels[f]:
+          self.factorlevels[f].append(level)
+    self.ddf = dict()
+    for term in output.rowitems('Tests of Fixed Effects'):
+      df = output.texts('Tests of Fixed Effects', row=term, col='Denominator df')
+      if df:
+        self.ddf[termkey(term)] = number(df[0])
+    self.dfs = getattr(output, 'dfs', None)
+    self.means = None
+
+  def factor(self, name):
+    """a factor by its name, ignoring case like SPSS"""
+    for f in self.factors:
+      if f.lower() == name.lower():
+        return f
+    raise ContrastError("'%s' is not a factor of the model" % name)
+
+  def cellmeans(self):
+    """The matrix that gives the mean of every cell of the full design
+    from beta, one row per cell, with the cells in the order of
+    itertools.product over the levels of the factors"""
+    if self.means is None:
+      cells = list(itertools.product(*[ range(len(self.factorlevels[f])) for f in self.factors ]))
+      cells = numpy.array(cells, dtype=int).reshape((len(cells), len(self.factors)))
+      M = numpy.ones((len(cells), len(self.labels)))
+      for (k, levels) in enumerate(self.levels):
+        for (f, level) in levels:
+          i = self.factors.index(f)
+          M[:, k] *= cells[:, i] == self.factorlevels[f].index(level)
+      self.means = M
+    return self.means
+
+  def weights(self, factors, coding):
+    """The weights of the cell means for a function of the levels of
+    'factors' that averages over the others: the Kronecker product over
+    all factors of 'coding' (a function of the number of levels) for
+    those in factors and of equal weights for the rest"""
+    K = numpy.ones((1, 1))
+    for f in self.factors:
+      n = len(self.factorlevels[f])
+      K = numpy.kron(K, coding(n) if f in factors else numpy.ones((1, n)) / n)
+    return K
+
+  def marginal(self, factor):
+    """L for the marginal means of the levels of a factor"""
+    return numpy.dot(self.weights([factor], numpy.eye), self.cellmeans())
+
+  def typeIII(self, term):
+    """L for the Type III test of a term, a tuple of factors"""
+    effects = lambda n: numpy.hstack([numpy.eye(n - 1), -numpy.ones((n - 1, 1))])
+    return numpy.dot(self.weights(term, effects), self.cellmeans())
+
+  def df(self, factors, L):
+    """the denominator df of every row of L, a contrast on the levels of
+    factors: from the df approximation of the model if it has one, else
+    those of the test of the term of these factors (or of the highest
+    term that has them all)"""
+    if self.dfs is not None:
+      return self.dfs.contrastdf(self.dfs.reduce(L))
+    return numpy.repeat(self.termdf(factors), len(L))
+
+  def termdf(self, factors):
+    key = frozenset(factors)
+    if key in self.ddf:
+      return self.ddf[key]
+    above = [ (len(k), df) for (k, df) in self.ddf.items() if key <= k ]
+    if not above:
+      raise ContrastError("No test of fixed effects for '%s' to take the df from" %
+                          ' * '.join(factors))
+    return min(above)[1]
+
+  def estimates(self, L):
+    """L beta and its standard errors, for every row of L at once"""
+    variances = numpy.einsum('ij,jk,ik->i', L, self.covb, L)
+    return numpy.dot(L, self.beta), numpy.sqrt(numpy.maximum(variances, 0))
+
+
+def termkey(term):
+  """the factors of a term label ('a * b') as a frozenset"""
+  return frozenset([ x for x in term.split() if x != '*' and x != 'Intercept' ])
+
+
+def tstatistics(estimates, se, df):
+  """t and its two sided p for estimates with standard errors se"""
+  t = estimates / numpy.where(se > 0, se, numpy.nan)
+  return t, djstats.pf(t * t, 1, df, lowertail=False)
+
+
+def adjust(p, method):
+  """p values adjusted for the number of comparisons, by Sidak
+  (1 - (1 - p)^m) or by the step down method of Holm (Bonferroni-Holm:
+  the i-th smallest p times m - i + 1, kept in order)"""
+  p = numpy.asarray(p, dtype=float)
+  m = len(p)
+  if method == 'sidak':
+    return 1 - (1 - p) ** m
+  if method == 'holm':
+    order = numpy.argsort(p, kind='mergesort')
+    steps = p[order] * (m - numpy.arange(m))
+    res = numpy.empty(m)
+    res[order] = numpy.minimum(numpy.maximum.accumulate(steps), 1)
+    return res
+  raise ContrastError("Unknown adjustment '%s', use %s" % (method, ' or '.join(ADJUSTMENTS)))
+
+
+def marginalmeans(fe, factor, level=0.95):
+  """(levels, means, se, df, lower, upper) of the levels of a factor,
+  df one per level"""
+  factor = fe.factor(factor)
+  L = fe.marginal(factor)
+  (means, se) = fe.estimates(L)
+  df = fe.df([factor], L)
+  half = djstats.qt(0.5 + level / 2, df) * se
+  return fe.factorlevels[factor], means, se, df, means - half, means + half
+
+
+def pairwise(fe, factor, method='sidak'):
+  """All pairwise comparisons of the marginal means of a factor:
+  (pairs, differences, se, df, t, p, adjusted p)"""
+  factor = fe.factor(factor)
+  L = fe.marginal(factor)
+  (i, j) = numpy.triu_indices(len(L), 1)
+  L = L[i] - L[j]
+  (diff, se) = fe.estimates(L)
+  df = fe.df([factor], L)
+  (t, p) = tstatistics(diff, se, df)
+  levels = fe.factorlevels[factor]
+  pairs = [ (levels[a], levels[b]) for (a, b) in zip(i, j) ]
+  return pairs, diff, se, df, t, p, adjust(p, method)
+
+
+def contrasts(fe, factor, coefficients, method='sidak'):
+  """User contrasts on the marginal means of a factor, one list of
+  coefficients (one per level) each: (estimates, se, df, t, p, adjusted p)"""
+  factor = fe.factor(factor)
+  L = fe.marginal(factor)
+  C = numpy.array(coefficients, dtype=float)
+  if C.ndim != 2 or C.shape[1] != len(L):
+    raise ContrastError("A contrast on '%s' needs %d coefficients, one per level" %
+                        (factor, len(L)))
+  L = numpy.dot(C, L)
+  (estimates, se) = fe.estimates(L)
+  df = fe.df([factor], L)
+  (t, p) = tstatistics(estimates, se, df)
+  return estimates, se, df, t, p, adjust(p, method)
+
+
+def typeIIItests(fe):
+  """(term, numerator df, denominator df, F, p) for the Type III test of
+  every term with a test in the model"""
+  res = list()
+  for (key, df) in sorted(fe.ddf.items(), key=lambda x: len(x[0])):
+    term = [ f for f in fe.factors if f in key ]
+    L = fe.typeIII(term)
+    if fe.dfs is not None:
+      (F, r, df) = fe.dfs.test(fe.dfs.reduce(L), fe.dfs.reduce(fe.beta)[0])
+    else:
+      (Lb, Q) = (numpy.dot(L, fe.beta), numpy.dot(numpy.dot(L, fe.covb), L.T))
+      r = numpy.linalg.matrix_rank(Q)
+      F = numpy.dot(Lb, numpy.dot(numpy.linalg.pinv(Q), Lb)) / r
+    res.append((' * '.join(term) or 'Intercept', r, df, F,
+                djstats.pf(F, r, df, lowertail=False)))
+  return res
+
+
+
+if __name__ == '__main__':
+  pass
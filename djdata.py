@@ -0,0 +1,555 @@
+# djdata.py
+#
+# Reading data for the native fitter (djnative) outside of SPSS.
+#
+# Within SPSS the data come from the active dataset, but the native
+# fitter should also run on machines without SPSS, so here is a small
+# reader for SPSS system files (.sav).  The file format is documented
+# by the PSPP project, see
+# http://www.gnu.org/software/pspp/pspp-dev/html_node/System-File-Format.html
+#
+# Only what we need is supported: numeric and (short and long) string
+# variables, uncompressed and bytecode compressed files.  Value labels,
+# documents and most extension records are skipped.
+#
+# readsav gives plain lists, which is fine for a dataset like
+# tw-set1d-spss.sav.  For trial level data of millions of rows there is
+# readcolumns: it reads a .sav, CSV or Parquet file in chunks of rows,
+# keeps only the variables of the model, codes the categorical ones
+# (predictors, PPS, ITEMS) as small integers on the fly and can drop
+# incomplete rows listwise as it goes, like MIXED does.  The result is a
+# ColumnStore that djnative takes as it is.
+#
+# When even that is too big there is readstatistics.  With categorical
+# predictors and random effects the likelihood only needs the number of
+# rows and the sum of the dv for every combination of predictor levels,
+# PPS and ITEMS, plus the total sum of squares.  readstatistics adds
+# these up in one pass over the file, so memory goes with the number of
+# such groups instead of the number of rows.  djnative takes the
+# resulting Statistics like a ColumnStore.
+#
+# $Revision$
+
+import struct, itertools
+
+
+class SavHeader(object):
+  """The dictionary of a system file: variable names, types and where
+  the data start"""
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.readheader()
+    self.readdictionary()
+
+  def read(self, fmt):
+    fmt = self.endian + fmt
+    return struct.unpack(fmt, self.stream.read(struct.calcsize(fmt)))
+
+  def readheader(self):
+    magic = self.stream.read(4)
+    if magic != '$FL2':
+      raise IOError("Not an (uncompressed or bytecode compressed) SPSS system file")
+    self.product = self.stream.read(60)
+    layout = self.stream.read(4)
+    # layout code is 2 or 3, which tells us the byte order
+    if struct.unpack('<i', layout)[0] in (2, 3):
+      self.endian = '<'
+    else:
+      self.endian = '>'
+    (self.casesize, self.compression, self.weightindex, self.ncases,
+     self.bias) = self.read('iiiid')
+    self.stream.read(9 + 8 + 64 + 3)   # date, time, file label, padding
+
+  def readdictionary(self):
+    self.segments = list()   # width of each 8-byte segment: 0 numeric, >0 string, -1 continuation
+    self.shortnames = list()
+    self.widths = list()
+    self.sysmis = -struct.unpack('<d', '\xff\xff\xff\xff\xff\xff\xef\x7f')[0]
+    longnames = dict()
+    self.encoding = 'windows-1252'
+    while True:
+      (rectype,) = self.read('i')
+      if rectype == 2:
+        (width, haslabel, nmissing, printfmt, writefmt) = self.read('iiiii')
+        name = self.stream.read(8).rstrip()
+        if haslabel:
+          (labellen,) = self.read('i')
+          self.stream.read((labellen + 3) // 4 * 4)
+        if nmissing:
+          self.stream.read(8 * abs(nmissing))
+        self.segments.append(width)
+        if width >= 0:
+          self.shortnames.append(name)
+          self.widths.append(width)
+      elif rectype == 3:
+        (nlabels,) = self.read('i')
+        for i in range(nlabels):
+          self.stream.read(8)
+          (labellen,) = self.read('B')
+          self.stream.read((labellen + 8) // 8 * 8 - 1)
+      elif rectype == 4:
+        (nvars,) = self.read('i')
+        self.stream.read(4 * nvars)
+      elif rectype == 6:
+        (nlines,) = self.read('i')
+        self.stream.read(80 * nlines)
+      elif rectype == 7:
+        (subtype, size, count) = self.read('iii')
+        data = self.stream.read(size * count)
+        if subtype == 4:
+          self.sysmis = struct.unpack(self.endian + 'd', data[:8])[0]
+        elif subtype == 13:
+          for pair in data.split('\t'):
+            if '=' in pair:
+              short, long = pair.split('=', 1)
+              longnames[short] = long
+        elif subtype == 20:
+          self.encoding = data
+      elif rectype == 999:
+        self.read('i')
+        break
+      else:
+        raise IOError("Unknown record type %d in system file" % rectype)
+    self.names = [ longnames.get(n, n) for n in self.shortnames ]
+    self.dataoffset = self.stream.tell()
+
+
+def readvalues(header):
+  """Generate the raw 8-byte segments of the data, one by one"""
+  stream = header.stream
+  endian = header.endian
+  if header.compression == 0:
+    while True:
+      raw = stream.read(8)
+      if len(raw) < 8:
+        return
+      yield raw
+  spaces = ' ' * 8
+  sysmis = struct.pack(endian + 'd', header.sysmis)
+  while True:
+    codes = stream.read(8)
+    if len(codes) < 8:
+      return
+    for code in struct.unpack('8B', codes):
+      if code == 0:
+        continue
+      elif code == 252:
+        return
+      elif code == 253:
+        yield stream.read(8)
+      elif code == 254:
+        yield spaces
+      elif code == 255:
+        yield sysmis
+      else:
+        yield struct.pack(endian + 'd', code - header.bias)
+
+
+def readsav(filename, variables=None):
+  """Read an SPSS system file and return a dictionary from variable name
+  to a list with the values of that variable.  System missing values
+  become None, strings are stripped of trailing blanks.  If variables
+  is given, only those are returned; names are matched case
+  insensitively but returned as written in variables."""
+  stream = open(filename, 'rb')
+  try:
+    header = SavHeader(stream)
+    lookup = dict([ (n.lower(), i) for (i, n) in enumerate(header.names) ])
+    if variables is None:
+      variables = header.names
+    wanted = dict()
+    for v in variables:
+      try:
+        wanted[lookup[v.lower()]] = v
+      except KeyError:
+        raise KeyError("Variable '%s' not found in '%s'" % (v, filename))
+    columns = dict([ (v, list()) for v in wanted.values() ])
+    nsegments = len(header.segments)
+    unpackd = struct.Struct(header.endian + 'd').unpack
+    values = readvalues(header)
+    while True:
+      case = list()
+      for raw in values:
+        case.append(raw)
+        if len(case) == nsegments:
+          break
+      if len(case) < nsegments:
+        break
+      segment = 0
+      for (i, width) in enumerate(header.widths):
+        nseg = max(1, (width + 7) // 8)
+        if i in wanted:
+          if width == 0:
+            value = unpackd(case[segment])[0]
+            if value == header.sysmis:
+              value = None
+          else:
+            value = ''.join(case[segment:segment+nseg])[:width].rstrip()
+            value = value.decode(header.encoding, 'replace')
+          columns[wanted[i]].append(value)
+        segment += nseg
+  finally:
+    stream.close()
+  return columns
+
+
+
+########## chunked reading into a column store
+
+# rows per chunk of readcolumns
+CHUNKSIZE = 65536
+
+
+class CodedColumn(object):
+  """A categorical column as integer codes into its levels, which are
+  sorted ascending like SPSS sorts them; code -1 is missing"""
+
+  def __init__(self, levels, codes):
+    self.levels = levels
+    self.codes = codes
+
+  def __len__(self):
+    return len(self.codes)
+
+  def values(self):
+    """the values themselves, None for missing"""
+    import numpy
+    res = numpy.empty(len(self.codes), dtype=object)
+    present = self.codes >= 0
+    res[present] = self.levels[self.codes[present]]
+    return res
+
+  def __array__(self, dtype=None):
+    res = self.values()
+    if dtype is not None:
+      res = res.astype(dtype)
+    return res
+
+  def __iter__(self):
+    return iter(self.values())
+
+  def subset(self, keep):
+    return CodedColumn(self.levels, self.codes[keep])
+
+
+class ColumnStore(dict):
+  """Variable name -> column, as read by readcolumns: a float array for
+  numeric variables (NaN is missing), a CodedColumn for the others"""
+
+  def __init__(self, nrows=0):
+    dict.__init__(self)
+    self.nrows = nrows
+
+  def nbytes(self):
+    res = 0
+    for col in self.values():
+      if isinstance(col, CodedColumn):
+        res += col.codes.nbytes
+      else:
+        res += col.nbytes
+    return res
+
+
+class Coder(object):
+  """Codes the values of a categorical variable chunk by chunk: codes are
+  handed out in order of appearance and sorted at the end"""
+
+  def __init__(self):
+    self.lookup = dict()
+    self.chunks = list()
+
+  def code(self, values, missing):
+    import numpy
+    codes = numpy.empty(len(values), dtype=numpy.int32)
+    codes[missing] = -1
+    present = ~missing
+    if present.any():
+      # only the distinct values of the chunk go through the dictionary
+      uniq, inverse = numpy.unique(values[present], return_inverse=True)
+      mapped = numpy.array([ self.lookup.setdefault(u, len(self.lookup)) for u in uniq ],
+                           dtype=numpy.int32)
+      codes[present] = mapped[inverse]
+    return codes
+
+  def column(self, chunks):
+    import numpy
+    keys = self.lookup.keys()
+    levels = numpy.array(sorted(keys), dtype=object)
+    order = numpy.empty(len(keys) + 1, dtype=numpy.int32)
+    order[-1] = -1                         # code -1 stays -1
+    for (new, value) in enumerate(levels):
+      order[self.lookup[value]] = new
+    codes = numpy.concatenate(chunks) if chunks else numpy.zeros(0, dtype=numpy.int32)
+    codes = order[codes]
+    if len(levels) < 127:
+      codes = codes.astype(numpy.int8)
+    elif len(levels) < 32767:
+      codes = codes.astype(numpy.int16)
+    if len(levels) and not [ l for l in levels if isinstance(l, basestring) ]:
+      levels = levels.astype(float)
+    return CodedColumn(levels, codes)
+
+
+def findvariables(names, variables, filename):
+  """the index in names of every variable, matched case insensitively"""
+  lookup = dict([ (n.lower(), i) for (i, n) in enumerate(names) ])
+  res = list()
+  for v in variables:
+    try:
+      res.append(lookup[v.lower()])
+    except KeyError:
+      raise KeyError("Variable '%s' not found in '%s'" % (v, filename))
+  return res
+
+
+def savchunks(filename, variables, chunksize):
+  """Generate the variables of a system file as dictionaries of arrays of
+  up to chunksize rows: floats with NaN for system missing, or strings"""
+  import numpy
+  stream = open(filename, 'rb')
+  try:
+    header = SavHeader(stream)
+    indices = findvariables(header.names, variables, filename)
+    # the byte offset of every variable within a case
+    offsets = list()
+    segment = 0
+    for width in header.widths:
+      offsets.append(8 * segment)
+      segment += max(1, (width + 7) // 8)
+    casebytes = 8 * len(header.segments)
+    values = readvalues(header)
+    while True:
+      if header.compression == 0:
+        raw = stream.read(chunksize * casebytes)
+      else:
+        raw = ''.join(itertools.islice(values, chunksize * len(header.segments)))
+      ncases = len(raw) // casebytes
+      if ncases == 0:
+        return
+      cases = numpy.frombuffer(raw, dtype=numpy.uint8, count=ncases * casebytes)
+      cases = cases.reshape(ncases, casebytes)
+      chunk = dict()
+      for (v, i) in zip(variables, indices):
+        (offset, width) = (offsets[i], header.widths[i])
+        if width == 0:
+          col = cases[:, offset:offset+8].copy().view(header.endian + 'f8').ravel()
+          chunk[v] = numpy.where(col == header.sysmis, numpy.nan, col)
+        else:
+          col = cases[:, offset:offset+width].copy().view('S%d' % width).ravel()
+          # decode every distinct string once
+          uniq, inverse = numpy.unique(col, return_inverse=True)
+          uniq = numpy.array([ u.rstrip().decode(header.encoding, 'replace') for u in uniq ],
+                             dtype=object)
+          chunk[v] = uniq[inverse]
+      yield chunk
+      if ncases < chunksize:
+        return
+  finally:
+    stream.close()
+
+
+def csvvalues(texts):
+  """a column of CSV fields as floats (empty is NaN) if they all are
+  numbers, else as strings (empty is None)"""
+  import numpy
+  try:
+    return numpy.array([ float(t) if t.strip() else numpy.nan for t in texts ], dtype=float)
+  except ValueError:
+    return numpy.array([ t if t.strip() else None for t in texts ], dtype=object)
+
+
+def csvchunks(filename, variables, chunksize):
+  import csv
+  stream = open(filename, 'rb')
+  try:
+    reader = csv.reader(stream)
+    indices = findvariables([ n.strip() for n in reader.next() ], variables, filename)
+    while True:
+      rows = list(itertools.islice(reader, chunksize))
+      if not rows:
+        return
+      yield dict([ (v, csvvalues([ row[i] for row in rows ])) for (v, i) in zip(variables, indices) ])
+  finally:
+    stream.close()
+
+
+def parquetchunks(filename, variables, chunksize):
+  try:
+    import pyarrow.parquet
+  except ImportError:
+    raise ImportError("Reading Parquet files needs pyarrow")
+  import numpy
+  parquet = pyarrow.parquet.ParquetFile(filename)
+  names = parquet.schema.names
+  columns = [ names[i] for i in findvariables(names, variables, filename) ]
+  for batch in parquet.iter_batches(batch_size=chunksize, columns=columns):
+    chunk = dict()
+    for (v, name) in zip(variables, columns):
+      col = batch.column(batch.schema.get_field_index(name)).to_numpy(zero_copy_only=False)
+      if col.dtype.kind in 'iub':
+        col = col.astype(float)
+      chunk[v] = col
+    yield chunk
+
+
+def missingvalues(col):
+  import numpy
+  if col.dtype.kind == 'f':
+    return numpy.isnan(col)
+  return numpy.array([ x is None for x in col ], dtype=bool)
+
+
+def filechunks(filename, variables, chunksize=CHUNKSIZE, fileformat=None):
+  """the chunks of a .sav, .csv or .parquet file ('fileformat' if the
+  extension does not tell)"""
+  if fileformat is None:
+    fileformat = filename.rsplit('.', 1)[-1]
+  readers = dict(sav=savchunks, csv=csvchunks, parquet=parquetchunks, pq=parquetchunks)
+  try:
+    return readers[fileformat.lower()](filename, variables, chunksize)
+  except KeyError:
+    raise IOError("Cannot read '%s', not a .sav, .csv or .parquet file" % filename)
+
+
+def readcolumns(filename, variables, numeric=(), listwise=False, chunksize=CHUNKSIZE,
+                fileformat=None):
+  """Read the variables from a .sav, .csv or .parquet file ('fileformat'
+  if the extension does not tell) chunk by chunk into a ColumnStore.
+  The variables in 'numeric' (the dv) become float arrays, the others
+  are coded as CodedColumns.  With listwise set, rows with a missing
+  value on any of the variables are dropped.  Names are matched case
+  insensitively but the store uses them as written in variables."""
+  import numpy
+  chunks = filechunks(filename, variables, chunksize, fileformat)
+  numeric = set([ v.lower() for v in numeric ])
+  coders = dict([ (v, Coder()) for v in variables if v.lower() not in numeric ])
+  parts = dict([ (v, list()) for v in variables ])
+  nrows = 0
+  for chunk in chunks:
+    missing = dict([ (v, missingvalues(chunk[v])) for v in variables ])
+    if listwise:
+      keep = ~numpy.any([ missing[v] for v in variables ], axis=0)
+      chunk = dict([ (v, chunk[v][keep]) for v in variables ])
+      missing = dict([ (v, missing[v][keep]) for v in variables ])
+    for v in variables:
+      if v in coders:
+        parts[v].append(coders[v].code(chunk[v], missing[v]))
+      elif chunk[v].dtype.kind != 'f':
+        raise ValueError("Variable '%s' in '%s' is not numeric" % (v, filename))
+      else:
+        parts[v].append(chunk[v])
+    nrows += len(chunk[variables[0]]) if variables else 0
+  store = ColumnStore(nrows)
+  for v in variables:
+    if v in coders:
+      store[v] = coders[v].column(parts[v])
+    else:
+      store[v] = numpy.concatenate(parts[v]) if parts[v] else numpy.zeros(0)
+    del parts[v]
+  return store
+
+
+########## sufficient statistics
+
+class Statistics(ColumnStore):
+  """The sufficient statistics of the data of a model, see
+  readstatistics: one row per distinct combination of the categorical
+  variables (CodedColumns as in a ColumnStore), with the number of data
+  rows it stands for in 'counts' and the sum of every numeric variable
+  in its column.  'squares' holds the sum of squares of every numeric
+  variable, 'ncases' the number of data rows."""
+
+  def __init__(self, nrows=0):
+    ColumnStore.__init__(self, nrows)
+    self.counts = None
+    self.squares = dict()
+    self.ncases = 0
+
+  def nbytes(self):
+    return ColumnStore.nbytes(self) + self.counts.nbytes
+
+
+def groupsums(codes, counts, sums):
+  """Add up the counts and the sums (a list of arrays) of the rows of
+  codes that are equal; return the distinct rows, counts and sums"""
+  import numpy
+  if len(codes) == 0 or codes.shape[1] == 0:
+    inverse = numpy.zeros(len(codes), dtype=int)
+    codes = codes[:1]
+  else:
+    order = numpy.lexsort(codes.T[::-1])
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = (codes[order[1:]] != codes[order[:-1]]).any(axis=1)
+    inverse = numpy.empty(len(order), dtype=int)
+    inverse[order] = numpy.cumsum(first) - 1
+    codes = codes[order[first]]
+  counts = numpy.bincount(inverse, weights=counts, minlength=len(codes))
+  sums = [ numpy.bincount(inverse, weights=x, minlength=len(codes)) for x in sums ]
+  return codes, counts, sums
+
+
+def sufficientstatistics(chunks, variables, numeric=()):
+  """Add up the chunks (dictionaries of arrays, as from savchunks) into
+  Statistics, dropping incomplete rows listwise.  The rows of a chunk
+  are summed per group straight away and the groups so far are summed
+  again whenever the rows waiting outnumber them, so memory stays in
+  proportion to the number of groups."""
+  import numpy
+  numeric = set([ v.lower() for v in numeric ])
+  categorical = [ v for v in variables if v.lower() not in numeric ]
+  numeric = [ v for v in variables if v.lower() in numeric ]
+  coders = dict([ (v, Coder()) for v in categorical ])
+  parts = ([], [], [ list() for v in numeric ])
+  (squares, ncases, waiting, grouped) = (numpy.zeros(len(numeric)), 0, 0, 0)
+  for chunk in chunks:
+    keep = ~numpy.any([ missingvalues(chunk[v]) for v in variables ], axis=0)
+    m = int(keep.sum())
+    for v in numeric:
+      if chunk[v].dtype.kind != 'f':
+        raise ValueError("Variable '%s' is not numeric" % v)
+    codes = numpy.zeros((m, len(categorical)), dtype=numpy.int32)
+    for (j, v) in enumerate(categorical):
+      codes[:, j] = coders[v].code(chunk[v][keep], numpy.zeros(m, dtype=bool))
+    values = [ chunk[v][keep] for v in numeric ]
+    squares += [ numpy.dot(x, x) for x in values ]
+    (codes, counts, sums) = groupsums(codes, numpy.ones(m), values)
+    parts[0].append(codes)
+    parts[1].append(counts)
+    for (part, x) in zip(parts[2], sums):
+      part.append(x)
+    ncases += m
+    waiting += len(codes)
+    if waiting > grouped:
+      (codes, counts, sums) = groupsums(numpy.concatenate(parts[0]), numpy.concatenate(parts[1]),
+                                        [ numpy.concatenate(part) for part in parts[2] ])
+      parts = ([codes], [counts], [ [x] for x in sums ])
+      (waiting, grouped) = (0, len(codes))
+  if len(parts[0]) != 1:
+    empty = numpy.zeros((0, len(categorical)), dtype=numpy.int32)
+    (codes, counts, sums) = groupsums(numpy.concatenate([empty] + parts[0]),
+                                      numpy.concatenate([numpy.zeros(0)] + parts[1]),
+                                      [ numpy.concatenate([numpy.zeros(0)] + part)
+                                        for part in parts[2] ])
+  store = Statistics(len(codes))
+  for (j, v) in enumerate(categorical):
+    store[v] = coders[v].column([codes[:, j]])
+  for (v, x, ss) in zip(numeric, sums, squares):
+    (store[v], store.squares[v]) = (x, ss)
+  store.counts = counts
+  store.ncases = ncases
+  return store
+
+
+def readstatistics(filename, variables, numeric=(), chunksize=CHUNKSIZE, fileformat=None):
+  """Read the sufficient statistics of the variables (see Statistics)
+  from a .sav, .csv or .parquet file in one pass of chunks.  The
+  variables in 'numeric' (the dv) are summed, the others are the
+  groups; incomplete rows are left out."""
+  return sufficientstatistics(filechunks(filename, variables, chunksize, fileformat), variables,
+                              numeric)
+
+
+
+if __name__ == '__main__':
+  pass
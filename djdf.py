@@ -0,0 +1,180 @@
+# djdf.py
+#
+# Denominator df for the tests of fixed effects of a native fit, by the
+# approximation of Satterthwaite or that of Kenward and Roger (1997).
+#
+# Both need the derivatives of Phi, the covariance matrix of beta, to
+# the variance components phi, and the asymptotic covariance matrix W
+# of the components.  These are computed once per model, from central
+# differences of the precision X'V^-1 X (a function of phi, see
+# derivatives); after that the df of a contrast l beta is
+#
+#   2 (l Phi l')^2 / g' W g,   g_i = l dPhi/dphi_i l'
+#
+# for any number of contrasts at once (DfApproximation.contrastdf), and
+# an F test of several rows combines the df of the eigenvectors of its
+# L Phi L' as SAS does.
+#
+# Kenward-Roger also needs the second derivatives of the precision.  It
+# inflates Phi for the uncertainty in phi (Phi_A) and scales F, see
+# DfApproximation.test.  V is linear in phi for all covariance
+# structures of djnative, so the second derivatives of V (R_ij of
+# Kenward and Roger) vanish.  W is the inverse of half the hessian of
+# the deviance that was maximized (ML or REML), not the expected REML
+# information of the paper.  For a single contrast the scale is 1 and
+# the df are those of Satterthwaite, only the standard error differs.
+#
+# Nothing in here needs spss.
+#
+# $Revision$
+
+import numpy
+
+
+DFMETHODS = ('satterthwaite', 'kenwardroger')
+
+
+class DfError(Exception):
+  pass
+
+
+def dfmethodname(dfmethod):
+  """the df approximation, SATTERTHWAITE or KENWARDROGER, in lower case"""
+  dfmethod = (dfmethod or 'satterthwaite').lower()
+  if not dfmethod in DFMETHODS:
+    raise DfError("The df method must be SATTERTHWAITE or KENWARDROGER, not '%s'" % dfmethod)
+  return dfmethod
+
+
+def derivatives(precision, phi, free, steps, second=False):
+  """Central differences of precision(phi), the p x p matrix X'V^-1 X,
+  to the free components of phi: the first derivatives as a k x p x p
+  array and, with second, the second derivatives as k x k x p x p (or
+  None).  steps are the steps for all components."""
+  k = len(free)
+  shifted = dict()
+  def at(*shifts):
+    key = tuple(sorted(shifts))
+    if not key in shifted:
+      x = numpy.array(phi, dtype=float)
+      for (i, sign) in shifts:
+        x[free[i]] += sign * steps[free[i]]
+      shifted[key] = precision(x)
+    return shifted[key]
+  P0 = at()
+  first = numpy.array([ (at((i, 1)) - at((i, -1))) / (2 * steps[free[i]])
+                        for i in range(k) ]).reshape((k,) + P0.shape)
+  if not second:
+    return first, None
+  hessian = numpy.empty((k, k) + P0.shape)
+  for i in range(k):
+    hi = steps[free[i]]
+    hessian[i, i] = (at((i, 1)) - 2 * P0 + at((i, -1))) / hi ** 2
+    for j in range(i):
+      hj = steps[free[j]]
+      hessian[i, j] = hessian[j, i] = (at((i, 1), (j, 1)) - at((i, 1), (j, -1))
+                                       - at((i, -1), (j, 1)) + at((i, -1), (j, -1))) \
+                                      / (4 * hi * hj)
+  return first, hessian
+
+
+class DfApproximation(object):
+  """The df of contrasts on the fixed effects of one model.  covbeta is
+  Phi, dprecision the first derivatives of its inverse to the free
+  variance components (see derivatives) and W their covariance matrix;
+  with hessian, the second derivatives, the approximation is that of
+  Kenward-Roger, unless the adjusted Phi is not positive definite (on
+  the boundary of the parameter space, where the differences straddle
+  a kink), which leaves Satterthwaite in 'method'.  columns, if given,
+  are the positions of the parameters among all parameter labels of
+  the model (djnative leaves out the redundant ones), see reduce.  Only
+  arrays are kept, so the object pickles with the output tree of the
+  model."""
+
+  def __init__(self, covbeta, dprecision, W, hessian=None, columns=None):
+    self.covbeta = covbeta
+    # dPhi/dphi_i = -Phi dPhi^-1/dphi_i Phi
+    self.jacobian = -numpy.einsum('ab,kbc,cd->kad', covbeta, dprecision, covbeta)
+    self.W = W
+    self.columns = None if columns is None else numpy.asarray(columns, dtype=int)
+    self.method = 'satterthwaite'
+    self.adjusted = covbeta
+    if hessian is not None:
+      adjusted = self.kenwardrogercovariance(dprecision, hessian)
+      if numpy.all(numpy.linalg.eigvalsh(adjusted) > 0):
+        (self.method, self.adjusted) = ('kenwardroger', adjusted)
+
+  def kenwardrogercovariance(self, dprecision, hessian):
+    """Phi_A = Phi + 2 Phi (sum W_ij (Q_ij - P_i Phi P_j)) Phi, where
+    Q_ij + Q_ji is the second derivative of the precision (R_ij is 0)
+    and W is symmetric, so Q_ij may be taken as half of it"""
+    Phi = self.covbeta
+    P = dprecision
+    inner = 0.5 * numpy.einsum('ij,ijab->ab', self.W, hessian) \
+            - numpy.einsum('ij,iab,bc,jcd->ad', self.W, P, Phi, P)
+    res = Phi + 2 * numpy.dot(numpy.dot(Phi, inner), Phi)
+    return 0.5 * (res + res.T)
+
+  def reduce(self, L):
+    """L on all parameter labels to L on the parameters of covbeta"""
+    L = numpy.atleast_2d(numpy.asarray(L, dtype=float))
+    if self.columns is None:
+      return L
+    return L[:, self.columns]
+
+  def contrastdf(self, L):
+    """The Satterthwaite df of every row of L as a contrast by itself,
+    all at once: 2 (l Phi l')^2 / g' W g"""
+    L = numpy.atleast_2d(L)
+    variances = numpy.einsum('ni,ij,nj->n', L, self.covbeta, L)
+    g = numpy.einsum('ni,kij,nj->nk', L, self.jacobian, L)
+    denominator = numpy.einsum('nk,kl,nl->n', g, self.W, g)
+    return 2 * variances ** 2 / numpy.where(denominator > 0, denominator, numpy.nan)
+
+  def test(self, L, beta):
+    """(F, numerator df, denominator df) for the test of L beta = 0.  L
+    is replaced by the rows of its eigenvectors with nonzero variance,
+    which makes it full rank."""
+    L = numpy.atleast_2d(L)
+    (d, E) = numpy.linalg.eigh(numpy.dot(numpy.dot(L, self.covbeta), L.T))
+    rows = d > max(d.max(), 0) * 1e-10 if len(d) else d > 0
+    if not rows.any():
+      raise DfError("The hypothesis has no estimable part")
+    (d, L) = (d[rows], numpy.dot(E[:, rows].T, L))
+    r = len(d)
+    if self.method == 'kenwardroger':
+      return self.kenwardroger(L, beta, d)
+    F = numpy.sum(numpy.dot(L, beta) ** 2 / d) / r
+    nus = self.contrastdf(L)
+    if r == 1:
+      return F, r, nus[0]
+    E = sum([ nu / (nu - 2) for nu in nus if nu > 2 ])
+    if E > r:
+      return F, r, 2 * E / (E - r)
+    return F, r, min(nus)
+
+  def kenwardroger(self, L, beta, d):
+    """the scaled F and its df, for L full rank with L Phi L' = diag(d)"""
+    r = float(len(d))
+    Theta = numpy.dot(L.T / d, L)
+    TJ = numpy.einsum('ab,kbc->kac', Theta, self.jacobian)
+    traces = numpy.einsum('kaa->k', TJ)
+    A1 = numpy.dot(traces, numpy.dot(self.W, traces))
+    A2 = numpy.einsum('ij,iab,jba->', self.W, TJ, TJ)
+    B = (A1 + 6 * A2) / (2 * r)
+    g = ((r + 1) * A1 - (r + 4) * A2) / ((r + 2) * A2)
+    denominator = 3 * r + 2 * (1 - g)
+    (c1, c2, c3) = (g / denominator, (r - g) / denominator, (r + 2 - g) / denominator)
+    Estar = 1 / (1 - A2 / r)
+    Vstar = 2 / r * (1 + c1 * B) / ((1 - c2 * B) ** 2 * (1 - c3 * B))
+    rho = Vstar / (2 * Estar ** 2)
+    m = 4 + (r + 2) / (r * rho - 1)
+    scale = m / (Estar * (m - 2))
+    Lb = numpy.dot(L, beta)
+    F = numpy.dot(Lb, numpy.linalg.solve(numpy.dot(numpy.dot(L, self.adjusted), L.T), Lb)) / r
+    return scale * F, int(r), m
+
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,152 @@
+# djdiagnostics.py
+#
+# Residual diagnostics for PLOT=RESIDUALS and PLOT=EQUALVARIANCE.  These
+# used to be a DESCRIPTIVES /SAVE pass for the standardized residuals,
+# EXAMINE and GRAPH for the residual plots and a designcell variable
+# plus GGRAPH for the equal variance plot: four passes over the data per
+# model.  Here everything comes from one pass over the residual column
+# (and the main predictors): the standardized residuals, a summary of
+# the residuals, their variance per design cell and the Levene and
+# Brown-Forsythe tests of equal variance.
+#
+# Levene's test is the one-way ANOVA F of the absolute deviations of the
+# residuals from their cell mean; Brown and Forsythe (1974) use the
+# deviations from the cell median instead, which keeps its size when the
+# residuals are skewed.
+#
+# $Revision$
+
+try:
+  import numpy
+except ImportError:
+  raise ImportError("The residual diagnostics of DJMIXED need numpy")
+
+import djstats
+
+
+# standardized residuals beyond this are counted as outlying
+OUTLYING = 3.0
+
+
+def leveltext(value):
+  if isinstance(value, (float, numpy.floating)) and value == int(value):
+    return '%d' % value
+  return ('%s' % value).strip()
+
+
+def designcells(columns):
+  """The design cell of every row of the (complete) columns of the main
+  predictors: a code 0..ncell-1 per row and the label of every cell,
+  the levels of the predictors in the order of the columns"""
+  n = len(columns[0]) if columns else 0
+  if not columns:
+    return numpy.zeros(n, dtype=int), ['All']
+  key = numpy.zeros(n, dtype=numpy.int64)
+  allevels = list()
+  for col in columns:
+    levels, codes = numpy.unique(numpy.asarray(col), return_inverse=True)
+    key = key * len(levels) + codes
+    allevels.append(levels)
+  ukey, first, cells = numpy.unique(key, return_index=True, return_inverse=True)
+  labels = list()
+  for row in first:
+    labels.append(' '.join([ leveltext(numpy.asarray(col)[row]) for col in columns ]))
+  return cells, labels
+
+
+def onewayF(values, groups, ngroups):
+  """F, df1, df2 and p of the one-way ANOVA of values over groups"""
+  n = len(values)
+  counts = numpy.bincount(groups, minlength=ngroups).astype(float)
+  present = counts > 0
+  k = int(present.sum())
+  if k < 2 or n <= k:
+    return None
+  means = numpy.bincount(groups, weights=values, minlength=ngroups)[present] / counts[present]
+  grand = values.mean()
+  between = (counts[present] * (means - grand) ** 2).sum()
+  within = ((values - numpy.bincount(groups, weights=values, minlength=ngroups)[groups]
+             / counts[groups]) ** 2).sum()
+  df1, df2 = k - 1, n - k
+  if within <= 0:
+    return None
+  F = (between / df1) / (within / df2)
+  return F, df1, df2, djstats.pf(F, df1, df2, lowertail=False)
+
+
+def cellmedians(values, groups, ngroups):
+  """the median of values within every group, in one sort"""
+  order = numpy.lexsort((values, groups))
+  counts = numpy.bincount(groups, minlength=ngroups)
+  starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+  sortedvalues = values[order]
+  low = starts + (counts - 1) // 2
+  high = starts + counts // 2
+  res = numpy.zeros(ngroups)
+  present = counts > 0
+  res[present] = (sortedvalues[low[present]] + sortedvalues[high[present]]) / 2.0
+  return res
+
+
+class Diagnostics(object):
+  """The diagnostics of the residuals of one model.  Rows with a missing
+  residual (NaN) are left out."""
+
+  def __init__(self, residuals, cells=None, labels=None):
+    residuals = numpy.asarray(residuals, dtype=float)
+    if cells is None:
+      cells, labels = numpy.zeros(len(residuals), dtype=int), ['All']
+    present = ~numpy.isnan(residuals)
+    r = residuals[present]
+    cells = numpy.asarray(cells)[present]
+    self.n = n = len(r)
+    if n < 3:
+      raise ValueError("Too few residuals for diagnostics: %d" % n)
+    self.mean = r.mean()
+    self.sd = r.std(ddof=1)
+    self.minimum, self.maximum = r.min(), r.max()
+    # skewness and kurtosis with the small sample corrections SPSS uses
+    m2 = ((r - self.mean) ** 2).sum() / n
+    m3 = ((r - self.mean) ** 3).sum() / n
+    m4 = ((r - self.mean) ** 4).sum() / n
+    self.skewness = m3 / m2 ** 1.5 * numpy.sqrt(n * (n - 1.0)) / (n - 2)
+    self.kurtosis = None
+    if n > 3:
+      self.kurtosis = ((n + 1.0) * (m4 / m2 ** 2) - 3 * (n - 1.0)) * (n - 1) / ((n - 2.0) * (n - 3))
+    self.zresiduals = numpy.empty(len(residuals))
+    self.zresiduals[:] = numpy.nan
+    self.zresiduals[present] = (r - self.mean) / self.sd
+    self.outlying = int((numpy.abs(self.zresiduals[present]) > OUTLYING).sum())
+
+    # per design cell
+    self.labels = list(labels)
+    k = len(self.labels)
+    counts = numpy.bincount(cells, minlength=k)
+    sums = numpy.bincount(cells, weights=r, minlength=k)
+    self.cellcounts = counts
+    self.cellmeans = sums / numpy.maximum(counts, 1)
+    deviations = r - self.cellmeans[cells]
+    squares = numpy.bincount(cells, weights=deviations ** 2, minlength=k)
+    self.cellvariances = numpy.where(counts > 1, squares / numpy.maximum(counts - 1, 1), numpy.nan)
+    self.levene = onewayF(numpy.abs(deviations), cells, k)
+    self.brownforsythe = onewayF(numpy.abs(r - cellmedians(r, cells, k)[cells]), cells, k)
+
+  def plotdata(self, filename, residuals, predicted=None, cells=None):
+    """Write the data for residual plots to a CSV file: residual,
+    standardized residual, predicted value and design cell label per
+    row; for when plots are wanted after all"""
+    stream = open(filename, 'w')
+    try:
+      stream.write('residual,zresidual,predicted,designcell\n')
+      for i in range(len(residuals)):
+        values = [residuals[i], self.zresiduals[i], predicted[i] if predicted is not None else None]
+        values = [ '' if v is None or v != v else repr(float(v)) for v in values ]
+        label = self.labels[cells[i]] if cells is not None else ''
+        stream.write('%s,"%s"\n' % (','.join(values), label.replace('"', '""')))
+    finally:
+      stream.close()
+
+
+
+if __name__ == '__main__':
+  pass
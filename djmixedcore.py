@@ -21,7 +21,6 @@
 # - the program should check whether numeric predictors are used, as string preds are possible in MIXED but not
 #   supported here (yet)
 # - unify treatment of spss errors and warnings
-# - check equality of residual variances with a levene or so.
 # - interaction plots?
 # 
 
@@ -29,23 +28,27 @@
 # TODO check whether to use updated versions of extension for later spss versions,
 # or shall i simply not bother?
 
-import spss, spssaux, extension16
-import djstats
-import textwrap
+import spss
+import djstats, djregistry, djstore, djprofile
+from djterms import fullfactorial, reparsepredictors, modelvariables, splitslopes
 import random, re, os
+# spssaux and extension16 (for Run), djoxml (for reading output trees)
+# and djnative c.s. are imported where they are first needed: a job that
+# only starts and stops models should not pay for them.  djstats finds
+# its cephes library on first use.
 
 __author__ = "dirk p. janssen"
 __version__ = "$Id$: spam 41c 29Aug11 spam eggs ham".split()
 __version__ = "Revision: %s at %s" % (__version__[2], __version__[3]) 
-print """Importing DJMIXED by Dirk P. Janssen, %s """ % __version__
-print """Reading python files from """, os.path.abspath(__file__)
 
 
 # globals
 modelnumber = 1
-currentmodel = None
-# each model has an OMS handle, which is stored in this set
-modelhandles = set()  
+# at most this many models keep their full OXML in the xml workspace
+MAXHANDLES = 20
+# directory of the results of earlier fits, see djstore; None for no store
+RESULTSTORE = os.environ.get('DJMIXED_STORE',
+                             os.path.join(os.path.expanduser('~'), '.djmixed', 'store'))
 pluginversion = spss.GetDefaultPlugInVersion()
 
 
@@ -53,6 +56,10 @@ pluginversion = spss.GetDefaultPlugInVersion()
 DEBUG = True
 DEBUG = False
 
+if DEBUG:
+  print """Importing DJMIXED by Dirk P. Janssen, %s """ % __version__
+  print """Reading python files from """, os.path.abspath(__file__)
+
 
 class DjmixedFatal(Exception):
   pass
@@ -73,6 +80,7 @@ def xpastring(paragraph):
 def blockstring(paragraph, width=75):
   """complete reformat the paragraph to have separated lines of only
   'width' characters."""
+  import textwrap
   text = longstring(paragraph)
   return textwrap.fill(text, width)
 
@@ -135,7 +143,49 @@ def silentsubmit(spsscmd):
   except spss.errMsg.SpssError, v:
     error = ('SpssError', v)
   return error
-               
+
+
+
+def loadoutput(name):
+  import djoxml
+  return djoxml.OutputTree(spss.GetXmlUtf16(name))
+
+
+def releaseoutput(name):
+  spss.DeleteXPathHandle(name)
+
+
+def captureoutput(name, directory):
+  """Write the OXML of handle 'name' to directory/name.xml, for the
+  replay stand-in of spss (see replay/spss.py) to serve later"""
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  text = re.sub(r'^\s*<\?xml[^>]*\?>', '', spss.GetXmlUtf16(name)).lstrip()
+  filename = os.path.join(directory, name + '.xml')
+  stream = open(filename, 'wb')
+  try:
+    stream.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    stream.write(text.encode('utf-8'))
+  finally:
+    stream.close()
+  return filename
+
+
+# every model by name: its OMS handle and parsed output, see djregistry
+registry = djregistry.ModelRegistry(MAXHANDLES, loadoutput, releaseoutput)
+
+# time the calls to spss if DJMIXED_PROFILE is set, see djprofile
+djprofile.fromenvironment(spss)
+
+
+def modeloutput(name):
+  """Return the parsed output tree of model 'name'.  The OXML is
+  fetched from the xml workspace and parsed only the first time it is
+  asked for, all later questions are answered from the registry."""
+  if not name in registry:
+    # a handle that was not made by us
+    return loadoutput(name)
+  return registry.get(name)
 
 
 
@@ -145,17 +195,13 @@ def startmodel(name, message=True, output='SPLIT'):
   Contrary to what the user may think, this actually only
   starts a OMS output block with certain output copied to OXML, and
   output stored under xmlworkspace 'name'."""
-  global currentmodel, modelhandles
-  
   if name is None or name=='':
     raise DjmixedFatal('Name argument mandatory for startmodel')
-  if currentmodel is not None:
-    print "Startmodel triggered Stopmodel for '%s'" % currentmodel
-    stopmodel(currentmodel)
-  if name in modelhandles:
-      """remove previous output under same name"""
-      spss.DeleteXPathHandle(name)
-      modelhandles.remove(name)
+  if registry.current is not None:
+    print "Startmodel triggered Stopmodel for '%s'" % registry.current
+    stopmodel(registry.current)
+  if registry.remove(name):
+      # removed previous output under same name
       print "Removed old model by this name"
 
   if message or output=='split':
@@ -177,8 +223,8 @@ def startmodel(name, message=True, output='SPLIT'):
       /DESTINATION  format=oxml xmlworkspace='%s' viewer=%s
       /TAG='%s' """ % (name, viewer, name) )
   spss.Submit(cmd)
-  currentmodel = name
-  modelhandles.add(name)
+  registry.addhandle(name)
+  registry.current = name
   
 
 def stopmodel(name=None, message=True, modelerror=None):
@@ -190,11 +236,10 @@ def stopmodel(name=None, message=True, modelerror=None):
   error with the model are generated (regardless of 'message').  If
   'modelerror' is None, the GetLastErrorLevel is checked and a
   carefully phrased note produced if a warning was logged. """
-  global currentmodel
   notchecked = list().append("not checked")
   if name is None or name=='' or name=='*':
-    name = currentmodel
-  elif name !=currentmodel:
+    name = registry.current
+  elif name != registry.current:
     spss.Submit(r"""omsend.""" % name)
     raise DjmixedFatal('Name argument of stopmodel does not match last startmodel')
   
@@ -204,12 +249,11 @@ def stopmodel(name=None, message=True, modelerror=None):
     errorlevel = notchecked 
   spss.Submit(r"""omsend tag='%s'.""" % name)
 
-  xpa = xpastring("""//command[@command='Mixed']/@text""")
-  analyses = spss.EvaluateXPath(name, '/outputTree', xpa)
+  analyses = djprofile.call('stopmodel check', modeloutput, name).commandcount('Mixed')
   outputweird = ""
-  if len(analyses)==0:
+  if analyses==0:
     outputweird = blockstring("""No MIXED output found: Did your commands succeed?""")
-  elif len(analyses)>1:
+  elif analyses>1:
     outputweird = blockstring("""Multiple MIXED outputs found: Please review your syntax""")
 
 
@@ -237,7 +281,7 @@ def stopmodel(name=None, message=True, modelerror=None):
     if message:
       spss.TextBlock("StopModel", "Ending model '%s'" % name)
     spss.EndProcedure()
-  currentmodel = None
+  registry.current = None
 
 
 def getm2llr(name, verbose=False):
@@ -245,46 +289,40 @@ def getm2llr(name, verbose=False):
 
   Optionally prints the value of the -2LLR from the Information Criteria table, mostly
   for testing purposes."""
-  # TODO add a [1] or [Last] here and to all xpaths.
-  xpa = xpastring("""//pivotTable[@subType='Information Criteria']
-    //dimension[@axis='row']
-    //category[@text="-2 Log Likelihood"]
-    /cell/@text""")
-  m2llr = spss.EvaluateXPath(name, '/outputTree', xpa)[0]
+  # TODO add a [1] or [Last] here and to all lookups.
+  output = modeloutput(name)
+  m2llr = (output.texts('Information Criteria', row="-2 Log Likelihood") or
+           output.texts('Information Criteria', row="-2 Restricted Log Likelihood"))[0]
   if verbose:
     print m2llr
   return m2llr
 
 
+def remlfit(name):
+  """whether the model was fitted by REML, from its Information Criteria"""
+  return bool(modeloutput(name).texts('Information Criteria',
+                                      row="-2 Restricted Log Likelihood"))
+
+
 def getaic(name, verbose=False):
   """Utility function to obtain AIC"""
-  xpa = xpastring("""//pivotTable[@subType='Information Criteria']
-    //dimension[@axis='row']
-    //category[@text="Akaike's Information Criterion (AIC)"]
-    /cell/@text""") # ' single quote to fool python-mode
-  aic = spss.EvaluateXPath(name, '/outputTree', xpa)[0]
+  aic = modeloutput(name).texts('Information Criteria',
+                                row="Akaike's Information Criterion (AIC)")[0]
   if verbose:
     print aic
   return aic
 
 
 def getnumparameters(name, verbose=False):
-  xpa = xpastring("""//pivotTable[@subType='Model Dimension']
-    //dimension[@axis='row']//category[@text="Total"]
-    //dimension[@axis='column']//category[@text="Number of Parameters"]
-    /cell/@text""")
-  df = spss.EvaluateXPath(name, '/outputTree', xpa)[0]
+  df = modeloutput(name).texts('Model Dimension', row="Total", col="Number of Parameters")[0]
   if verbose:
     print df
   return df
 
 
 def getrandomparameters(name, verbose=False):
-  xpa = xpastring("""//pivotTable[@subType='Model Dimension']
-    //group[@text='Random Effects']
-    //dimension[@axis=\'column\']/category[@text="Number of Parameters"]
-    /cell/@text""")
-  params = spss.EvaluateXPath(name, '/outputTree', xpa)
+  params = modeloutput(name).texts('Model Dimension', row='Random Effects',
+                                   col="Number of Parameters")
   # first we check whether there are any random effects
   if len(params)>0:
     params = [ int(p) for p in params ]
@@ -295,6 +333,11 @@ def getrandomparameters(name, verbose=False):
   return params
 
 
+def getwarnings(name):
+  """Return the texts of all cells in the Warnings tables of the model"""
+  return modeloutput(name).texts('Warnings')
+
+
 def getallvarnames(strmethod=None, labels=False):
   """Return a list with all variable names from the spss dataset; if
   labels is set, return a list of variable name/variable label tuples"""
@@ -313,6 +356,33 @@ def getallvarnames(strmethod=None, labels=False):
   return res
 
 
+class DataDictionary(object):
+  """A snapshot of the dictionary of the active dataset, read in one go:
+  name, type (0 numeric, else string width), format and label of every
+  variable, looked up without regard to case"""
+
+  def __init__(self):
+    self.variables = list()
+    self.lookup = dict()
+    for n in range(spss.GetVariableCount()):
+      var = dict(name=spss.GetVariableName(n), type=spss.GetVariableType(n),
+                 format=spss.GetVariableFormat(n), label=spss.GetVariableLabel(n))
+      self.variables.append(var)
+      self.lookup[var['name'].lower()] = var
+    self.ncases = spss.GetCaseCount()
+
+  def __contains__(self, name):
+    return name.lower() in self.lookup
+
+  def get(self, name):
+    return self.lookup.get(name.lower())
+
+  def names(self, strmethod=None):
+    res = [ var['name'] for var in self.variables ]
+    if strmethod:
+      res = [ getattr(name, strmethod)() for name in res ]
+    return res
+
 
 class ModelComparison(object):
   def __init__(self, title1, title2):
@@ -330,6 +400,7 @@ class ModelComparison(object):
     self.npar2 = getnumparameters(self.name2)
     self.nrandom1 = sum(getrandomparameters(self.name1))
     self.nrandom2 = sum(getrandomparameters(self.name2))
+    self.reml = remlfit(self.name1) or remlfit(self.name2)
 
 
   def swapparams(self, inspssproc=True):
@@ -361,14 +432,11 @@ class ModelComparison(object):
     """Test both models for convergence, produce warning message if appropriate"""
 
     wronglist = list()
-    xpa = "//pivotTable[@subType='Warnings']//dimension[@axis='row']//category/cell/@text"
-    errmsg = spss.EvaluateXPath(self.name1, '/outputTree', xpa)
     re_errmsg = re.compile("convergence has not been achieved|final Hessian matrix is not positive definite")
-    if errmsg and re_errmsg.search(errmsg):
-      wronglist.append(self.name1)
-    errmsg = spss.EvaluateXPath(self.name2, '/outputTree', xpa)
-    if errmsg and re_errmsg.search(errmsg):
-      wronglist.append(self.name2)
+    for name in (self.name1, self.name2):
+      errmsg = '\n'.join(getwarnings(name))
+      if errmsg and re_errmsg.search(errmsg):
+        wronglist.append(name)
     if wronglist:
       return longstring("""SPSS output seems to indicate
       that model(s) '%s' did not converge.  If this is correct, the
@@ -399,7 +467,7 @@ def invalidhandlewarning(handlelist):
   """This function generates a detailed warning if there any invalid
   handle names in the handlelist.  It returns False if there was no
   warning, True if there was. """
-  inlist = spss.GetHandleList()
+  inlist = list(spss.GetHandleList()) + registry.names()
   res = list()
   for h in handlelist:
     if not h in inlist:
@@ -501,6 +569,10 @@ def comparemodels(name1, name2):
     of Model B against the lower number of parameters of Model A and
     suggests which model is best based on a Chi-Squared test (with
     alpha=%f).""" % alpha)
+    if mc.reml:
+      assumptions += '\n' + footnote("""Warning: REML likelihoods can only
+      compare models with the same fixed effects, refit both models with
+      METHOD=ML for this test.""")
     convwarn = mc.convergencetest()
     if convwarn:
        table.TitleFootnotes(str(convwarn) + '\n' + assumptions)
@@ -540,9 +612,8 @@ def comparerandommodels(name1, name2):
     mc.make_numeric()
 
     chisqvalue = mc.fit1 - mc.fit2
-    chisqpval1 = djstats.pchisq(chisqvalue, mc.nrandom1, lowertail=False)
-    chisqpval2 = djstats.pchisq(chisqvalue, mc.nrandom2, lowertail=False)
-    chisqpval = 0.5* chisqpval1 + 0.5* chisqpval2
+    chisqpval = djstats.pchibarsq(chisqvalue, [0.5, 0.5], [mc.nrandom1, mc.nrandom2],
+                                  lowertail=False)
     chisqdf = str(mc.nrandom1) + "," + str(mc.nrandom2)
 
     if chisqpval < 0.05:
@@ -590,6 +661,220 @@ def comparerandommodels(name1, name2):
 
 
 
+class FitIndices(object):
+  """The fit indices and terms of one model, extracted once for compareall"""
+
+  def __init__(self, name):
+    self.name = name
+    output = modeloutput(name)
+    try:
+      self.fit = float(getm2llr(name))
+      self.aic = float(getaic(name))
+      self.npar = int(getnumparameters(name))
+    except (ValueError, IndexError), v:
+      raise DjmixedFatal("Could not read the fit indices of model '%s': %s" % (name, v))
+    self.nrandom = sum(getrandomparameters(name))
+    self.fixedterms = frozenset(output.rowitems('Tests of Fixed Effects'))
+    self.randomterms = randomeffectset(output)
+    self.reml = remlfit(name)
+
+  def nestedin(self, other):
+    """whether this model is a proper submodel of the other, by its terms;
+    REML likelihoods only compare models with the same fixed terms"""
+    if self.reml != other.reml or (self.reml and self.fixedterms != other.fixedterms):
+      return False
+    return (self.fixedterms <= other.fixedterms and self.randomterms <= other.randomterms
+            and (self.fixedterms, self.randomterms) != (other.fixedterms, other.randomterms))
+
+
+def randomeffectset(output):
+  """The random effects of a model as a set, for nesting: the residual,
+  every (subject variable, effect) pair, like ('Word', 'Intercept') and
+  ('Word', 'priming'), and (subject variable, 'covariances') for a term
+  with COVTYPE(UN).  So random intercepts are nested in random slopes,
+  and DIAG in UN."""
+  res = set()
+  for rterm in output.rowitems('Covariance Parameter Estimates'):
+    match = re_randomterm.match(rterm)
+    if not match:
+      res.add(rterm)
+      continue
+    subject = match.group(2)
+    res.update([ (subject, effect) for effect in match.group(1).split(' + ') ])
+    if [ s for (s, line, redundant) in covparmlines(output, rterm) if s and s.startswith('UN') ]:
+      res.add((subject, 'covariances'))
+  return frozenset(res)
+
+
+def compareall(names=None):
+  """Compare every pair of nested models among 'names' (default: all
+  models) with a likelihood ratio test, and rank all models on AIC.
+
+  Model A is nested in model B when its fixed terms and its random
+  terms are subsets of those of B, and both are fitted with the same
+  method (with REML, only models with the same fixed terms).  Pairs
+  that differ in random terms only are tested with the chi-square
+  mixture of comparerandommodels, pairs that differ in fixed terms only
+  with the chi-square of comparemodels.  Pairs that differ in both are
+  listed but not tested, neither test applies to them."""
+  import numpy
+  if not names:
+    names = registry.names()
+  if invalidhandlewarning(names):
+    raise DjmixedFatal('Invalid model names')
+  spss.StartProcedure("DJMIXED.CompareAll")
+  try:
+    models = [ FitIndices(name) for name in names ]
+    pairs = [ (i, j) for (i, a) in enumerate(models) for (j, b) in enumerate(models)
+              if a.nestedin(b) and a.npar < b.npar ]
+    fit = numpy.array([ m.fit for m in models ])
+    npar = numpy.array([ m.npar for m in models ])
+    nrandom = numpy.array([ m.nrandom for m in models ])
+    alpha = 0.05
+
+    if pairs:
+      (small, large) = [ numpy.array(x) for x in zip(*pairs) ]
+      chisq = fit[small] - fit[large]
+      df = npar[large] - npar[small]
+      randomonly = numpy.array([ models[i].fixedterms == models[j].fixedterms
+                                 for (i, j) in pairs ])
+      fixedonly = numpy.array([ models[i].randomterms == models[j].randomterms
+                                for (i, j) in pairs ])
+      pval = djstats.pchisq(chisq, df, lowertail=False)
+      # the mixture of comparerandommodels
+      mixture = djstats.pchibarsq(chisq, [0.5, 0.5], [nrandom[small], nrandom[large]],
+                                  lowertail=False)
+      pval = numpy.where(randomonly, mixture, pval)
+      cells = list()
+      for (k, (i, j)) in enumerate(pairs):
+        if randomonly[k] or fixedonly[k]:
+          cells.append([models[i].name, models[j].name,
+                        'Mixture' if randomonly[k] else 'Chi-squared',
+                        float(chisq[k]), int(df[k]), float(pval[k]),
+                        models[j].name if pval[k] < alpha else models[i].name])
+        else:
+          cells.append([models[i].name, models[j].name, 'Not tested',
+                        float(chisq[k]), int(df[k]), '.', '.'])
+      table = spss.BasePivotTable('Compare All Models', 'djmixed_compareall')
+      table.SimplePivotTable(rowdim="", coldim="",
+        rowlabels = [ str(k+1) for k in range(len(pairs)) ],
+        collabels = ['Model A', 'Model B', 'Test', 'Chi-squared', 'Df', 'p-value', 'Best'],
+        cells = cells)
+      table.TitleFootnotes(footnote("""Model A is nested within Model B:
+      all its fixed and random terms are in Model B.  Models that only
+      differ in random effects are tested with a chi-square mixture (Stram
+      and Lee, 1994), see 'comparerandommodels'.  Models that differ in
+      both fixed and random effects are not tested, compare them through a
+      model in between.  The best model is chosen with alpha=%s.""" % alpha))
+    else:
+      spss.TextBlock("Note", "None of the models %s is nested within another." %
+                     ', '.join([ "'%s'" % n for n in names ]))
+
+    order = numpy.argsort([ m.aic for m in models ], kind='mergesort')
+    bestaic = models[order[0]].aic
+    cells = [ [models[i].name, models[i].fit, models[i].aic, models[i].npar,
+               models[i].aic - bestaic] for i in order ]
+    table = spss.BasePivotTable('Models Ranked by AIC', 'djmixed_compareall_aic')
+    table.SimplePivotTable(rowdim="", coldim="",
+      rowlabels = [ str(k+1) for k in range(len(models)) ],
+      collabels = ['Model Name', '-2LL', 'AIC', 'Number of Parameters', 'Delta AIC'],
+      cells = cells)
+    notes = list()
+    convwarn = [ m.name for m in models if getwarnings(m.name) ]
+    if convwarn:
+      notes.append(longstring("""SPSS issued warnings for model(s)
+      '%s', please check these before trusting this comparison.""") % "', '".join(convwarn))
+    if len(set([ m.reml for m in models ])) > 1:
+      notes.append(longstring("""Some models were fitted by REML and some
+      by ML, their AIC values are not comparable."""))
+    if notes:
+      table.TitleFootnotes('\n'.join(notes))
+  finally:
+    spss.EndProcedure()
+
+
+
+def bootstrapmodels(name1, name2, nsim=1000, processes=None, seed=None):
+  """Do a likelihood ratio test on two nested models with a parametric
+  bootstrap: simulate nsim data sets from the simpler model and refit
+  both models on each with the native backend (see
+  djparallel.parametricbootstrap).  This does not lean on the
+  asymptotic chi-square mixture of comparerandommodels, which is off
+  for small numbers of subjects or items.  Both models must have been
+  fitted by mixedmodel (or friends) on the same data; they are refitted
+  on the cases that are complete for both."""
+  import djparallel, djnative
+  if invalidhandlewarning([name1, name2]):
+    raise DjmixedFatal('Invalid model names')
+  if seed is None:
+    seed = random.randint(1, 999999)
+  spss.StartProcedure("DJMIXED.BootstrapModels")
+  try:
+    mc = ModelComparison(name1, name2)
+    mc.getallparams()
+    mc.make_numeric()
+    if mc.npar1 > mc.npar2:
+      mc.swapparams()
+    mc.samemodeltest()
+    specs = [ registry.spec(mc.name1), registry.spec(mc.name2) ]
+    for (name, spec) in zip((mc.name1, mc.name2), specs):
+      if spec is None:
+        raise DjmixedFatal(longstring("""Model '%s' was not fitted by mixedmodel,
+        so it cannot be fitted again for the bootstrap""") % name)
+    if specs[0]['data'] is not specs[1]['data'] or specs[0]['subset'] != specs[1]['subset']:
+      raise DjmixedFatal("Models '%s' and '%s' were not fitted on the same data" %
+                         (mc.name1, mc.name2))
+    nativespecs = [ dict([ (k, spec[k]) for k in ('dv', 'predictors', 'pps', 'items', 'modeltype',
+                                                  'randomslopes', 'slopecov', 'method')
+                                 if spec.get(k) ])
+                    for spec in specs ]
+    subset = specs[0]['subset'] or {}
+    variables = sorted(set(djparallel.specvariables(nativespecs)) | set(subset))
+    data = nativedata(specs[0]['data'], variables, [ spec['dv'] for spec in nativespecs ],
+                      listwise=True)
+    if subset:
+      data = djparallel.subsetcolumns(data, subset)
+    try:
+      result = djparallel.parametricbootstrap(data, nativespecs[0], nativespecs[1], nsim,
+                                              processes, seed)
+    except djnative.NativeError, v:
+      raise DjmixedFatal("The native backend could not fit the models: %s" % v)
+
+    alpha = 0.05
+    bestmodel = "Model 2" if result.pvalue < alpha else "Model 1"
+    table = spss.BasePivotTable("Likelihood Ratio Test - Parametric Bootstrap",
+        "djmixed_bootstrapmodels",
+        caption=footnote("""Comparison of two nested mixed models with
+           an LRT, where the p-value is the proportion of data sets simulated
+           from Model 1 with a chi-square at least as large as the observed
+           one (counting the observed data as one).  A significant result
+           indicates that the more complex Model 2 is a better fit than the
+           simpler Model 1."""))
+    table.SimplePivotTable(rowdim="", coldim="",
+        rowlabels=("Model 1 name", "Model 2 name",
+                   "-2LLR for Model 1", "-2LLR for Model 2",
+                   "Chi-square value", "Number of simulations", "Failed simulations",
+                   "Seed", "p-value", "Monte Carlo standard error",
+                   "Best model (alpha=0.05)"),
+        collabels = ["Value"],
+        cells = (mc.name1, mc.name2, mc.fit1, mc.fit2,
+                 result.observed, result.nsim, result.nfailed, seed,
+                 result.pvalue, result.mcerror, bestmodel))
+    notes = list()
+    if abs(result.observed - (mc.fit1 - mc.fit2)) > 0.01:
+      notes.append(longstring("""The native refit gives a chi-square of %.3f,
+      which differs from the one of the models as fitted (%.3f); the models may
+      not have been fitted on the same cases.""") % (result.observed, mc.fit1 - mc.fit2))
+    if result.nfailed:
+      notes.append(longstring("""%d simulations did not converge and were left
+      out.""") % result.nfailed)
+    if notes:
+      table.TitleFootnotes('\n'.join(notes))
+  finally:
+    spss.EndProcedure()
+
+
+
 def explode_interactions(predictors):
   """Scan the predictor (string) and write out an R-style interaction
   with all main effects syntax for each shorthand interaction, but use
@@ -598,26 +883,6 @@ def explode_interactions(predictors):
   pass
   # MAYBE, this would be a nice addition
 
-def fullfactorial(preds):
-  """return a list with all n-way interactions added, input and output
-  are space separated strings"""
-  def innerff(plist):
-    if len(plist)==1:
-      return plist
-    else:
-      assert(len(plist)>0)
-      restff = innerff(plist[1:])
-      me = plist[0]
-      res = [me]
-      for p in restff:
-        res.append(p)
-        res.append(me+"*"+p)
-      return res
-  predlist = preds.split()
-  return ' '.join(innerff(predlist))
-
-      
-
 def mixedmodel_spssparse(argstring):
   """helper for mixedmodel_spss, takes large string with all arguments
   (spss style) and returns a dictionary"""
@@ -669,55 +934,70 @@ def mixedmodel_spss(argstring):
   mixedmodel(**res)
 
 
-def reparsepredictors(predictors):
-  """Join all interactions into one word (a * b -> a*b) to produce a
-  standardized list of actual predictors; Produce a list of all main
-  effects that are mentioned or involved in interaction terms"""
-  star = '*'
-  predictors = predictors[:]
-  while star in predictors:
-    pos = predictors.index(star)
-    predictors[pos-1:pos+2] = [''.join(predictors[pos-1:pos+2])]
-
-  #mainpredictors = list(set(filter(lambda x: x!=star, predictors)))
-  mainpredictors = set()
-  for p in predictors:
-    if not star in p:
-      mainpredictors.add(p)
-    else:
-      for ppart in p.split(star):
-        mainpredictors.add(ppart)
-  
-  return (' '.join(predictors), 
-          ' '.join(mainpredictors))
+def designcelllabel(mainpredictors, dictionary, fingerprint):
+  """The variable label that tells which predictors (and formats), how
+  many cases and which data (the fingerprint of the predictors, see
+  predictorfingerprint) the designcell variable was made from"""
+  predictors = [ '%s(%s)' % (dictionary.get(p)['name'], dictionary.get(p)['format'])
+                 for p in mainpredictors ]
+  return "DJMIXED design cells of %s, %d cases, data %s" % (' '.join(predictors),
+                                                            dictionary.ncases, fingerprint)
+
 
+def predictorfingerprint(mainpredictors, dictionary):
+  """A short digest of the values of the predictors in the active
+  dataset, read in chunks (see djstore.datafingerprint); a RECODE or
+  COMPUTE of a predictor changes it.  None if the data cannot be read."""
+  numeric = [ p for p in mainpredictors if dictionary.get(p)['type']==0 ]
+  try:
+    return djstore.datafingerprint(activechunks(mainpredictors, numeric))[:16]
+  except spss.errMsg.SpssError:
+    return None
 
 
-def createdesignvariable(mainpredictors):
+def createdesignvariable(mainpredictors, dictionary=None):
   """Return spss syntax that sets up a `designcell' variable, which
-  has a different (consequetive) value for each cell of the design, as
+  has a different (consecutive) value for each cell of the design, as
   defined by crossing all main predictors.  Predictors can be numeric
-  or string."""
-
+  or string.  The cells are numbered 1, 2, ... by AUTORECODE, with the
+  levels of the predictors as value labels.
+
+  The variable label of designcell records the predictors it was made
+  from and a fingerprint of their data, so when it is still up to date
+  no syntax (and no transformation pass) is needed and the empty string
+  is returned.  Reading the predictors for the fingerprint is cheaper
+  than AUTORECODE; when they cannot be read, designcell is always made
+  again.  All lookups go to one snapshot of the dictionary, 'dictionary'
+  if given."""
+  if dictionary is None:
+    dictionary = DataDictionary()
   mainpredictors = mainpredictors.split() # it was a spss style space separated list
   res = list()
   for p in mainpredictors:
-    vardict = spssaux.VariableDict(pattern=p+"$") # necessary as the API is retardedly case sensitive
-    if vardict.numvars != 1:
-      raise DjmixedFatal("Looked for predictor '%s' but found %d matches. " %(p, vardict.numvars))
-    if vardict[0].VariableType==0: # numeric
-      format = vardict[0].VariableFormat
-      res.append("rtrim(ltrim(string(%s, %s)))" % (p, format))
+    var = dictionary.get(p)
+    if var is None:
+      raise DjmixedFatal("Looked for predictor '%s' but it is not in the active dataset" % p)
+    if var['type']==0: # numeric
+      res.append("rtrim(ltrim(string(%s, %s)))" % (var['name'], var['format']))
     else:
-      res.append("rtrim(ltrim(%s))" % p)
-  res = "compute designcell=concat(" + ','.join(res) + ").\nexecute."
-  vardict = spssaux.VariableDict(pattern="designcell$")
-  if vardict.numvars==0:
-    res = "string designcell (A64).\n" + res
-  elif vardict[0].VariableType != 64:
-    res = "delete variables designcell.\nstring designcell (A64).\n" + res
-  return res
-  
+      res.append("rtrim(ltrim(%s))" % var['name'])
+  fingerprint = predictorfingerprint(mainpredictors, dictionary)
+  label = designcelllabel(mainpredictors, dictionary, fingerprint or 'unknown')
+  existing = dictionary.get('designcell')
+  if fingerprint and existing and existing['type']==0 and existing['label']==label:
+    return ""
+  delete = [ v for v in ('designcell', 'designcell_') if v in dictionary ]
+  cmd = list()
+  if delete:
+    cmd.append("delete variables %s." % ' '.join(delete))
+  cmd.append("string designcell_ (A64).")
+  cmd.append("compute designcell_=concat(" + ",' ',".join(res) + ").")
+  cmd.append("autorecode variables=designcell_ /into designcell.")
+  cmd.append("delete variables designcell_.")
+  cmd.append("variable labels designcell '%s'." % label.replace("'", "''"))
+  return '\n'.join(cmd)
+
+
 def splitsublist(src, sep):
   """divide list items from src into sublist at items that equal sep"""
   res = list()
@@ -733,22 +1013,505 @@ def splitsublist(src, sep):
   return res
 
 
+def modelname(name):
+  """Return the name for a new model: the given name without
+  surrounding quotes, or the next free 'modelNN'"""
+  global modelnumber
+  if not name:
+    name = 'model%02d' % modelnumber
+    modelnumber += 1
+  # remove surrounding quotes if present:
+  elif name[0]==name[-1] and name[0] in "\"'":
+    name = name[1:-1]
+  return name
+
+
+def activeindices(varnames):
+  """the indices of the variables in varnames in the active dataset"""
+  allnames = [ v.lower() for v in getallvarnames() ]
+  indices = list()
+  for v in varnames:
+    if not v.lower() in allnames:
+      raise DjmixedFatal("Variable '%s' not found in the active dataset" % v)
+    indices.append(allnames.index(v.lower()))
+  return indices
+
+
+def activecolumns(varnames):
+  """Read the variables in varnames from the active dataset into a
+  dictionary from name to list of values, for the native backend.
+  System missing values are None."""
+  cursor = spss.Cursor(activeindices(varnames))
+  try:
+    cases = cursor.fetchall()
+  finally:
+    cursor.close()
+  columns = dict()
+  for (j, v) in enumerate(varnames):
+    columns[v] = [ x.rstrip() if isinstance(x, basestring) else x for x in
+                   [ case[j] for case in cases ] ]
+  return columns
+
+
+def activechunks(varnames, numeric=()):
+  """the variables in varnames of the active dataset in chunks of cases,
+  as djdata.sufficientstatistics takes them"""
+  import numpy, djdata
+  numeric = set([ v.lower() for v in numeric ])
+  cursor = spss.Cursor(activeindices(varnames))
+  try:
+    while True:
+      cases = cursor.fetchmany(djdata.CHUNKSIZE)
+      if not cases:
+        break
+      chunk = dict()
+      for (v, col) in zip(varnames, zip(*cases)):
+        if v.lower() in numeric:
+          chunk[v] = numpy.array(col, dtype=float)
+        else:
+          chunk[v] = numpy.array([ x.rstrip() if isinstance(x, basestring) else x for x in col ],
+                                 dtype=object)
+      yield chunk
+  finally:
+    cursor.close()
+
+
+def nativedata(data, varnames, numeric=(), listwise=False, stream=False):
+  """The data for the native backend: 'data' itself if it is a mapping
+  from variable name to values, the variables in varnames from the SPSS
+  system file (or CSV or Parquet file) named by 'data', or else from the
+  active dataset.  A file is read in chunks into a djdata.ColumnStore,
+  with the variables in numeric as floats and the rest coded; listwise
+  drops the incomplete rows while reading.  With stream, a file or the
+  active dataset is summed into djdata.Statistics instead, in one pass
+  of chunks (always listwise)."""
+  if stream and not isinstance(data, dict):
+    import djdata
+    if isinstance(data, basestring):
+      return djdata.readstatistics(data, varnames, numeric)
+    return djdata.sufficientstatistics(activechunks(varnames, numeric), varnames, numeric)
+  if isinstance(data, basestring):
+    import djdata
+    data = djdata.readcolumns(data, varnames, numeric, listwise)
+  if data is None:
+    data = activecolumns(varnames)
+  return data
+
+
+def modelspec(dv, predictors=None, pps=None, items=None, modeltype=None, data=None,
+              subset=None, randomslopes=None, slopecov=None, method=None, **ignored):
+  """what the registry keeps of the arguments of a model, see
+  bootstrapmodels; data and subset are those of the native backend"""
+  return dict(dv=dv, predictors=predictors, pps=pps, items=items, modeltype=modeltype,
+              data=data, subset=subset, randomslopes=randomslopes, slopecov=slopecov,
+              method=method)
+
+
+def startcomponents(name, subjects):
+  """The variance components of model 'name' to start a native fit
+  from: the variance of the random intercept of every subject variable
+  in subjects (None if that model did not have it) and the residual
+  variance last, see djnative.starttheta.  The intercept is the first
+  component of a random term with slopes."""
+  if not name in registry and not name in spss.GetHandleList():
+    raise DjmixedFatal("STARTFROM: there is no model named '%s'" % name)
+  output = modeloutput(name)
+  terms = dict()
+  for rterm in output.rowitems('Covariance Parameter Estimates'):
+    match = re_randomterm.match(rterm)
+    if match and match.group(1).split(' + ')[0] == 'Intercept':
+      terms[match.group(2).lower()] = rterm
+  res = list()
+  for s in list(subjects) + [None]:
+    if s is None:
+      lines = [ (None, ) + covparmline(output, 'Residual') ]
+    else:
+      lines = covparmlines(output, terms.get(s.lower(), s))
+    try:
+      (statistic, line, redundant) = lines[0]
+      res.append(0.0 if redundant else float(line['Estimate']))
+    except (IndexError, KeyError, ValueError):
+      res.append(None)
+  if res[-1] is None:
+    raise DjmixedFatal("STARTFROM: model '%s' has no residual variance to start from" % name)
+  return res
+
+
+def coldstart(name):
+  """the model that 'name' was warm started from, following STARTFROM
+  back to a model that was fitted from the default start"""
+  seen = set()
+  spec = registry.spec(name)
+  while spec and spec.get('startfrom') and not name in seen:
+    seen.add(name)
+    name = spec['startfrom']
+    spec = registry.spec(name)
+  return name, spec
+
+
+def warmstartnote(name, startfrom, iterations):
+  """Say how many iterations the warm start of model 'name' took, and
+  how many it saved compared to the last model fitted from scratch"""
+  note = """Model '%s' started from the covariance parameters of model '%s'
+  and converged in %d iterations.""" % (name, startfrom, iterations)
+  (cold, spec) = coldstart(startfrom)
+  if spec and spec.get('iterations') is not None:
+    note += """  Model '%s' needed %d iterations from the default start, so
+    the warm start saved about %d.""" % (cold, spec['iterations'],
+                                        max(0, spec['iterations'] - iterations))
+  return blockstring(note)
+
+
+def registernative(name, output, spec=None):
+  """store the output tree of a native fit under 'name'"""
+  if registry.current == name:
+    stopmodel(name, message=False)
+  registry.register(name, output)
+  if spec:
+    registry.setspec(name, spec)
+
+
+def nativemixedmodel(dv, predictors=None, pps=None, items=None, name=None,
+                     output='split', modeltype=None, data=None, startfrom=None, plot=None,
+                     plotdata=None, randomslopes=None, slopecov='UN', method='ML', stream=False,
+                     dfmethod='satterthwaite'):
+  """Fit the model with djnative instead of SPSS MIXED and store its
+  output under 'name', where the summary and comparison functions will
+  find it just like the output of an SPSS fit.  Data come from 'data',
+  which is either a mapping from variable name to values or the file
+  name of an SPSS system file (or a .csv or .parquet file), or else from
+  the active dataset.  With startfrom, the optimizer starts from the
+  covariance parameters of that model (say the previous model of a
+  nested sequence) instead of the default start.  With plot, the
+  residual diagnostics follow, see residualdiagnostics.  randomslopes,
+  slopecov, method, stream and dfmethod are as for mixedmodel."""
+  import djnative
+  name = modelname(name)
+  djprofile.setmodel(name)
+  # a wrong RANDOMSLOPES is an error before any data are read
+  slopelists(randomslopes)
+  if stream and (plot or plotdata):
+    raise DjmixedFatal("PLOT needs the data row by row, it cannot be combined with STREAM")
+  spec = modelspec(dv, predictors, pps, items, modeltype, data, randomslopes=randomslopes,
+                   slopecov=slopecov, method=method)
+  start = None
+  if startfrom:
+    start = startcomponents(startfrom, [ s for s in (pps, items) if s ])
+  data = nativedata(data, modelvariables(dv, predictors, pps, items, randomslopes), [dv],
+                    listwise=True, stream=stream)
+  try:
+    model = djprofile.call('native fit', djnative.fitmixedmodel, data, dv, predictors, pps,
+                           items, modeltype, methodname(method), start=start,
+                           randomslopes=randomslopes, slopecov=slopecov or 'UN',
+                           dfmethod=dfmethod)
+  except djnative.NativeError, v:
+    raise DjmixedFatal("The native backend could not fit model '%s': %s" % (name, v))
+  spec.update(iterations=model.iterations, startfrom=startfrom)
+  registernative(name, model.output, spec)
+
+  if output=='none' or startfrom:
+    spss.StartProcedure('DJMIXED.MixedModel')
+    try:
+      if output=='none':
+        print "Fitted model '%s' with the native backend" % name
+      if startfrom:
+        spss.TextBlock("Warm start", warmstartnote(name, startfrom, model.iterations))
+    finally:
+      spss.EndProcedure()
+  if output!='none':
+    djprofile.call('summary tables', summarytables, name, 'DJMIXED.ModelSummary.Auto')
+  if plot or plotdata:
+    djprofile.call('diagnostics', residualdiagnostics, name, predictors, plot or [], plotdata,
+                   model)
+  return model
+
+
+nativekeywords = ("dv predictors pps items name modeltype subset randomslopes slopecov "
+                  "method dfmethod").split()
+
+def nativemixedmodels(specs, output='split', processes=None, data=None):
+  """Fit a list of independent models with the native backend, in
+  parallel over 'processes' worker processes (default: one per cpu).
+  Each spec is a dictionary with the arguments of nativemixedmodel (dv,
+  predictors, pps, items, name, modeltype, randomslopes, slopecov,
+  method, dfmethod) and
+  optionally 'subset', a
+  dictionary from variable to value that restricts that model to the
+  matching rows.  The data are read once and shared by all workers.
+  Returns the list of model names."""
+  import djparallel
+  output = output.lower()
+  specs = [ dict(spec) for spec in specs ]
+  names = list()
+  for spec in specs:
+    wrong = [ k for k in spec if not k in nativekeywords ]
+    if wrong:
+      raise DjmixedFatal("Argument(s) not recognised in model specification: %s" % ', '.join(wrong))
+    spec['name'] = modelname(spec.get('name'))
+    if spec['name'] in names:
+      raise DjmixedFatal("Model name '%s' is used twice in one batch" % spec['name'])
+    names.append(spec['name'])
+  datasource = data
+  data = nativedata(data, djparallel.specvariables(specs), [ spec['dv'] for spec in specs ])
+  results = djprofile.call('native fit', djparallel.fitmodels, data, specs, processes)
+  specs = dict([ (spec['name'], spec) for spec in specs ])
+
+  spss.StartProcedure('DJMIXED.MixedModels')
+  try:
+    for name in names:
+      if name in results:
+        registernative(name, results.get(name), modelspec(data=datasource, **specs[name]))
+        if output=='split':
+          djprofile.setmodel(name)
+          djprofile.call('summary tables', modeltables, name)
+      else:
+        error = results.errors[name].strip().splitlines()[-1]
+        spss.TextBlock("Error", blockstring("""The native backend could not
+        fit model '%s': %s""" % (name, error)))
+    if output=='none':
+      print "Fitted models %s with the native backend" % ', '.join([ "'%s'" % n for n in results.names() ])
+  finally:
+    spss.EndProcedure()
+  return names
+
+
+def storekey(cmd, dv, predictors, pps, items, randomslopes=None):
+  """The key of a model in the result store: the MIXED command and the
+  data of the variables it uses, and what else goes into the fit.  A
+  read cursor skips the cases that FILTER, USE and SELECT IF leave out,
+  so the data are those MIXED sees; the number of cases in the file
+  tells a filter from a selection.  SPLIT FILE does not take cases away
+  but fits a model per split, so its variables and their data are part
+  of the key as well.  __version__ is not: the string is never
+  expanded, STOREVERSION is bumped instead.  None if the data cannot
+  be read, the model is then submitted as usual."""
+  try:
+    split = list(spss.GetSplitVariableNames())
+    weight = spss.GetWeightVar()
+    varnames = modelvariables(dv, predictors, pps, items, randomslopes)
+    varnames += [ v for v in split + [weight] if v and not v in varnames ]
+    numeric = [ v for (v, i) in zip(varnames, activeindices(varnames))
+                if spss.GetVariableType(i) == 0 ]
+    extra = (pluginversion, weight, ' '.join(split), spss.GetCaseCount())
+    fingerprint = djstore.datafingerprint(activechunks(varnames, numeric), extra)
+  except spss.errMsg.SpssError, v:
+    print "Could not read the data for the result store, submitting the model: %s" % v
+    return None
+  return djstore.ResultStore(RESULTSTORE).key(cmd, fingerprint)
+
+
+def storedmodel(name, output, outputtype, spec):
+  """register a model taken from the result store and show it"""
+  registernative(name, output, spec)
+  spss.StartProcedure('DJMIXED.MixedModel')
+  try:
+    print "Model '%s' was fitted before on the same data, results taken from the store" % name
+    print "The MIXED output of that fit is not shown again, use STORE=NO to fit it anew"
+  finally:
+    spss.EndProcedure()
+  if outputtype=='split':
+    djprofile.call('summary tables', summarytables, name, 'DJMIXED.ModelSummary.Auto')
+
+
 def mixedmodel(dv, predictors=None, pps=None, items=None, 
                stepwise=None, name=None, output='SPLIT', posthoc=None,
-               contrast=None, plot=None, modeltype=None):
+               contrast=None, plot=None, modeltype=None, backend='spss', data=None,
+               store=False, startfrom=None, plotdata=None, randomslopes=None, slopecov='UN',
+               method='ML', stream=False, adjust='sidak', dfmethod='satterthwaite'):
   """Construct spss mixed model syntax from arguments, pythonic syntax
 
   The list of predictors is (changed) either a string or a list of
   strings. This command does not do any error checking (ie. whether dv
   is an existing variable and valid syntactically).  The command also
   has a number of intentional limitations, write your own mixed syntax
-  directly for all cases not covered here."""
-  global modelnumber
+  directly for all cases not covered here.
+
+  With backend='native' the model is not submitted to SPSS but fitted
+  by djnative, see nativemixedmodel.
+
+  With store set (and RESULTSTORE), a model that was fitted before on
+  the same data with the same command is not submitted again, its
+  results are taken from the result store (see djstore).  Models with
+  plot and full output are always submitted, as only the summary is
+  stored.  The store is off by default: the key takes a pass over the
+  data of the model, and a stored result has no MIXED output.
+
+  posthoc (a list of factors) asks for their estimated marginal means
+  and all pairwise comparisons, with the p values adjusted by 'adjust'
+  (sidak or holm); contrast is a factor and lists of coefficients for
+  its levels, separated by '|' ('priming | 1 -1 0 | 1 1 -2').  Both are
+  computed after the fit from the fixed effects and their covariance
+  matrix, see posthoctables, which can also be called on a model later.
+
+  With startfrom, the name of an earlier model, the native backend
+  starts its optimizer from the covariance parameters of that model,
+  which saves iterations in a sequence of nested models.  MIXED has no
+  way to take initial values for the covariance parameters, so the
+  SPSS backend fits from scratch and says so.
+
+  PLOT asks for residual diagnostics (see residualdiagnostics): a
+  summary of the residuals for RESIDUALS, tests of equal variance over
+  the design cells for EQUALVARIANCE, and with CHARTS also the SPSS
+  charts of these.  plotdata names a CSV file for the residuals.
+
+  randomslopes adds random slopes to the random intercepts: a list of
+  main predictors for both PPS and ITEMS, or two lists separated by
+  '|', the slopes by participant and those by item (so 'priming morph
+  | priming').  slopecov is the covariance structure of a random term
+  with slopes, UN (the default) or DIAG.
+
+  method is ML (the default) or REML.  REML gives less biased variance
+  components, but its likelihoods only compare models with the same
+  fixed effects.
+
+  With stream, the native backend does not hold the data but sums them
+  per combination of predictor levels, PPS and ITEMS in one pass over
+  the file (or the active dataset), which is all the fit needs; memory
+  then goes with the number of such groups rather than rows, see
+  djdata.readstatistics.  PLOT needs the rows and is not available.
+
+  dfmethod is the approximation of the denominator df of the native
+  backend: SATTERTHWAITE (the default, as MIXED) or KENWARDROGER, which
+  also corrects the covariance matrix of the fixed effects for the
+  uncertainty in the variance components, and takes longer, see
+  djdf.  MIXED has no Kenward-Roger."""
 
   #if stepwise:
   #  mixedmodelstepwise(dv, predictors, pps, items, stepwise, name, output)
 
   output = output.lower()
+  # the name is resolved once, a second modelname would number a new model
+  name = modelname(name)
+  if startfrom:
+    startfrom = modelname(startfrom)
+  if backend and backend.lower()=='native':
+    model = nativemixedmodel(dv, predictors, pps, items, name, output, modeltype, data,
+                             startfrom, plot, plotdata, randomslopes, slopecov, method, stream,
+                             dfmethod)
+    if posthoc or contrast:
+      djprofile.call('posthoc', posthoctables, name, posthoc, contrast, adjust)
+    return model
+  if plotdata and not plot:
+    plot = ['residuals']
+  if startfrom:
+    print "STARTFROM is only used by the native backend, MIXED fits the model from scratch"
+  if stream:
+    print "STREAM is only used by the native backend"
+  if dfmethod and dfmethod.lower() != 'satterthwaite':
+    raise DjmixedFatal("DFMETHOD=%s needs BACKEND=NATIVE, MIXED only has Satterthwaite df" %
+                       dfmethod.upper())
+  cmd = mixedsyntax(dv, predictors, pps, items, plot, modeltype, randomslopes, slopecov, method)
+  spec = modelspec(dv, predictors, pps, items, modeltype, randomslopes=randomslopes,
+                   slopecov=slopecov, method=method)
+
+  djprofile.setmodel(name)
+
+  key = None
+  if store and RESULTSTORE and output!='full' and not plot:
+    key = storekey(cmd, dv, predictors, pps, items, randomslopes)
+    stored = key and djstore.ResultStore(RESULTSTORE).get(key)
+    if stored is not None:
+      storedmodel(name, stored, output, spec)
+      if posthoc or contrast:
+        djprofile.call('posthoc', posthoctables, name, posthoc, contrast, adjust)
+      return
+
+  if output=='split':
+    djprofile.call('output juggling', activatedetails)
+
+  if output=='full' or output=='split':
+    print "== Submitting DJMIXED MIXEDMODEL '%s' == " % name
+    print cmd
+
+  djprofile.call('oms capture', startmodel, name, message=False, output=output)
+  registry.setspec(name, spec)
+  try:
+    # produce output, but startmodel may OMS it away
+    djprofile.call('mixed fit', mysubmit, cmd, silent=False)
+    errlevel = spss.GetLastErrorLevel()
+    # need to account for exceptions here, as wrong syntax will throw        
+  except spss.errMsg.SpssError, v:
+    # MAYBE need to have a way to signal that model error here
+    # if we submit pre/main/post cmd separately, we can at least see where the error
+    # occurred.  or we resplit cmd on periods and submit in parts.   
+    stopmodel(name, message=True, modelerror=True)
+    spss.Submit("omsend.")
+    # cannot reraise for some reason
+    print "ERROR:\nSPSS signalled the following error while processing this command:\n%s" % \
+          v
+    plot = posthoc = contrast = None
+  else:
+    djprofile.call('oms capture', stopmodel, name, message=False, modelerror=False)
+    tree = modeloutput(name)
+    if key and tree.commandcount('Mixed')==1:
+      try:
+        djstore.ResultStore(RESULTSTORE).put(key, tree.summary(djregistry.SUMMARYTYPES))
+      except (IOError, OSError), v:
+        print "Could not save model '%s' in the result store: %s" % (name, v)
+  if output=='split':
+    error = djprofile.call('output juggling', silentsubmit, "OUTPUT ACTIVATE djmain .")
+    # print "Back to djmain" 
+  
+  
+  if output=='none':
+    spss.StartProcedure('DJMIXED.MixedModel')
+    try:
+      print "Submitted model '%s'" % name
+      print cmd
+    finally:
+      spss.EndProcedure()
+
+  if output=='split':
+    print "Automatically calling 'modelsummary' because split output was requested"
+    djprofile.call('summary tables', summarytables, name, 'DJMIXED.ModelSummary.Auto')
+
+  if posthoc or contrast:
+    djprofile.call('posthoc', posthoctables, name, posthoc, contrast, adjust)
+
+  if plot:
+    djprofile.call('diagnostics', residualdiagnostics, name, predictors, plot, plotdata)
+
+
+def activatedetails():
+  """send the output that follows to the 'djdetails' output window, for split output"""
+  error = silentsubmit(cmdsyntax("""
+  OUTPUT NAME NAME=djmain .
+  OUTPUT ACTIVATE djdetails ."""))
+  if error:
+    error = silentsubmit("OUTPUT NEW NAME=djdetails .\nOUTPUT ACTIVATE djdetails .")
+    if error:
+      print "Could not create new output, split may not work well"      
+
+
+def slopelists(randomslopes):
+  """the random slopes by participant and by item, see mixedmodel"""
+  try:
+    return splitslopes(randomslopes)
+  except ValueError, v:
+    raise DjmixedFatal(str(v))
+
+
+def randomsyntax(subject, slopes, slopecov):
+  """the /RANDOM subcommand for the random effects of one subject variable"""
+  if not slopes:
+    return " /RANDOM=INTERCEPT | SUBJECT(%s) COVTYPE(VC)" % subject
+  return " /RANDOM=INTERCEPT %s | SUBJECT(%s) COVTYPE(%s)" % (' '.join(slopes), subject,
+                                                            (slopecov or 'UN').upper())
+
+
+def methodname(method):
+  """the estimation method, ML or REML, see mixedmodel"""
+  method = (method or 'ML').upper()
+  if not method in ('ML', 'REML'):
+    raise DjmixedFatal("METHOD must be ML or REML, not '%s'" % method)
+  return method
+
+
+def mixedsyntax(dv, predictors=None, pps=None, items=None, plot=None, modeltype=None,
+                randomslopes=None, slopecov=None, method=None):
+  """Return the MIXED syntax (plus the commands for the plots) that
+  mixedmodel submits for these arguments.  POSTHOC and CONTRAST are no
+  part of it, see posthoctables."""
   if plot:
     plot = [ x.lower() for x in plot ]
   cmd = list(); precmd = list()
@@ -765,182 +1528,487 @@ def mixedmodel(dv, predictors=None, pps=None, items=None,
     """no predictors mentioned"""
     predictors = mainpredictors = ""
   cmd.append(" /FIXED= %s | SSTYPE(3)" % predictors)
+  (ppsslopes, itemslopes) = slopelists(randomslopes)
+  # MIXED only takes random effects of variables in the BY list
+  wrong = [ s for s in ppsslopes + itemslopes if not s in mainpredictors.split() ]
+  if wrong:
+    raise DjmixedFatal("RANDOMSLOPES: '%s' is not among the predictors" % wrong[0])
   if pps:
-    cmd.append(" /RANDOM=INTERCEPT | SUBJECT(%s) COVTYPE(VC)" % pps)
+    cmd.append(randomsyntax(pps, ppsslopes, slopecov))
   if items:
-    cmd.append(" /RANDOM=INTERCEPT | SUBJECT(%s) COVTYPE(VC)" % items)
-  if posthoc:
-    if isinstance(posthoc, str):  
-      posthoc = [posthoc]
-    for v in posthoc:
-      cmd.append(""" /EMMEANS = tables(%s) compare adj(sidak)""" % v)
-  if contrast:
-    contrast = splitsublist(contrast, '|')
-    varname = contrast.pop(0)[0]
-    msg = [ ' ' + varname + ' ' + ' '.join(coefs) for coefs in contrast ]
-    msg = " /TEST 'contrasts on %s' " % varname  + ';'.join(msg)
-    cmd.append(msg)
+    cmd.append(randomsyntax(items, itemslopes, slopecov))
   if plot:
-    # only residuals and equalvariance are options for now
-    varnames = getallvarnames(strmethod='lower')
+    # MIXED saves the residuals in the same pass as the fit, the rest of
+    # PLOT is done by residualdiagnostics afterwards
+    varnames = DataDictionary().names(strmethod='lower')
     delvars = [ x for x in ('predicted','residual') if x in varnames ]
     if delvars:
       precmd.append( "DELETE VARIABLES %s ." % ' '.join(delvars) )
     cmd.append("  /SAVE PRED(predicted) RESID(residual)")
     
-  cmd.append(""" /METHOD=ML
+  cmd.append(""" /METHOD=%s
 /PRINT=SOLUTION  TESTCOV  COVB
 /CRITERIA=CIN(95) MXITER(10000) MXSTEP(50) SCORING(1) SINGULAR(0.000000000001)
-HCONVERGE(0, ABSOLUTE) LCONVERGE(0, ABSOLUTE) PCONVERGE(0.000001, ABSOLUTE) . """)
-
-  if plot:
-    if 'zresidual' in varnames:
-      precmd.append("DELETE VARIABLES Zresidual .")
-    cmd.append(cmdsyntax(""" 
-      DESCRIPTIVES VARIABLES=residual  (Zresidual)  /SAVE ."""))
-    if 'residuals' in plot:
-      cmd.append(cmdsyntax(""" 
-        EXAMINE VARIABLES=residual /PLOT =    histogram npplot .
-        GRAPH  /SCATTERPLOT(bivar)=predicted WITH Zresidual .    """))
-    if 'equalvariance' in plot:
-      precmd.append(createdesignvariable(mainpredictors))
-      cmd.append(cmdsyntax(""" 
-        GGRAPH 
-          /GRAPHDATASET NAME="graphdataset" VARIABLES=Zresidual designcell
-            MISSING=LISTWISE REPORTMISSING=NO 
-          /GRAPHSPEC SOURCE=INLINE. 
-        BEGIN GPL 
-          SOURCE: s=userSource(id("graphdataset")) 
-          DATA: Zresidual=col(source(s), name("Zresidual")) 
-          DATA: designcell=col(source(s), name("designcell"), unit.category()) 
-          GUIDE: axis(dim(1), label("Zscore of Residuals")) 
-          GUIDE: axis(dim(2), label("Frequency")) 
-          GUIDE: legend(aesthetic(aesthetic.color.interior), label("designcell")) 
-          ELEMENT: line(position(summary.count(bin.rect(Zresidual))),
-            color.interior(designcell), missing.wings()) 
-        END GPL.
-        """)) # line -> area.stack for a pretty plot which is not as useful
-
+HCONVERGE(0, ABSOLUTE) LCONVERGE(0, ABSOLUTE) PCONVERGE(0.000001, ABSOLUTE) . """ %
+             methodname(method))
 
   cmd = precmd + cmd
-  cmd = "\n".join(cmd)
+  return "\n".join(cmd)
+
+
+def mainpredictorlist(predictors):
+  """the main predictors involved in predictors (as in mixedmodel), in
+  the order of the BY list of mixedsyntax"""
+  if not predictors or predictors=='None':
+    return []
+  if isinstance(predictors, basestring):
+    predictors = predictors.split()
+  return reparsepredictors(predictors)[1].split()
+
+
+def numbercell(value):
+  if value is None or value != value:
+    return '.'
+  return spss.CellText.Number(float(value), spss.FormatSpec.Coefficient)
+
+
+def sigtext(p):
+  return ('%.3f' % p).lstrip('0')
+
+
+def residualdiagnostics(name, predictors, plot, plotdata=None, model=None):
+  """Show the residual diagnostics of model 'name' for PLOT: a summary
+  of the residuals (RESIDUALS), their variance per design cell and the
+  Levene and Brown-Forsythe tests (EQUALVARIANCE), see djdiagnostics.
+  The residuals come from 'model' for the native backend, else from
+  the residual and predicted variables MIXED saved, read in one pass
+  together with the main predictors.  The SPSS charts are only made
+  for CHARTS, and the plot data only written to a CSV file if plotdata
+  names one."""
+  import djdiagnostics
+  import numpy
+  plot = [ x.lower() for x in plot ]
+  mainpredictors = mainpredictorlist(predictors)
+  if model is not None:
+    residuals, predicted = model.residuals(), model.fitted()
+    cells, labels = model.data.cell, model.celllabels()
+    cellfactors = [ f.name for f in model.data.factors ]
+  else:
+    columns = activecolumns(['residual', 'predicted'] + mainpredictors)
+    raw = [ columns[v] for v in ['residual', 'predicted'] + mainpredictors ]
+    keep = numpy.array([ None not in case for case in zip(*raw) ], dtype=bool)
+    residuals = numpy.array(columns['residual'], dtype=float)[keep]
+    predicted = numpy.array(columns['predicted'], dtype=float)[keep]
+    cells, labels = djdiagnostics.designcells([ numpy.asarray(columns[p], dtype=object)[keep]
+                                                for p in mainpredictors ])
+    cellfactors = mainpredictors
+  try:
+    diagnostics = djdiagnostics.Diagnostics(residuals, cells, labels)
+  except ValueError, v:
+    raise DjmixedFatal("No residual diagnostics for model '%s': %s" % (name, v))
 
-  if not name:
-    name = 'model%02d' % modelnumber
-    modelnumber += 1
-  # remove surrounding quotes if present:
-  elif name[0]==name[-1] and name[0] in "\"'":
-    name = name[1:-1]
+  spss.StartProcedure('DJMIXED.Diagnostics')
+  try:
+    if 'residuals' in plot:
+      pivot = spss.BasePivotTable('Residuals', 'djmixed_residuals')
+      pivot.SimplePivotTable(
+          rowdim="",
+          coldim="Model name: " + name,
+          rowlabels=('N', 'Mean', 'Std. Deviation', 'Minimum', 'Maximum', 'Skewness',
+                     'Kurtosis', 'Standardized beyond %g' % djdiagnostics.OUTLYING),
+          collabels=('Value',),
+          cells=[ diagnostics.n, numbercell(diagnostics.mean), numbercell(diagnostics.sd),
+                  numbercell(diagnostics.minimum), numbercell(diagnostics.maximum),
+                  numbercell(diagnostics.skewness), numbercell(diagnostics.kurtosis),
+                  diagnostics.outlying ])
+    if 'equalvariance' in plot:
+      pivot = spss.BasePivotTable('Residual Variance by Design Cell', 'djmixed_cellvariance')
+      pivot.SimplePivotTable(
+          rowdim=' '.join(cellfactors),
+          coldim="Model name: " + name,
+          rowlabels=diagnostics.labels,
+          collabels=('N', 'Mean', 'Std. Deviation', 'Variance'),
+          cells=[ (int(count), numbercell(mean), numbercell(numpy.sqrt(var)), numbercell(var))
+                  for (count, mean, var) in zip(diagnostics.cellcounts, diagnostics.cellmeans,
+                                                 diagnostics.cellvariances) ])
+      tests = [ ('Levene (mean)', diagnostics.levene),
+                ('Brown-Forsythe (median)', diagnostics.brownforsythe) ]
+      pivot = spss.BasePivotTable('Tests of Equal Residual Variance', 'djmixed_equalvariance')
+      pivot.SimplePivotTable(
+          rowdim="",
+          coldim="Model name: " + name,
+          rowlabels=[ label for (label, test) in tests ],
+          collabels=('F', 'df1', 'df2', 'Sig.'),
+          cells=[ (numbercell(test[0]), test[1], test[2], sigtext(test[3])) if test else
+                  ('.', '.', '.', '.') for (label, test) in tests ])
+      pivot.TitleFootnotes("The ANOVA of the absolute deviations of the residuals "
+                           "from the mean or the median of their design cell.")
+    if plotdata:
+      diagnostics.plotdata(plotdata, residuals, predicted, cells)
+      spss.TextBlock("Plot data", "The residuals of model '%s' were written to %s" %
+                     (name, plotdata))
+  finally:
+    spss.EndProcedure()
+  if 'charts' in plot:
+    if model is not None:
+      raise DjmixedFatal("PLOT=CHARTS is not available with the native backend, use PLOTDATA")
+    mysubmit(chartsyntax(mainpredictors, plot, diagnostics), silent=False)
+  return diagnostics
+
+
+def chartsyntax(mainpredictors, plot, diagnostics):
+  """The syntax of the SPSS charts for PLOT=CHARTS, on the residual and
+  predicted variables MIXED saved.  Zresidual is computed from the mean
+  and standard deviation in diagnostics, not by a DESCRIPTIVES pass."""
+  dictionary = DataDictionary()
+  cmd = list()
+  if 'zresidual' in dictionary:
+    cmd.append("DELETE VARIABLES Zresidual .")
+  cmd.append("COMPUTE Zresidual = (residual - (%r)) / %r ." % (float(diagnostics.mean),
+                                                             float(diagnostics.sd)))
+  if 'residuals' in plot:
+    cmd.append(cmdsyntax(""" 
+      EXAMINE VARIABLES=residual /PLOT =    histogram npplot .
+      GRAPH  /SCATTERPLOT(bivar)=predicted WITH Zresidual .    """))
+  if 'equalvariance' in plot:
+    designcell = createdesignvariable(' '.join(mainpredictors), dictionary)
+    if designcell:
+      cmd.append(designcell)
+    cmd.append(cmdsyntax(""" 
+      GGRAPH 
+        /GRAPHDATASET NAME="graphdataset" VARIABLES=Zresidual designcell
+          MISSING=LISTWISE REPORTMISSING=NO 
+        /GRAPHSPEC SOURCE=INLINE. 
+      BEGIN GPL 
+        SOURCE: s=userSource(id("graphdataset")) 
+        DATA: Zresidual=col(source(s), name("Zresidual")) 
+        DATA: designcell=col(source(s), name("designcell"), unit.category()) 
+        GUIDE: axis(dim(1), label("Zscore of Residuals")) 
+        GUIDE: axis(dim(2), label("Frequency")) 
+        GUIDE: legend(aesthetic(aesthetic.color.interior), label("designcell")) 
+        ELEMENT: line(position(summary.count(bin.rect(Zresidual))),
+          color.interior(designcell), missing.wings()) 
+      END GPL.
+      """)) # line -> area.stack for a pretty plot which is not as useful
+  return "\n".join(cmd)
+
+
+def omsblock(name, cmd, viewer='yes'):
+  """wrap cmd in an OMS block that captures its output under handle 'name'"""
+  return cmdsyntax("""
+  OMS
+      /DESTINATION  format=oxml xmlworkspace='%s' viewer=%s
+      /TAG='%s' .
+  %s
+  OMSEND tag='%s' .""" % (name, viewer, name, cmd, name))
+
+
+batchkeywords = ("dv predictors pps items name posthoc contrast adjust plot modeltype "
+                 "randomslopes slopecov method").split()
+
+def mixedmodels(specs, output='split'):
+  """Fit a list of models in a single round trip to SPSS.  Each spec is
+  a dictionary with the arguments of mixedmodel (dv, predictors, pps,
+  items, name, posthoc, contrast, adjust, modeltype, randomslopes,
+  slopecov, method).  PLOT is not available: the saved residuals of
+  one model would overwrite those of the next.  The MIXED commands
+  are submitted as one block, each in its own OMS block, so that
+  afterwards every model has its own handle, exactly as if it had been
+  fitted by mixedmodel.  The posthoc tables follow for every output
+  mode, as they do for mixedmodel.  Returns the list of model names."""
+  output = output.lower()
+  if registry.current is not None:
+    print "Mixedmodels triggered Stopmodel for '%s'" % registry.current
+    stopmodel(registry.current)
+  viewer = 'no' if output=='none' else 'yes'
+  names = list()
+  block = list()
+  modelspecs = dict()
+  posthocs = dict()
+  for spec in specs:
+    spec = dict(spec)
+    wrong = [ k for k in spec if not k in batchkeywords ]
+    if wrong:
+      raise DjmixedFatal("Argument(s) not recognised in model specification: %s" % ', '.join(wrong))
+    if spec.get('plot'):
+      raise DjmixedFatal("PLOT is not available in a batch of models, fit the model with "
+                         "MIXEDMODEL for its residual diagnostics")
+    name = modelname(spec.pop('name', None))
+    if name in names:
+      raise DjmixedFatal("Model name '%s' is used twice in one batch" % name)
+    names.append(name)
+    modelspecs[name] = modelspec(**spec)
+    posthocs[name] = (spec.pop('posthoc', None), spec.pop('contrast', None),
+                      spec.pop('adjust', None) or 'sidak')
+    block.append(omsblock(name, mixedsyntax(**spec), viewer))
+  block = '\n'.join(block)
+
+  for name in names:
+    registry.remove(name)
 
   if output=='split':
-    error = silentsubmit(cmdsyntax("""
-    OUTPUT NAME NAME=djmain .
-    OUTPUT ACTIVATE djdetails ."""))
-    if error:
-      error = silentsubmit("OUTPUT NEW NAME=djdetails .\nOUTPUT ACTIVATE djdetails .")
-      if error:
-        print "Could not create new output, split may not work well"      
-
+    djprofile.call('output juggling', activatedetails)
   if output=='full' or output=='split':
-    print "== Submitting DJMIXED MIXEDMODEL '%s' == " % name
-    print cmd
-
-  startmodel(name, message=False, output=output)
+    print "== Submitting DJMIXED MIXEDBATCH of %d models == " % len(names)
+    print block
+  error = None
   try:
-    mysubmit(cmd, silent=False)  # produce output, but startmodel may OMS it away
-    errlevel = spss.GetLastErrorLevel()
-    # need to account for exceptions here, as wrong syntax will throw        
+    djprofile.call('mixed fit', mysubmit, block, silent=False)
   except spss.errMsg.SpssError, v:
-    # MAYBE need to have a way to signal that model error here
-    # if we submit pre/main/post cmd separately, we can at least see where the error
-    # occurred.  or we resplit cmd on periods and submit in parts.   
-    stopmodel(name, message=True, modelerror=True)
+    error = v
     spss.Submit("omsend.")
-    # cannot reraise for some reason
-    print "ERROR:\nSPSS signalled the following error while processing this command:\n%s" % \
-          v
-  else:
-    stopmodel(name, message=False, modelerror=False)
   if output=='split':
-    error = silentsubmit("OUTPUT ACTIVATE djmain .")
-    # print "Back to djmain" 
-  
-  
-  if output=='none':
-    spss.StartProcedure('DJMIXED.MixedModel')
-    try:
-      print "Submitted model '%s'" % name
-      print cmd
-    finally:
-      spss.EndProcedure()
+    djprofile.call('output juggling', silentsubmit, "OUTPUT ACTIVATE djmain .")
 
-  if output=='split':
-    print "Automatically calling 'modelsummary' because split output was requested"
-    spss.StartProcedure('DJMIXED.ModelSummary.Auto')
-    try:
-      copywarnings(name)
-      fixedeffects_table(name)
-      randomeffects_table(name)
-    finally:
-      spss.EndProcedure()
+  handles = spss.GetHandleList()
+  spss.StartProcedure('DJMIXED.MixedModels')
+  try:
+    if error:
+      spss.TextBlock("Error", blockstring("""An ERROR was issued while processing
+      the batch of models (%s).  You should carefully inspect the output to
+      determine which models are valid.""" % error))
+    for name in names:
+      djprofile.setmodel(name)
+      if name in handles:
+        registry.addhandle(name)
+        registry.setspec(name, modelspecs[name])
+        analyses = djprofile.call('stopmodel check', modeloutput, name).commandcount('Mixed')
+      else:
+        analyses = 0
+      if analyses != 1:
+        spss.TextBlock("Error", blockstring("""Model '%s': %d MIXED outputs
+        found where 1 was expected.  Please review your syntax.""" % (name, analyses)))
+      else:
+        if output=='split':
+          djprofile.call('summary tables', modeltables, name)
+        if posthocs[name][:2] != (None, None):
+          djprofile.call('posthoc', contrasttables, name, *posthocs[name])
+    djprofile.setmodel(None)
+    if output=='none':
+      print "Submitted models %s" % ', '.join([ "'%s'" % n for n in names ])
+  finally:
+    spss.EndProcedure()
+  return names
+
+
+def batchspecs(dv, predictors=None, pps=None, items=None, names=None, modeltype=None,
+               randomslopes=None, slopecov=None, method=None):
+  """Turn the arguments of DJMIXED /MIXEDBATCH into the specs for
+  mixedmodels.  All models share dv, pps, items, their random
+  slopes and the method; the predictor sets
+  of the models are separated by '|' (use None for a model without
+  fixed predictors) and names, if given, has one name per model."""
+  if predictors:
+    predictors = splitsublist(predictors, '|')
+  else:
+    predictors = [None]
+  if names and len(names) != len(predictors):
+    raise DjmixedFatal("MIXEDBATCH: %d names given for %d models" % (len(names), len(predictors)))
+  specs = list()
+  for (i, p) in enumerate(predictors):
+    if p in ([], ['None']):
+      p = None
+    spec = dict(dv=dv, predictors=p, pps=pps, items=items, modeltype=modeltype)
+    if randomslopes:
+      spec.update(randomslopes=randomslopes, slopecov=slopecov or 'UN')
+    if method:
+      spec['method'] = method
+    if names:
+      spec['name'] = names[i]
+    specs.append(spec)
+  return specs
 
 
 
 
 re_spurious = re.compile('The covariance structure for random effect with only one level will be changed to Identity.')
 
+def modeltables(name):
+  """the warnings and the fixed and random effects tables of a model"""
+  copywarnings(name)
+  fixedeffects_table(name)
+  randomeffects_table(name)
+
+
+def summarytables(name, procedure):
+  """modeltables in a procedure of their own"""
+  spss.StartProcedure(procedure)
+  try:
+    modeltables(name)
+  finally:
+    spss.EndProcedure()
+
+
 def copywarnings(model):
-  xpa = xpastring("""//pivotTable[@subType='Warnings']
-     //cell/@text""")
-  match = spss.EvaluateXPath(model, '/outputTree', xpa)
-  for warn in match:
+  for warn in getwarnings(model):
     if not re_spurious.search(warn):
       spss.TextBlock("Warning", "SPSS issued the following warning: \n" + warn)
-               
 
 
-def relatedbetas(nonredundants, fterm):
-  """return a list of nonredundant effects that are related to this fixed term"""
-  star = '*'
-  res = list()
-  fparts = [ p.strip() for p in fterm.split() if p != star ]
-  fparts = set(fparts)
-  
+def parsecontrast(contrast):
+  """the factor and the lists of coefficients of CONTRAST, see mixedmodel"""
+  contrast = splitsublist(contrast, '|')
+  if len(contrast) < 2 or len(contrast[0]) != 1:
+    raise DjmixedFatal("CONTRAST takes a factor and lists of coefficients, separated by '|'")
+  try:
+    return contrast[0][0], [ [ float(x) for x in coefs ] for coefs in contrast[1:] ]
+  except ValueError, v:
+    raise DjmixedFatal("CONTRAST: coefficients must be numbers (%s)" % v)
+
+
+def tablenumber(x):
+  """a number for a pivot table, '.' when it cannot be computed"""
+  import numpy
+  return float(x) if numpy.isfinite(x) else '.'
+
+
+def contrasttables(name, posthoc=None, contrast=None, adjust='sidak'):
+  """The tables of posthoctables, within the current procedure"""
+  import djcontrast, djdf
+  adjust = (adjust or 'sidak').lower()
+  if isinstance(posthoc, basestring):
+    posthoc = posthoc.split()
+  try:
+    fe = djcontrast.FixedEffects(modeloutput(name))
+    if fe.dfs is None:
+      dfnote = "The df are those of the test of the factor."
+    elif fe.dfs.method == 'satterthwaite':
+      dfnote = "The df are Satterthwaite's, for every row."
+    else:
+      dfnote = """The df are Satterthwaite's, for every row, and the standard
+      errors Kenward-Roger's."""
+    if posthoc:
+      cells, rowlabels = list(), list()
+      for v in posthoc:
+        (levels, means, se, df, lower, upper) = djcontrast.marginalmeans(fe, v)
+        for k in range(len(levels)):
+          rowlabels.append('%s=%s' % (fe.factor(v), levels[k]))
+          cells.append([ tablenumber(x) for x in (means[k], se[k], df[k], lower[k], upper[k]) ])
+      table = spss.BasePivotTable('Estimated Marginal Means', 'djmixed_posthoc_means')
+      table.SimplePivotTable(rowdim="", coldim="Model name: " + name, rowlabels=rowlabels,
+        collabels=['Mean', 'Std. Error', 'df', 'Lower Bound', 'Upper Bound'], cells=cells)
+      table.TitleFootnotes(footnote("""Means of the cells of all factors, averaged
+      with equal weights over the other factors, with 95%% confidence intervals.
+      %s""" % dfnote))
+
+      cells, rowlabels = list(), list()
+      for v in posthoc:
+        (pairs, diff, se, df, t, p, padj) = djcontrast.pairwise(fe, v, adjust)
+        for k in range(len(pairs)):
+          rowlabels.append('%s: %s - %s' % ((fe.factor(v),) + pairs[k]))
+          cells.append([ tablenumber(x) for x in (diff[k], se[k], df[k], t[k], p[k], padj[k]) ])
+      table = spss.BasePivotTable('Pairwise Comparisons', 'djmixed_posthoc_pairwise')
+      table.SimplePivotTable(rowdim="", coldim="Model name: " + name, rowlabels=rowlabels,
+        collabels=['Difference', 'Std. Error', 'df', 't', 'Sig.',
+                   'Sig. (%s)' % adjust.capitalize()], cells=cells)
+      table.TitleFootnotes(footnote("""Differences of the estimated marginal
+      means, adjusted (%s) for the number of comparisons of each factor.""" %
+                                    adjust.capitalize()))
+
+    if contrast:
+      (v, coefficients) = parsecontrast(contrast)
+      (estimates, se, df, t, p, padj) = djcontrast.contrasts(fe, v, coefficients, adjust)
+      rowlabels = [ '%s: %s' % (fe.factor(v), ' '.join([ '%g' % c for c in coefs ]))
+                    for coefs in coefficients ]
+      cells = [ [ tablenumber(x) for x in (estimates[k], se[k], df[k], t[k], p[k], padj[k]) ]
+                for k in range(len(coefficients)) ]
+      table = spss.BasePivotTable('Contrasts', 'djmixed_posthoc_contrasts')
+      table.SimplePivotTable(rowdim="", coldim="Model name: " + name, rowlabels=rowlabels,
+        collabels=['Estimate', 'Std. Error', 'df', 't', 'Sig.',
+                   'Sig. (%s)' % adjust.capitalize()], cells=cells)
+      table.TitleFootnotes(footnote("""Contrasts on the estimated marginal means
+      of %s, the coefficients in the order of its levels (%s), adjusted (%s)
+      for the number of contrasts.""" % (fe.factor(v), ', '.join(fe.factorlevels[fe.factor(v)]),
+                                         adjust.capitalize())))
+
+    tests = djcontrast.typeIIItests(fe)
+    table = spss.BasePivotTable('Type III Tests', 'djmixed_posthoc_typeIII')
+    table.SimplePivotTable(rowdim="", coldim="Model name: " + name,
+      rowlabels=[ test[0] for test in tests ],
+      collabels=['Numerator df', 'Denominator df', 'F', 'Sig.'],
+      cells=[ [ int(ndf), tablenumber(ddf), tablenumber(F), tablenumber(p) ]
+              for (term, ndf, ddf, F, p) in tests ])
+  except (djcontrast.ContrastError, djdf.DfError), v:
+    raise DjmixedFatal("Cannot compute the contrasts of model '%s': %s" % (name, v))
+
+
+def posthoctables(name, posthoc=None, contrast=None, adjust='sidak'):
+  """The estimated marginal means of the factors in posthoc with all
+  their pairwise comparisons, the contrasts in contrast (see mixedmodel)
+  and the Type III tests of model 'name'.  Everything is computed from
+  the fixed effects of the model and their covariance matrix (see
+  djcontrast), so a model gets new contrasts without fitting it again.
+  The p values of the comparisons of a factor, and of the contrasts,
+  are adjusted by Sidak or by Holm ('adjust').  The model must exist,
+  so name is required."""
+  if not name:
+    raise DjmixedFatal("POSTHOC needs the NAME of a fitted model")
+  # only strips quotes, name is not empty
+  name = modelname(name)
+  if invalidhandlewarning([name]):
+    raise DjmixedFatal('Model not found')
+  spss.StartProcedure('DJMIXED.Posthoc')
+  try:
+    contrasttables(name, posthoc, contrast, adjust)
+  finally:
+    spss.EndProcedure()
+
+
+
+re_paramlevel = re.compile(r'\[(\w+)=\w+]$')
+
+def termfactors(label):
+  """The factors of a fixed term ('a * b') or of a parameter label
+  ('[a=1] * [b=2]') as a frozenset, which is the same for a term and
+  the parameters that belong to it"""
+  res = set()
+  for x in label.split():
+    if x=='*':
+      continue
+    match = re_paramlevel.match(x)
+    if match:
+      res.add(match.group(1))
+    elif x.replace('_', '').isalnum():
+      res.add(x)
+  return frozenset(res)
+
+
+def betaindex(nonredundants):
+  """Index the nonredundant parameter labels of a model on their
+  factors, once per model: frozenset of factors -> labels, in order"""
+  index = dict()
   for nr in nonredundants:
-    nrparts = set()
-    for x in nr.split():
-      if x!=star:
-        if re.match('\w+$', x):
-          nrparts.add(x)          
-        else:
-          match = re.match('\[(\w+)=\w+]$', x)
-          if match:
-            nrparts.add(match.group(1))
-    if fparts == nrparts:
-      res.append(nr)
-  # print "Related betas for '%s': " % fterm, res
-  return res
+    index.setdefault(termfactors(nr), list()).append(nr)
+  return index
 
-  
 
+def relatedbetas(nonredundants, fterm, index=None):
+  """return a list of nonredundant effects that are related to this
+  fixed term; pass the betaindex of nonredundants when asking for more
+  than one term"""
+  if index is None:
+    index = betaindex(nonredundants)
+  return index.get(termfactors(fterm), [])
 
 
 def fixedeffects_table(model):
   star = '*'
   cells = list()
   pivot = spss.BasePivotTable('Fixed Effects','djmixed_modelsummary_fixed')
-  xpa = xpastring("""//pivotTable[@subType='Tests of Fixed Effects']
-      /dimension[@axis='row']
-      /category/@text""")
-  fixedterms = spss.EvaluateXPath(model,'/outputTree',xpa)
-  # now retrieving all names of NON-redundant parameter estimates
-  xpa = xpastring("""//pivotTable[@subType='Parameter Estimates']/dimension[@axis='row']
-    /category[not(./dimension/category[1]/cell/footnote/note[contains(@text,'redundant')])]/@text""")
-  nonredundants = spss.EvaluateXPath(model,'/outputTree',xpa)
+  output = modeloutput(model)
+  fixedterms = output.rowitems('Tests of Fixed Effects')
+  # now retrieving all names of NON-redundant parameter estimates, the
+  # redundant ones have a footnote on their first cell
+  nonredundants = list()
+  for param in output.rowitems('Parameter Estimates'):
+    paramcells = output.rowcells('Parameter Estimates', param)
+    if not (paramcells and paramcells[0].hasnote('redundant')):
+      nonredundants.append(param)
 
   if len(fixedterms)==0:
     raise DjmixedFatal("""Fixedeffectstable: No fixed effect terms were found in the model's
     output, please make sure the model ran without errors.""")
+  index = betaindex(nonredundants)
 
   for fterm in fixedterms:
     # we could also read the whole line with this, but this is more dependent on the output
@@ -955,16 +2023,8 @@ def fixedeffects_table(model):
     
 
      
-    xpa = xpastring("""//pivotTable[@subType='Tests of Fixed Effects']
-       /dimension[@axis='row']
-       /category[@text='%s']
-       /*/category[@text='F']/cell/@text""" % fterm)
-    fval = spss.EvaluateXPath(model,'/outputTree',xpa)[0]
-    xpa = xpastring("""//pivotTable[@subType='Tests of Fixed Effects']
-       /dimension[@axis='row']
-       /category[@text='%s']
-       /*/category[@text='Sig.']/cell/@text""" % fterm)
-    pval = spss.EvaluateXPath(model,'/outputTree',xpa)[0]
+    fval = output.texts('Tests of Fixed Effects', row=fterm, col='F')[0]
+    pval = output.texts('Tests of Fixed Effects', row=fterm, col='Sig.')[0]
 
     # if fterm.find(star) < 0:
     #   re_fterm = '^\[%s=\w+]$' % fterm
@@ -973,17 +2033,15 @@ def fixedeffects_table(model):
     #   # interaction term, this assumes a * b (with spaces)
     #   parts = [ r'\b'+p.strip()+r'\b' for p in fterm.split() if p != star ]
     #   betas = [x for x in nonredundants if all(map(lambda part: re.search(part,x), parts)) ]
-    betas = relatedbetas(nonredundants, fterm)
-    if len(betas)==1:
-      xpa = xpastring("""//pivotTable[@subType='Parameter Estimates']
-         /dimension[@axis='row']/category[@text='%s']
-         /*/category[@text='Estimate']/cell/@text""" % betas[0])
-      beta = spss.EvaluateXPath(model,'/outputTree',xpa)[0]
-    else:
-      if len(betas)==0:
-        print longstring("""STRANGE:  found zero non-redundant parameters for effect '%s', 
-          continueing but something may be wrong.""" % fterm )
+    betas = relatedbetas(nonredundants, fterm, index)
+    if len(betas)==0:
+      print longstring("""STRANGE:  found zero non-redundant parameters for effect '%s', 
+        continueing but something may be wrong.""" % fterm )
       beta = '--'
+    else:
+      # one estimate per nonredundant level (combination) of the term
+      beta = '; '.join([ output.texts('Parameter Estimates', row=b, col='Estimate')[0]
+                         for b in betas ])
     cells.append((fterm, beta, fval, pval))
  
   # print dict(
@@ -997,66 +2055,97 @@ def fixedeffects_table(model):
 
 
 
+def covparmline(output, rterm):
+  """Return the line of the Covariance Parameter Estimates table for
+  random term 'rterm' as a dictionary from column label to cell text,
+  and whether SPSS flagged the parameter as redundant.  For a group
+  (the random effects proper) the row label within the group, like
+  'Variance', is stored under 'Statistics'."""
+  line = dict()
+  redundant = False
+  for cell in output.rowcells('Covariance Parameter Estimates', rterm):
+    if len(cell.rows) > 1:
+      line['Statistics'] = cell.rows[1]
+    if cell.cols:
+      line[cell.cols[-1]] = cell.text
+    if cell.hasnote('This covariance parameter is redundant'):
+      redundant = True
+  return line, redundant
+
+
+def covparmlines(output, rterm):
+  """The lines of the Covariance Parameter Estimates table for random
+  term 'rterm', one per statistic (like 'Variance', 'Var(2)' or 'UN
+  (2,1)'), as (statistic, line, redundant), see covparmline"""
+  statistics = list()
+  lines = dict()
+  redundant = set()
+  for cell in output.rowcells('Covariance Parameter Estimates', rterm):
+    statistic = cell.rows[1] if len(cell.rows) > 1 else None
+    if not statistic in lines:
+      statistics.append(statistic)
+      lines[statistic] = dict(Statistics=statistic)
+    if cell.cols:
+      lines[statistic][cell.cols[-1]] = cell.text
+    if cell.hasnote('This covariance parameter is redundant'):
+      redundant.add(statistic)
+  return [ (s, lines[s], s in redundant) for s in statistics ]
+
+
+re_randomterm = re.compile(r'(.+?) \[subject = (\w+)]$')
+
 def randomeffects_table(model):
   cells = list()
   footnotes = list()
   pivot = spss.BasePivotTable('Random Effects','djmixed_modelsummary_random')
-  # MAYBE this is not an ideal xpath for this, the * should be category or group
-  # prolly /*[name()='category' or name()='group']
-  xpa = xpastring("""//pivotTable[@subType='Covariance Parameter Estimates']
-      /dimension[@axis='row']/*/@text""")
-  randomterms = spss.EvaluateXPath(model,'/outputTree',xpa)
+  output = modeloutput(model)
+  randomterms = output.rowitems('Covariance Parameter Estimates')
   # ['Residual', 'Intercept [subject = Participant]', 'Intercept [subject = Word]']
 
   # the xml structure of residual is different from the other ones, sigh.
   # also residual should be last
-  # the 'variance' refers to variance components, if you use covtype(un) you get the familiar 
-  # listing of UN(1,2) etc here, which we cannot grok.
+  # the 'variance' refers to variance components, with random slopes
+  # (covtype(un) or covtype(diag)) every term has one row per statistic,
+  # like UN (2,1), and so gets one line per statistic here
 
   if not 'Residual' in randomterms:
     raise DjmixedFatal("""Randomeffectstable:  No 'residual' term was found in the model's
     output, please make sure the model ran without errors.""")
+  components = False
   for rterm in randomterms:
     if rterm == 'Residual':
       continue
     # parse name
-    match = re.match('(\w+) \[subject = (\w+)]$', rterm)
+    match = re_randomterm.match(rterm)
     if not match:
       raise DjmixedFatal("""Randomeffectstable:  No 'subject' term was found in the model's
     output, please make sure the model ran without errors.""")
     rtermnice, rtermwithin = match.group(1), match.group(2)
-    # retrieve values
-    xpa = xpastring("""//pivotTable[@subType='Covariance Parameter Estimates']
-      /dimension[@axis='row']/group[@text="%s"]
-      //*/@text""" % rterm )
-    line = spss.EvaluateXPath(model,'/outputTree',xpa)
-    # ['Variance', 'Statistics', 'Estimate', '5627.489502', 'Std. Error', '1466.568900', 'Wald Z', '3.837', 
-    #  'Sig.', '.000', '95% Confidence Interval', 'Lower Bound', '3376.639870', 'Upper Bound', '9378.743161']
-    re_redundant = re.compile('This covariance parameter is redundant')
-    match = [ n for n,i in enumerate(line) if re.match(re_redundant, i) ]
-    if match:
-      for n in match: 
-        del line[n]
-      footnotes.append("Model term '%s [%s]' is redundant. " % (rtermnice, rtermwithin) )      
-    line[0:2] = (line[1], line[0])
-    line = dict([ (line[i], line[i+1]) for i in range(0,9,2) ])
-    if line['Statistics'] != 'Variance':
-      spss.TextBlock("Error", blockstring("""For this function to work, every random effect must be 
-        of type 'id' or type 'vc'.  This problem was encountered when reading random effect '%s'. """ % rterm) )
-      return
-    
-    cells.append((rtermnice, rtermwithin,  # pretty HACK y:
-                  spss.CellText.Number(float(line['Estimate']),  spss.FormatSpec.Coefficient),
-                  line['Wald Z'], line['Sig.'] ))
+    # retrieve values, one line per statistic
+    # {'Statistics': 'Variance', 'Estimate': '5627.489502', 'Std. Error': '1466.568900', 'Wald Z': '3.837', 
+    #  'Sig.': '.000', 'Lower Bound': '3376.639870', 'Upper Bound': '9378.743161'}
+    for (statistic, line, redundant) in covparmlines(output, rterm):
+      label = rtermnice
+      if statistic != 'Variance':
+        label = '%s %s' % (rtermnice, statistic)
+        components = True
+      if redundant:
+        footnotes.append("Model term '%s [%s]' is redundant. " % (label, rtermwithin) )
+      cells.append((label, rtermwithin,  # pretty HACK y:
+                    spss.CellText.Number(float(line['Estimate']),  spss.FormatSpec.Coefficient),
+                    line.get('Wald Z', '.'), line.get('Sig.', '.') ))
+  if components:
+    footnotes.append(longstring("""Var(i) is the variance of random effect i
+    of a term and UN (i,j) the covariance of random effects i and j (the
+    variance if i=j), numbered as in the term: the intercept first, then
+    the levels of every slope.  With COVTYPE(UN) the native backend leaves
+    out the last level of every slope, whose parameters SPSS reports as
+    redundant, but counts them like SPSS."""))
 
   # due to spss weirdness this is parsed slightly differently
 
   rterm = 'Residual'
-  xpa = xpastring("""//pivotTable[@subType='Covariance Parameter Estimates']
-      /dimension[@axis='row']
-      /category[@text="%s"]//*/@text""" % rterm)
-  line = spss.EvaluateXPath(model,'/outputTree',xpa)
-  line = dict([ (line[i], line[i+1]) for i in range(1,8,2) ])
+  line, redundant = covparmline(output, rterm)
   rtermnice = 'Error'
   rtermwithin = '--'
   cells.append((rtermnice, rtermwithin, 
@@ -1066,8 +2155,9 @@ def randomeffects_table(model):
   pivot.SimplePivotTable(
       rowdim="",
       coldim="Model name: "+ model,
-      rowlabels=map(lambda x:str(x+1), range(len(randomterms))), 
-      collabels=('Model Term', 'Adjustment for', 'Variance', 'Wald Z', 'p'), 
+      rowlabels=map(lambda x:str(x+1), range(len(cells))), 
+      collabels=('Model Term', 'Adjustment for', components and 'Estimate' or 'Variance',
+                 'Wald Z', 'p'), 
       cells=cells)
   if footnotes:
     pivot.TitleFootnotes('\n'.join(footnotes))
@@ -1082,13 +2172,8 @@ def modelsummary(model):
   if invalidhandlewarning([model]):
     raise DjmixedFatal('Model not found') 
     # we could just return here but we raise elsewhere
-  spss.StartProcedure("DJMIXED.modelsummary")
-  try:
-    copywarnings(model)
-    fixedeffects_table(model)
-    randomeffects_table(model)
-  finally:
-    spss.EndProcedure()
+  djprofile.setmodel(model)
+  djprofile.call('summary tables', summarytables, model, "DJMIXED.modelsummary")
 
 
   
@@ -1141,14 +2226,15 @@ def modelsummary(model):
 
 def removemodel(name, message=True):
   """there currenlty is no spss syntax for this"""
-  global currentmodel, modelhandles
   if name is None:
     raise DjmixedFatal('Name argument mandatory for removemodel')
-  if currentmodel is not None:
-    print "Auto-Ending model '%s'" % currentmodel
-    currentmodel = None
-  spss.DeleteXPathHandle(name)
-  modelhandles.remove(name)
+  if registry.current is not None:
+    print "Auto-Ending model '%s'" % registry.current
+    registry.current = None
+  if not name in registry:
+    # a handle that was not made by us
+    spss.DeleteXPathHandle(name)
+  registry.remove(name)
   if message:
     spss.StartProcedure('DJMIXED.RemoveModel')
     #print "Removing model '%s'" % name
@@ -1158,24 +2244,102 @@ def removemodel(name, message=True):
   
   
 def remove_all_oxml():
-  global currentmodel, modelhandles
-  if currentmodel is not None:
-    print "Auto-Ending model '%s'" % currentmodel
-    currentmodel = None
-  for name in modelhandles:
-    spss.DeleteXPathHandle(name)
-  modelhandles.clear()
+  if registry.current is not None:
+    print "Auto-Ending model '%s'" % registry.current
+    registry.current = None
+  registry.clear()
  
   
   
 
 
-def Run(args):
-  """This function will be called by SPSS when the DJMIXED command has
-  been read, with the baroque spss nested argument dictionary as the
-  one argument """
+def profile(state='on', trace=None):
+  """Switch timing of the calls to spss on (afresh) or off, see
+  djprofile; 'report' and 'off' show what was timed so far"""
+  state = state.lower()
+  if state=='on':
+    djprofile.enable(spss, trace)
+    print "Profiling DJMIXED, trace in %s" % (trace or djprofile.TRACEFILE)
+    return
+  if trace:
+    djprofile.profiler.tracefile = trace
+  if state=='off':
+    djprofile.disable()
+  profilereport()
+
+
+def profilereport():
+  """a pivot table of the time spent per command, model and call"""
+  lines = djprofile.profiler.summary()
+  # the report itself is not timed
+  enabled = djprofile.profiler.enabled
+  djprofile.profiler.enabled = False
+  spss.StartProcedure('DJMIXED.Profile')
+  try:
+    if not lines:
+      spss.TextBlock("Profile", "Nothing was timed, use DJMIXED /PROFILE STATE=ON first")
+      return
+    cells = [ (subc or '--', model or '--', call, count,
+               spss.CellText.Number(seconds, spss.FormatSpec.Coefficient),
+               spss.CellText.Number(1000.0 * seconds / count, spss.FormatSpec.Coefficient))
+              for (subc, model, call, count, seconds) in lines ]
+    pivot = spss.BasePivotTable('Time Spent by DJMIXED', 'djmixed_profile')
+    pivot.SimplePivotTable(
+        rowdim="",
+        coldim="",
+        rowlabels=[ str(i+1) for i in range(len(lines)) ],
+        collabels=('Command', 'Model', 'Call', 'Count', 'Seconds', 'Milliseconds per Call'),
+        cells=cells)
+    pivot.TitleFootnotes("Calls within other calls (like spss.Submit within 'mixed fit') "
+                         "are counted in both.")
+  finally:
+    spss.EndProcedure()
+    djprofile.profiler.enabled = enabled
+
+
+# the extension16.Syntax of DJMIXED and the defaults of its keywords,
+# made by runsyntax for the first DJMIXED command and shared by all
+runsyntaxcache = None
+# the spssaux.VariableDict for existingvarlist keywords and the variable
+# names of the active dataset it was made for, see runvardict
+runvardictcache = [None, None]
+
+
+def runsyntax():
+  """The extension16.Syntax of the DJMIXED command and the defaults of
+  its keywords; the templates are built once, not for every command"""
+  global runsyntaxcache
+  if runsyntaxcache is None:
+    import extension16
+    templates, defaults = runtemplates(extension16)
+    runsyntaxcache = (extension16.Syntax(templates), defaults)
+  return runsyntaxcache
+
+
+def runvardict(declaration, cmd):
+  """The spssaux.VariableDict to expand the existingvarlist keywords of
+  cmd with, or None if cmd has none.  A VariableDict reads everything
+  about every variable, so it is kept until the variables change."""
+  for (subc, items) in cmd.items():
+    for item in items:
+      key = item.keys()[0]
+      template = declaration.subcdict.get(subc, {}).get(key)
+      if template is not None and template.ktype=='existingvarlist':
+        break
+    else:
+      continue
+    break
+  else:
+    return None
+  import spssaux
+  names = tuple(getallvarnames())
+  if runvardictcache[1] != names:
+    runvardictcache[:] = [spssaux.VariableDict(), names]
+  return runvardictcache[0]
 
-  #print "ARGS", args
+
+def runtemplates(extension16):
+  """the templates and defaults of all DJMIXED subcommands"""
   templates = list()
   defaults = dict()
 
@@ -1211,8 +2375,22 @@ def Run(args):
   templates +=  [extension16.Template(
           subc="COMPAREMODELS", kwd="TYPE", 
           var="comptype", islist = False, ktype="literal", 
-          vallist=['fixed','random'])]
+          vallist=['fixed','random','bootstrap'])]
   defaults['COMPAREMODELS','comptype']='fixed' 
+  templates +=  [extension16.Template(
+          subc="COMPAREMODELS", kwd="NSIM", 
+          var="nsim", islist = False, ktype="int", vallist=[1])]
+  templates +=  [extension16.Template(
+          subc="COMPAREMODELS", kwd="SEED", 
+          var="seed", islist = False, ktype="int", vallist=[0])]
+  templates +=  [extension16.Template(
+          subc="COMPAREMODELS", kwd="PROCESSES", 
+          var="processes", islist = False, ktype="int", vallist=[1])]
+
+  # compareall
+  templates +=  [extension16.Template(
+          subc="COMPAREALL", kwd="NAMES", 
+          var="compnames", islist = True, ktype="literal")]
 
 
   # modelsummary
@@ -1252,11 +2430,126 @@ def Run(args):
   templates +=  [extension16.Template(
           subc="MIXEDMODEL", kwd="PLOT", 
           var="plot", islist = True, ktype="literal",
-          vallist=['residuals' 'equalvariance'] )]
+          vallist=['residuals', 'equalvariance', 'charts'] )]
+  templates +=  [extension16.Template(
+          subc="MIXEDMODEL", kwd="PLOTDATA", 
+          var="plotdata", islist = False, ktype="literal")]
   templates +=  [extension16.Template(
           subc="MIXEDMODEL", kwd="MODELTYPE", 
           var="modeltype", islist = False, ktype="literal",
           vallist=['fullfactorial','maineffects'] )]
+  templates +=  [extension16.Template(
+          subc="MIXEDMODEL", kwd="BACKEND", 
+          var="backend", islist = False, ktype="literal",
+          vallist=['spss','native'] )]
+  templates +=  [extension16.Template(
+          subc="MIXEDMODEL", kwd="STORE", 
+          var="store", islist = False, ktype="bool")]
+  templates +=  [extension16.Template(
+          subc="MIXEDMODEL", kwd="ADJUST", 
+          var="adjust", islist = False, ktype="literal",
+          vallist=['sidak','holm'] )]
+  templates +=  [extension16.Template(
+          subc="MIXEDMODEL", kwd="STREAM", 
+          var="stream", islist = False, ktype="bool")]
+  templates +=  [extension16.Template(
+          subc="MIXEDMODEL", kwd="STARTFROM", 
+          var="startfrom", islist = False, ktype="literal")]
+  templates +=  [extension16.Template(
+          subc="MIXEDMODEL", kwd="RANDOMSLOPES", 
+          var="randomslopes", islist = True, ktype="literal")]
+  templates +=  [extension16.Template(
+          subc="MIXEDMODEL", kwd="SLOPECOV", 
+          var="slopecov", islist = False, ktype="literal",
+          vallist=['un','diag'] )]
+  templates +=  [extension16.Template(
+          subc="MIXEDMODEL", kwd="METHOD", 
+          var="method", islist = False, ktype="literal",
+          vallist=['ml','reml'] )]
+  templates +=  [extension16.Template(
+          subc="MIXEDMODEL", kwd="DFMETHOD", 
+          var="dfmethod", islist = False, ktype="literal",
+          vallist=['satterthwaite','kenwardroger'] )]
+
+  # mixedbatch: several models with the same dv and random effects
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="DV", 
+          var="dv", islist = False, ktype="varname")]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="PREDICTORS", 
+          var="batchpredictors", islist = True, ktype="literal")]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="PPS", 
+          var="pps", islist = False, ktype="varname")]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="ITEMS", 
+          var="items", islist = False, ktype="varname")]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="NAMES", 
+          var="names", islist = True, ktype="literal")]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="OUTPUT", 
+          var="output", islist = False, ktype="literal",
+          vallist=['none','split','full'] )]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="MODELTYPE", 
+          var="modeltype", islist = False, ktype="literal",
+          vallist=['fullfactorial','maineffects'] )]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="BACKEND", 
+          var="backend", islist = False, ktype="literal",
+          vallist=['spss','native'] )]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="PROCESSES", 
+          var="processes", islist = False, ktype="int", vallist=[1])]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="RANDOMSLOPES", 
+          var="randomslopes", islist = True, ktype="literal")]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="SLOPECOV", 
+          var="slopecov", islist = False, ktype="literal",
+          vallist=['un','diag'] )]
+  templates +=  [extension16.Template(
+          subc="MIXEDBATCH", kwd="METHOD", 
+          var="method", islist = False, ktype="literal",
+          vallist=['ml','reml'] )]
+  defaults['MIXEDBATCH','output']='split'
+  defaults['MIXEDBATCH','backend']='spss'
+
+  # posthoc: contrasts on a fitted model, see posthoctables
+  templates +=  [extension16.Template(
+          subc="POSTHOC", kwd="NAME", 
+          var="name", islist = False, ktype="literal")]
+  templates +=  [extension16.Template(
+          subc="POSTHOC", kwd="VARIABLES", 
+          var="posthoc", islist = True, ktype="literal")]
+  templates +=  [extension16.Template(
+          subc="POSTHOC", kwd="CONTRAST", 
+          var="contrast", islist = True, ktype="literal")]
+  templates +=  [extension16.Template(
+          subc="POSTHOC", kwd="ADJUST", 
+          var="adjust", islist = False, ktype="literal",
+          vallist=['sidak','holm'] )]
+  defaults['POSTHOC','adjust']='sidak'
+
+  # profile: time the calls to spss, see djprofile
+  templates +=  [extension16.Template(
+          subc="PROFILE", kwd="STATE", 
+          var="state", islist = False, ktype="literal",
+          vallist=['on','off','report'] )]
+  templates +=  [extension16.Template(
+          subc="PROFILE", kwd="TRACE", 
+          var="trace", islist = False, ktype="literal")]
+  defaults['PROFILE','state']='on'
+  return templates, defaults
+
+
+def Run(args):
+  """This function will be called by SPSS when the DJMIXED command has
+  been read, with the baroque spss nested argument dictionary as the
+  one argument """
+  #print "ARGS", args
+  declaration, defaults = runsyntax()
 
   cmdname = args.keys()[0]
   assert(cmdname == 'DJMIXED')
@@ -1271,9 +2564,9 @@ def Run(args):
                  (len(subcommands), subcommands) )
   subcommand = subcommands[0]
 
-  declaration = extension16.Syntax(templates)
-  declaration.parsecmd(args[cmdname], vardict = spssaux.VariableDict())
-  parseddict = declaration.parsedparams
+  # the Syntax is shared, only its result is new for every command
+  declaration.parsedparams = parseddict = dict()
+  declaration.parsecmd(args[cmdname], vardict = runvardict(declaration, args[cmdname]))
 
   # add defaults to dict
   for (subc, keyword),value in defaults.items():
@@ -1294,6 +2587,7 @@ def Runpy(subcommand, **argdict):
   this. Despatching is done from here."""
   # TODO all python subcommands should check presence of required parameters
 
+  djprofile.begincommand(subcommand)
   try:
     args = Bunch(**argdict)
     if subcommand=='STARTMODEL':  
@@ -1306,12 +2600,35 @@ def Runpy(subcommand, **argdict):
     elif subcommand=='COMPAREMODELS': 
       if args.comptype.lower()=='fixed':
         comparemodels(args.compm1, args.compm2)
+      elif args.comptype.lower()=='bootstrap':
+        bootstrapmodels(args.compm1, args.compm2, argdict.get('nsim', 1000),
+                        argdict.get('processes'), argdict.get('seed'))
       else:
         comparerandommodels(args.compm1, args.compm2)
+    elif subcommand=='COMPAREALL': 
+      compareall(argdict.get('compnames'))
     elif subcommand=='MODELSUMMARY':
       modelsummary(args.name)
     elif subcommand=="MIXEDMODEL":
       mixedmodel(**argdict) 
+    elif subcommand=="MIXEDBATCH":
+      # literal keywords keep the case they were typed in
+      slopecov = argdict.get('slopecov')
+      method = argdict.get('method')
+      specs = batchspecs(argdict.get('dv'), argdict.get('batchpredictors'), argdict.get('pps'),
+                         argdict.get('items'), argdict.get('names'), argdict.get('modeltype'),
+                         argdict.get('randomslopes'), slopecov and slopecov.upper(),
+                         method and methodname(method))
+      if (argdict.get('backend') or 'spss').lower() == 'native':
+        nativemixedmodels(specs, output=argdict.get('output', 'split'),
+                          processes=argdict.get('processes'))
+      else:
+        mixedmodels(specs, output=argdict.get('output', 'split'))
+    elif subcommand=="POSTHOC":
+      posthoctables(argdict.get('name'), argdict.get('posthoc'), argdict.get('contrast'),
+                    argdict.get('adjust', 'sidak'))
+    elif subcommand=="PROFILE":
+      profile(argdict.get('state', 'on'), argdict.get('trace'))
     else:
       DjmixedFatal("Unrecognised subcommmand '%s'" % subcommand )
   except DjmixedFatal, e:
@@ -1329,5 +2646,7 @@ def Runpy(subcommand, **argdict):
     print "=================================================================="
     # TODO one day , make this nicer with a pivottable etc.
     # the problem is what procedure output this should be etc.
+  finally:
+    djprofile.endcommand()
     
   
@@ -0,0 +1,1214 @@
+# djnative.py
+#
+# A native fitter for the mixed models that mixedmodel builds, so they
+# can be estimated without an SPSS process.
+#
+# The model class is exactly what mixedmodel generates: a number of
+# categorical predictors (the BY list), the fixed terms of /FIXED under
+# SSTYPE(3), and crossed random intercepts (PPS, ITEMS) with
+# COVTYPE(VC), or random intercepts and slopes with COVTYPE(UN) or
+# DIAG (RANDOMSLOPES), estimated by ML or REML.
+#
+# The fit follows lme4 (Bates, Maechler, Bolker & Walker, 2015): the
+# random effects are b = sigma * Lambda * u with Lambda block diagonal,
+# a lower triangular block T per level of a random factor, and theta
+# the elements of the T's (one relative standard deviation per random
+# factor for random intercepts, see RandomTerm).  For given theta
+# the fixed effects and sigma can be solved for directly, which leaves a
+# profiled deviance in theta only.  Everything is computed from cross
+# products (X'X, Z'Z, Z'X, ...), and because all predictors are
+# categorical X is evaluated once per design cell instead of once per
+# row.  For the same reason the rows can be groups of data rows with
+# their number and the sum of the dv (djdata.Statistics): every cross
+# product is a weighted sum over the groups, see ModelData.
+#
+# The results are written into the same pivot tables that OMS gives us
+# for an SPSS fit (see djoxml), so that modelsummary, comparemodels and
+# friends do not need to know where a model came from.  The df of the
+# tests are Satterthwaite's, or Kenward-Roger's on request, see djdf;
+# the output tree keeps what they need, so contrasts on the model later
+# get the same df.
+#
+# $Revision$
+
+import math, itertools, hashlib, copy
+
+try:
+  import numpy
+  import scipy.sparse
+  import scipy.sparse.linalg
+  import scipy.optimize
+except ImportError:
+  raise ImportError("The native backend of DJMIXED needs numpy and scipy")
+
+try:
+  from sksparse.cholmod import cholesky as cholmodcholesky, analyze as cholmodanalyze
+except ImportError:
+  cholmodcholesky = None
+
+import djstats, djoxml, djterms, djcontrast, djdf
+
+
+# these mirror the /CRITERIA of mixedmodel
+MXITER = 10000
+SINGULAR = 0.000000000001
+PCONVERGE = 0.000001
+# the number of columns of A^-1 solved for at a time, see logdetgradient
+INVERSECHUNK = 512
+# a warm start never puts theta below this: the slope of the deviance is
+# zero at theta 0, so a component that starts there would stay there
+STARTFLOOR = 0.05
+
+NOTCONVERGED = """Iteration was terminated but convergence has not been
+achieved. The MIXED procedure continues despite this warning. Subsequent
+results produced are based on the last iteration. Validity of the model
+fit is uncertain."""
+NOTPOSITIVE = """The final Hessian matrix is not positive definite although
+all convergence criteria are satisfied. The MIXED procedure continues
+despite this warning. Validity of subsequent results cannot be
+ascertained."""
+REDUNDANTBETA = "This parameter is set to zero because it is redundant."
+NOKENWARDROGER = """The Kenward-Roger adjustment of the covariance matrix of
+the fixed effects is not positive definite, which happens when variance
+components are at the boundary of their space. Satterthwaite df are used
+instead."""
+REDUNDANTCOV = """This covariance parameter is redundant. The test statistic
+and confidence interval cannot be computed."""
+
+
+class NativeError(Exception):
+  pass
+
+
+def getcolumn(columns, name):
+  """look up a variable in a mapping of columns, ignoring case like SPSS does"""
+  try:
+    return columns[name]
+  except KeyError:
+    for key in columns:
+      if key.lower() == name.lower():
+        return columns[key]
+  raise NativeError("Variable '%s' not found in the data" % name)
+
+
+def ismissing(value):
+  return value is None or (isinstance(value, float) and value != value)
+
+
+def missingmask(col):
+  """which values of a column are missing, without a python loop for
+  coded columns (djdata.CodedColumn) and float arrays"""
+  if hasattr(col, 'codes'):
+    return col.codes < 0
+  if isinstance(col, numpy.ndarray) and col.dtype.kind == 'f':
+    return numpy.isnan(col)
+  return numpy.array([ ismissing(x) for x in col ], dtype=bool)
+
+
+def subsetrows(col, keep):
+  if hasattr(col, 'subset'):
+    return col.subset(keep)
+  return numpy.asarray(col, dtype=object)[keep]
+
+
+class Factor(object):
+  """A categorical variable, coded 0..nlevels-1 with the levels sorted
+  in ascending order, like SPSS sorts them"""
+
+  def __init__(self, name, values):
+    self.name = name
+    if hasattr(values, 'codes'):
+      # already coded, only drop the levels that no longer occur
+      counts = numpy.bincount(values.codes, minlength=len(values.levels))
+      present = numpy.flatnonzero(counts)
+      recode = numpy.zeros(len(values.levels), dtype=int)
+      recode[present] = numpy.arange(len(present))
+      self.levels, self.codes = values.levels[present], recode[values.codes]
+    else:
+      self.levels, self.codes = numpy.unique(numpy.asarray(values), return_inverse=True)
+    self.nlevels = len(self.levels)
+
+  def leveltext(self, level):
+    value = self.levels[level]
+    if isinstance(value, (float, numpy.floating)) and value == int(value):
+      return '%d' % value
+    return '%s' % value
+
+
+class ModelData(object):
+  """The data of one model after listwise deletion: the response, the
+  design cell of every row, and the level of every random factor.
+
+  From djdata.Statistics a row is a group of data rows: 'weights' has
+  the number of data rows of every group, y their sum and 'yty' the
+  sum of squares of the response.  Otherwise weights is None."""
+
+  def __init__(self, columns, dv, factors, subjects):
+    variables = [dv] + list(factors) + list(subjects)
+    raw = [ getcolumn(columns, v) for v in variables ]
+    keep = ~numpy.any([ missingmask(col) for col in raw ], axis=0)
+    raw = [ subsetrows(col, keep) for col in raw ]
+    self.y = numpy.asarray(raw[0], dtype=float)
+    self.weights = getattr(columns, 'counts', None)
+    if self.weights is None:
+      self.n = int(keep.sum())
+      self.yty = numpy.dot(self.y, self.y)
+    else:
+      self.weights = numpy.asarray(self.weights, dtype=float)[keep]
+      self.n = int(round(self.weights.sum()))
+      self.yty = getcolumn(columns.squares, dv)
+    if self.n == 0:
+      raise NativeError("No cases left after removing missing values")
+    self.factors = [ Factor(f, col) for (f, col) in zip(factors, raw[1:1+len(factors)]) ]
+    self.subjects = [ Factor(s, col) for (s, col) in zip(subjects, raw[1+len(factors):]) ]
+    # compact design cells: one code per combination of factor levels present
+    if self.factors:
+      codes = numpy.column_stack([ f.codes for f in self.factors ])
+      self.cellcodes, self.cell = uniquerows(codes)
+    else:
+      self.cellcodes = numpy.zeros((1, 0), dtype=int)
+      self.cell = numpy.zeros(len(self.y), dtype=int)
+    self.ncell = len(self.cellcodes)
+
+  def factor(self, name):
+    for f in self.factors:
+      if f.name.lower() == name.lower():
+        return f
+    raise NativeError("Predictor '%s' is not among the BY factors" % name)
+
+  def factorindex(self, name):
+    return self.factors.index(self.factor(name))
+
+
+def uniquerows(codes):
+  """Return the unique rows of an integer array and, for every row, the
+  index of its unique row"""
+  radix = codes.max(axis=0) + 1
+  key = numpy.zeros(len(codes), dtype=numpy.int64)
+  for j in range(codes.shape[1]):
+    key = key * radix[j] + codes[:, j]
+  ukey, first, inverse = numpy.unique(key, return_index=True, return_inverse=True)
+  return codes[first], inverse
+
+
+class FixedDesign(object):
+  """The fixed effects design, evaluated per design cell.  SPSS uses an
+  overparameterized model (one column per level combination of every
+  term) and sets the columns that are linearly dependent on earlier ones
+  to zero; we do the same so estimates and labels agree with SPSS."""
+
+  def __init__(self, data, terms):
+    self.data = data
+    self.terms = [()] + list(terms)    # the intercept is the empty term
+    self.labels = list()
+    self.termof = list()
+    columns = list()
+    effects = list()
+    self.effecttermof = list()
+    for (t, term) in enumerate(self.terms):
+      idx = [ data.factorindex(f) for f in term ]
+      facs = [ data.factors[i] for i in idx ]
+      for levels in itertools.product(*[ range(f.nlevels) for f in facs ]):
+        col = numpy.ones(data.ncell)
+        for (i, level) in zip(idx, levels):
+          col = col * (data.cellcodes[:, i] == level)
+        columns.append(col)
+        self.termof.append(t)
+        self.labels.append(paramlabel(facs, levels))
+      # effect (sum to zero) coding, only used to define the Type III tests
+      for levels in itertools.product(*[ range(f.nlevels - 1) for f in facs ]):
+        col = numpy.ones(data.ncell)
+        for (i, level, f) in zip(idx, levels, facs):
+          codes = data.cellcodes[:, i]
+          col = col * ((codes == level).astype(float) - (codes == f.nlevels - 1))
+        effects.append(col)
+        self.effecttermof.append(t)
+    self.overcells = numpy.column_stack(columns)
+    self.effectcells = numpy.column_stack(effects)
+    self.counts = numpy.bincount(data.cell, weights=data.weights,
+                                 minlength=data.ncell).astype(float)
+    self.keep = nonredundant(crossproduct(self.overcells, self.counts), SINGULAR)
+    self.cells = self.overcells[:, self.keep]
+    self.p = len(self.keep)
+
+  def termlabel(self, t):
+    if t == 0:
+      return 'Intercept'
+    return ' * '.join(self.terms[t])
+
+  def nparameters(self, t):
+    return len([ k for k in self.keep if self.termof[k] == t ])
+
+  def nlevels(self, t):
+    return len([ k for k in range(len(self.termof)) if self.termof[k] == t ])
+
+  def typeIIIcontrasts(self):
+    """Return (term, L) for every term, where L tests the term under
+    SSTYPE(3) in terms of the nonredundant parameters.  The hypotheses
+    are those of the effect coded model, which is what Type III tests
+    for models without empty cells."""
+    W = self.counts
+    M = numpy.linalg.solve(crossproduct(self.cells, W),
+                           numpy.dot(self.cells.T * W, self.effectcells))
+    Minv = numpy.linalg.pinv(M)
+    termof = numpy.array(self.effecttermof)
+    res = list()
+    for t in range(len(self.terms)):
+      rows = numpy.nonzero(termof == t)[0]
+      if len(rows):
+        res.append((t, Minv[rows]))
+    return res
+
+
+def paramlabel(factors, levels):
+  if not factors:
+    return 'Intercept'
+  return ' * '.join([ '[%s=%s]' % (f.name, f.leveltext(l))
+                      for (f, l) in zip(factors, levels) ])
+
+
+def crossproduct(cells, weights):
+  return numpy.dot(cells.T * weights, cells)
+
+
+def nonredundant(C, singular):
+  """Sweep the columns of cross product matrix C in order and return the
+  indices of those that are not (numerically) linear combinations of
+  earlier ones, much like SPSS's SINGULAR criterion"""
+  keep = list()
+  L = numpy.zeros((0, 0))
+  for j in range(len(C)):
+    if C[j, j] <= 0:
+      continue
+    if keep:
+      w = numpy.linalg.solve(L, C[keep, j])
+      resid = C[j, j] - numpy.dot(w, w)
+    else:
+      w = numpy.zeros(0)
+      resid = C[j, j]
+    if resid <= singular * C[j, j]:
+      continue
+    # grow the cholesky factor of C[keep, keep]
+    k = len(keep)
+    newL = numpy.zeros((k + 1, k + 1))
+    newL[:k, :k] = L
+    newL[k, :k] = w
+    newL[k, k] = math.sqrt(resid)
+    L = newL
+    keep.append(j)
+  return keep
+
+
+def indicator(codes, nlevels, weights=None):
+  """The n x nlevels indicator matrix of an integer coded factor, built
+  directly in CSC form: column j holds the rows at level j (with their
+  weights instead of ones if given)"""
+  counts = numpy.bincount(codes, minlength=nlevels)
+  indptr = numpy.concatenate([[0], numpy.cumsum(counts)])
+  indices = numpy.argsort(codes, kind='mergesort')
+  values = numpy.ones(len(codes)) if weights is None else weights[indices]
+  return scipy.sparse.csc_matrix((values, indices, indptr), shape=(len(codes), nlevels))
+
+
+class SparseFactor(object):
+  """A factorization of Lambda Z'Z Lambda + I that can solve and give its
+  log determinant.  With CHOLMOD (scikit-sparse) this is a numeric
+  Cholesky on the symbolic analysis of the RandomStructure, otherwise
+  scipy's sparse LU with the fill reducing ordering of the first
+  factorization."""
+
+  def __init__(self, structure, A):
+    self.perm = None
+    self.lu = None
+    if cholmodcholesky is not None:
+      if structure.symbolic is None:
+        structure.symbolic = cholmodanalyze(A)
+      self.cholmod = structure.symbolic.cholesky(A)
+    else:
+      if structure.perm is None:
+        # the ordering only depends on the sparsity pattern; the first
+        # factorization is done again below, so that every theta takes
+        # the same path and results do not depend on what came first
+        structure.perm = scipy.sparse.linalg.splu(A, permc_spec='MMD_AT_PLUS_A',
+                                                  diag_pivot_thresh=0,
+                                                  options=dict(SymmetricMode=True)).perm_c
+        # and so does where every value of A goes in A[perm, perm]:
+        # permuting the values is much cheaper than slicing A each time
+        positions = scipy.sparse.csc_matrix((numpy.arange(1.0, len(A.data) + 1), A.indices,
+                                             A.indptr), shape=A.shape)
+        positions = positions[structure.perm, :][:, structure.perm]
+        positions.sort_indices()
+        structure.permuted = (positions.data.astype(int) - 1, positions.indices, positions.indptr)
+      self.perm = structure.perm
+      (order, indices, indptr) = structure.permuted
+      A = scipy.sparse.csc_matrix((A.data[order], indices, indptr), shape=A.shape)
+      self.lu = scipy.sparse.linalg.splu(A, permc_spec='NATURAL', diag_pivot_thresh=0,
+                                         options=dict(SymmetricMode=True))
+
+  def solve(self, B):
+    if self.lu is None:
+      return self.cholmod(B)
+    res = numpy.empty_like(B)
+    res[self.perm] = self.lu.solve(B[self.perm])
+    return res
+
+  def logdet(self):
+    if self.lu is None:
+      return self.cholmod.logdet()
+    return numpy.log(numpy.abs(self.lu.U.diagonal())).sum()
+
+
+def semicholesky(S):
+  """The lower triangular L with L L' = S for a positive semidefinite S:
+  a Cholesky factorization that leaves the column of a (numerically)
+  zero pivot at zero instead of failing"""
+  d = len(S)
+  L = numpy.zeros((d, d))
+  for j in range(d):
+    pivot = S[j, j] - numpy.dot(L[j, :j], L[j, :j])
+    if pivot <= SINGULAR * abs(S[j, j]):
+      continue
+    L[j, j] = math.sqrt(pivot)
+    L[j+1:, j] = (S[j+1:, j] - numpy.dot(L[j+1:, :j], L[j, :j])) / L[j, j]
+  return L
+
+
+COVSTRUCTURES = dict(VC='Variance Components', DIAG='Diagonal', UN='Unstructured')
+
+
+class RandomTerm(object):
+  """The random effects of one subject variable: a random intercept and
+  random slopes for the levels of some factors.  Every level of the
+  subject has a block of d random effects with covariance sigma2 T T',
+  where T is lower triangular: theta holds the lower triangle of T in
+  row major order for COVTYPE(UN), its diagonal for DIAG and the single
+  relative standard deviation for an intercept (VC).
+
+  The columns are the intercept and an indicator per level of every
+  slope factor.  Under UN the last level of every factor is left out:
+  its indicator is the intercept minus the others, so it adds nothing
+  but a singular covariance matrix.  SPSS keeps it and sets what is
+  left over to redundant, the likelihood is the same.  The components
+  are numbered and counted as SPSS does, with all levels (see
+  statistic and nparameters), so the models of both backends have the
+  same AIC and compare with the same df."""
+
+  def __init__(self, subject, slopes=(), covtype='UN'):
+    self.subject = subject
+    self.slopes = list(slopes)
+    self.covtype = covtype.upper() if self.slopes else 'VC'
+    if self.covtype not in COVSTRUCTURES:
+      raise NativeError("Covariance type '%s' is not available, use UN or DIAG" % covtype)
+    self.columns = [None]
+    # the number of every column among those of SPSS, from 1
+    self.numbers = [1]
+    first = 2
+    for f in self.slopes:
+      nlevels = f.nlevels - 1 if self.covtype == 'UN' else f.nlevels
+      self.columns.extend([ (f, level) for level in range(nlevels) ])
+      self.numbers.extend(range(first, first + nlevels))
+      first += f.nlevels
+    self.d = d = len(self.columns)
+    self.nlevels = subject.nlevels
+    self.q = self.nlevels * d
+    # Z in CSC form, the d columns of a level next to each other
+    rows = list()
+    for c in self.columns:
+      if c is None:
+        rows.append(numpy.arange(len(subject.codes)))
+      else:
+        rows.append(numpy.flatnonzero(c[0].codes == c[1]))
+    cols = numpy.concatenate([ subject.codes[r] * d + j for (j, r) in enumerate(rows) ])
+    rows = numpy.concatenate(rows)
+    self.Z = scipy.sparse.csc_matrix((numpy.ones(len(rows)), (rows, cols)),
+                                     shape=(len(subject.codes), self.q))
+    if self.covtype == 'UN':
+      (self.rows, self.cols) = numpy.tril_indices(d)
+    else:
+      self.rows = self.cols = numpy.arange(d)
+    self.ntheta = len(self.rows)
+    self.isdiag = self.rows == self.cols
+
+  def tmatrix(self, theta):
+    T = numpy.zeros((self.d, self.d))
+    T[self.rows, self.cols] = theta
+    return T
+
+  def covariance(self, phi):
+    """the d x d covariance matrix of the components phi of this term"""
+    S = numpy.zeros((self.d, self.d))
+    S[self.rows, self.cols] = phi
+    S[self.cols, self.rows] = phi
+    return S
+
+  def components(self, theta, sigma2):
+    """the variances and covariances, in the order of theta"""
+    T = self.tmatrix(theta)
+    return sigma2 * numpy.dot(T, T.T)[self.rows, self.cols]
+
+  def theta(self, phi, sigma2):
+    """theta for the components phi, see components"""
+    return semicholesky(self.covariance(phi) / sigma2)[self.rows, self.cols]
+
+  def scales(self, phi):
+    """the size of every component: a variance itself, a covariance the
+    geometric mean of its variances"""
+    v = numpy.abs(numpy.diag(self.covariance(phi)))
+    return numpy.sqrt(v[self.rows] * v[self.cols])
+
+  def free(self, phi, sigma2):
+    """which components are not redundant: variances that are not zero
+    and the covariances between these"""
+    v = numpy.diag(self.covariance(phi)) > SINGULAR * sigma2
+    return v[self.rows] & v[self.cols]
+
+  def effect(self):
+    return ' + '.join(['Intercept'] + [ f.name for f in self.slopes ])
+
+  def label(self):
+    """the row of the term in the Covariance Parameter Estimates"""
+    return '%s [subject = %s]' % (self.effect(), self.subject.name)
+
+  def statistic(self, k):
+    """the label of component k, like SPSS has it"""
+    if self.covtype == 'VC':
+      return 'Variance'
+    if self.covtype == 'DIAG':
+      return 'Var(%d)' % self.numbers[k]
+    return 'UN (%d,%d)' % (self.numbers[self.rows[k]], self.numbers[self.cols[k]])
+
+  def structure(self):
+    return COVSTRUCTURES[self.covtype]
+
+  def ncolumns(self):
+    """the number of random effects per subject as SPSS counts them, with
+    every level of every slope factor"""
+    return 1 + sum([ f.nlevels for f in self.slopes ])
+
+  def nparameters(self):
+    """the number of covariance parameters as SPSS counts them, for
+    ncolumns random effects; under UN those of the levels left out are
+    redundant"""
+    if self.covtype == 'UN':
+      c = self.ncolumns()
+      return c * (c + 1) // 2
+    return self.ntheta
+
+
+class RandomStructure(object):
+  """The random effects design of a list of RandomTerms: their sparse
+  blocks of Z and the pattern of A = Lambda' Z'Z Lambda + I, where
+  Lambda is block diagonal with a copy of T for every level of every
+  subject variable.
+
+  When every T is diagonal (random intercepts, DIAG) Lambda is diagonal
+  and A has the sparsity pattern of Z'Z, so its values are written
+  straight into that pattern.  Otherwise A is built from dense d x d
+  blocks, one for every pair of levels that share a row of the data:
+  T' G T for the block G of Z'Z, so a theta costs the number of blocks
+  times d cubed rather than anything in the total number of random
+  effects squared.  Either way the pattern does not depend on theta, so
+  the symbolic analysis is done once and shared by every theta and
+  every model with the same random effects, see randomstructure.
+
+  With weights (see ModelData) Z'Z is Z' W Z, and the weights stay
+  whole numbers, so it still holds counts."""
+
+  def __init__(self, terms, weights=None):
+    self.terms = terms
+    self.q = sum([ t.q for t in terms ])
+    self.offsets = numpy.cumsum([0] + [ t.q for t in terms ])
+    self.ntheta = sum([ t.ntheta for t in terms ])
+    self.thetaoffsets = numpy.cumsum([0] + [ t.ntheta for t in terms ])
+    self.thetadiag = numpy.concatenate([ t.isdiag for t in terms ])
+    self.diagonal = len([ t for t in terms if t.covtype == 'UN' ]) == 0
+    self.blocks = [ t.Z for t in terms ]
+    Z = scipy.sparse.hstack(self.blocks, format='csc')
+    if weights is None:
+      ZtZ = (Z.T * Z).tocsc()
+    else:
+      ZtZ = (Z.T * scipy.sparse.diags(weights) * Z).tocsc()
+    ZtZ.sort_indices()
+    if self.diagonal:
+      # a slope level that a subject never has is an empty column of Z,
+      # the identity keeps its diagonal in the pattern (Z'Z holds counts,
+      # so taking it off again is exact)
+      pattern = (ZtZ + scipy.sparse.identity(self.q, format='csc')).tocsc()
+      pattern.sort_indices()
+      self.indptr = pattern.indptr
+      self.indices = pattern.indices
+      self.cols = numpy.repeat(numpy.arange(self.q), numpy.diff(pattern.indptr))
+      self.isdiag = (self.indices == self.cols).astype(float)
+      self.ztz = pattern.data - self.isdiag
+    else:
+      self.blockpattern(ZtZ.tocsr())
+    self.ZtZ = ZtZ
+    self.symbolic = None
+    self.perm = self.permuted = None
+
+  def blockpattern(self, ZtZ):
+    """the dense blocks of Z'Z for every pair of terms, and where their
+    values go in the CSC pattern of A"""
+    self.pairs = list()
+    rows, cols = list(), list()
+    indicators = [ indicator(t.subject.codes, t.nlevels) for t in self.terms ]
+    for (s, ts) in enumerate(self.terms):
+      for (t, tt) in enumerate(self.terms):
+        levels = (indicators[s].T * indicators[t]).tocoo()
+        (a, b) = (levels.row[:, None, None], levels.col[:, None, None])
+        i = numpy.arange(ts.d)[None, :, None]
+        j = numpy.arange(tt.d)[None, None, :]
+        r = (self.offsets[s] + a * ts.d + i + 0 * j).ravel()
+        c = (self.offsets[t] + b * tt.d + j + 0 * i).ravel()
+        G = numpy.asarray(ZtZ[r, c]).reshape((len(levels.row), ts.d, tt.d))
+        # the identity of A, on the diagonal blocks
+        I = numpy.zeros(G.shape)
+        if s == t:
+          I[(a == b)[:, 0, 0]] = numpy.eye(ts.d)
+        self.pairs.append((s, t, G, I))
+        rows.append(r)
+        cols.append(c)
+    rows, cols = numpy.concatenate(rows), numpy.concatenate(cols)
+    self.order = numpy.lexsort((rows, cols))
+    self.indices = rows[self.order]
+    self.indptr = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(cols, minlength=self.q))])
+
+  def splittheta(self, theta):
+    return [ theta[self.thetaoffsets[k]:self.thetaoffsets[k+1]] for k in range(len(self.terms)) ]
+
+  def lambdadiag(self, theta):
+    """the diagonal of Lambda, when it is diagonal"""
+    return numpy.concatenate([ numpy.tile(th, t.nlevels)
+                               for (t, th) in zip(self.terms, self.splittheta(theta)) ])
+
+  def starttheta(self, intercepts=None):
+    """theta with T the identity, or with the relative standard
+    deviations of the random intercepts given, one per term"""
+    res = self.thetadiag.astype(float)
+    if intercepts is not None:
+      res[self.thetaoffsets[:-1]] = intercepts
+    return res
+
+  def bounds(self):
+    """the bounds of theta for the optimizer: the diagonal of T is not
+    negative, see optimizetheta"""
+    return [ (0.0, None) if diag else (None, None) for diag in self.thetadiag ]
+
+  def thetasum(self, U, V=None):
+    """For every theta, the sum over the levels of U[i] * V[j] (rows,
+    summed over the columns), where theta is T[i,j] of the level.  This
+    is tr(dLambda' U V') for the derivative dLambda of Lambda to theta,
+    which is all the gradient needs.  Without V, U is a q x q matrix
+    and the sum is over U[i,j]."""
+    res = list()
+    for (k, t) in enumerate(self.terms):
+      first = self.offsets[k] + numpy.arange(t.nlevels)[:, None] * t.d
+      (rows, cols) = (first + t.rows, first + t.cols)
+      if V is None:
+        res.append(U[rows, cols].sum(axis=0))
+      elif U.ndim == 1:
+        res.append((U[rows] * V[cols]).sum(axis=0))
+      else:
+        res.append((U[rows] * V[cols]).sum(axis=2).sum(axis=0))
+    return numpy.concatenate(res)
+
+  def logdetgradient(self, theta, factor):
+    """The derivatives of log|A| to theta, 2 tr(A^-1 dA) with dA =
+    Lambda' Z'Z dLambda for every theta.  Only the diagonal blocks of
+    Z'Z Lambda A^-1 count, so A^-1 is solved for a chunk of columns at
+    a time and memory stays linear in q."""
+    res = list()
+    for (k, t) in enumerate(self.terms):
+      nlevels = max(1, INVERSECHUNK // t.d)
+      grad = numpy.zeros(t.ntheta)
+      for start in range(0, t.nlevels, nlevels):
+        levels = numpy.arange(start, min(start + nlevels, t.nlevels))
+        columns = (self.offsets[k] + levels[:, None] * t.d + numpy.arange(t.d)).ravel()
+        E = numpy.zeros((self.q, len(columns)))
+        E[columns, numpy.arange(len(columns))] = 1.0
+        Y = self.ZtZ * self.lambdaproduct(theta, factor.solve(E))
+        # level l of the chunk has its block at columns l*d.. of Y
+        first = numpy.arange(len(levels))[:, None] * t.d
+        rows = self.offsets[k] + levels[:, None] * t.d + t.rows
+        grad += Y[rows, first + t.cols].sum(axis=0)
+      res.append(2 * grad)
+    return numpy.concatenate(res)
+
+  def factor(self, theta):
+    if self.diagonal:
+      lam = self.lambdadiag(theta)
+      data = lam[self.indices] * lam[self.cols] * self.ztz + self.isdiag
+    else:
+      T = [ t.tmatrix(th) for (t, th) in zip(self.terms, self.splittheta(theta)) ]
+      data = list()
+      for (s, t, G, I) in self.pairs:
+        # T_s' G T_t for every block at once
+        GT = numpy.dot(G, T[t])
+        data.append((numpy.dot(GT.transpose(0, 2, 1), T[s]).transpose(0, 2, 1) + I).ravel())
+      data = numpy.concatenate(data)[self.order]
+    A = scipy.sparse.csc_matrix((data, self.indices, self.indptr), shape=(self.q, self.q))
+    return SparseFactor(self, A)
+
+  def lambdaproduct(self, theta, M, transpose=False):
+    """Lambda M, or Lambda' M, for a q vector or q x m array M"""
+    if self.diagonal:
+      lam = self.lambdadiag(theta)
+      return lam * M if M.ndim == 1 else lam[:, None] * M
+    res = numpy.empty(M.shape)
+    for (k, (t, th)) in enumerate(zip(self.terms, self.splittheta(theta))):
+      T = t.tmatrix(th)
+      if transpose:
+        T = T.T
+      block = M[self.offsets[k]:self.offsets[k+1]].reshape((t.nlevels, t.d, -1))
+      res[self.offsets[k]:self.offsets[k+1]] = \
+        numpy.dot(block.transpose(0, 2, 1), T.T).transpose(0, 2, 1).reshape((t.q,) + M.shape[1:])
+    return res
+
+  def crossproduct(self, rows):
+    """Z' times 'rows', where rows is a sparse n x m matrix or a vector"""
+    res = [ block.T * rows for block in self.blocks ]
+    if scipy.sparse.issparse(rows):
+      return scipy.sparse.vstack(res, format='csr')
+    return numpy.concatenate(res)
+
+  def product(self, b):
+    """Z b, for a q vector b"""
+    res = 0.0
+    for (k, block) in enumerate(self.blocks):
+      res = res + block * b[self.offsets[k]:self.offsets[k+1]]
+    return res
+
+  def components(self, theta, sigma2):
+    return numpy.concatenate([ t.components(th, sigma2)
+                               for (t, th) in zip(self.terms, self.splittheta(theta)) ])
+
+  def theta(self, phi, sigma2):
+    return numpy.concatenate([ t.theta(p, sigma2)
+                               for (t, p) in zip(self.terms, self.splittheta(phi)) ])
+
+
+# random structures of recent models, most recent last, see randomstructure
+structures = list()
+MAXSTRUCTURES = 8
+
+
+def factorkey(f):
+  return (f.nlevels, hashlib.sha1(numpy.ascontiguousarray(f.codes)).hexdigest())
+
+
+def randomstructure(terms, weights=None):
+  """Return the RandomStructure for these random terms, reusing the one
+  of an earlier model (and so its symbolic factorization) when the
+  random effects are identical, as in the two models of a comparison"""
+  key = tuple([ (t.covtype, factorkey(t.subject)) + tuple([ factorkey(f) for f in t.slopes ])
+                for t in terms ])
+  if weights is not None:
+    key += (hashlib.sha1(numpy.ascontiguousarray(weights)).hexdigest(),)
+  for (i, (k, structure)) in enumerate(structures):
+    if k == key:
+      structures.append(structures.pop(i))
+      return structure
+  structure = RandomStructure(terms, weights)
+  structures.append((key, structure))
+  del structures[:-MAXSTRUCTURES]
+  return structure
+
+
+class CrossProducts(object):
+  """All the fit needs from the data: the cross products of response,
+  fixed design X and random effects design Z.  Memory is linear in the
+  number of rows (or groups): Z is only held as sparse blocks, one per
+  random term."""
+
+  def __init__(self, data, design, terms):
+    counts = design.counts
+    self.cell = data.cell
+    self.cells = design.cells
+    self.n = data.n
+    self.p = design.p
+    self.XtX = crossproduct(design.cells, counts)
+    self.q = sum([ t.q for t in terms ])
+    if self.q:
+      self.random = randomstructure(terms, data.weights)
+      C = indicator(data.cell, data.ncell, data.weights)
+      self.ZtX = numpy.asarray(self.random.crossproduct(C) * design.cells)
+    else:
+      self.random = None
+      self.ZtX = numpy.zeros((0, self.p))
+    self.setresponse(data.y, data.yty)
+
+  def setresponse(self, y, yty=None):
+    """the cross products that involve the response; yty if y holds
+    sums (see ModelData)"""
+    sums = numpy.bincount(self.cell, weights=y, minlength=len(self.cells))
+    self.yty = numpy.dot(y, y) if yty is None else yty
+    self.Xty = numpy.dot(self.cells.T, sums)
+    if self.q:
+      self.Zty = self.random.crossproduct(y)
+    else:
+      self.Zty = numpy.zeros(0)
+
+  def withresponse(self, y):
+    """a copy for another response on the same design, as in a
+    simulation; only the response cross products are computed again"""
+    res = copy.copy(self)
+    res.setresponse(y)
+    return res
+
+
+class Solution(object):
+  """The solution of the penalized least squares problem for one theta"""
+
+  def __init__(self, cp, theta):
+    self.theta = numpy.asarray(theta, dtype=float)
+    n, p = cp.n, cp.p
+    if cp.q:
+      factor = cp.random.factor(self.theta)
+      LZtX = cp.random.lambdaproduct(self.theta, cp.ZtX, transpose=True)
+      LZty = cp.random.lambdaproduct(self.theta, cp.Zty, transpose=True)
+      self.S = S = factor.solve(numpy.column_stack([LZtX, LZty]))
+      self.factor = factor
+      self.logdetA = factor.logdet()
+      self.XtVX = cp.XtX - numpy.dot(LZtX.T, S[:, :p])
+      Xty = cp.Xty - numpy.dot(LZtX.T, S[:, p])
+      yty = cp.yty - numpy.dot(LZty, S[:, p])
+    else:
+      self.logdetA = 0.0
+      self.XtVX = cp.XtX
+      Xty = cp.Xty
+      yty = cp.yty
+    self.beta = numpy.linalg.solve(self.XtVX, Xty)
+    self.r2 = yty - numpy.dot(self.beta, Xty)
+    self.n = n
+    self.p = p
+
+  def gradient(self, cp, reml=False):
+    """The derivatives of the profiled deviance to theta.  With e the
+    residual and u the spherical random effects, the penalized residual
+    sum of squares r2 changes by -2 e'Z dLambda u (the envelope theorem:
+    beta and u are optimal), log|A| as in RandomStructure.logdetgradient
+    and, for REML, log|X'V^-1 X| by tr((X'V^-1 X)^-1 d(X'V^-1 X))."""
+    (random, theta, n, p) = (cp.random, self.theta, self.n, self.p)
+    if not cp.q:
+      return numpy.zeros(0)
+    u = self.S[:, p] - numpy.dot(self.S[:, :p], self.beta)
+    Zte = cp.Zty - numpy.dot(cp.ZtX, self.beta) - random.ZtZ * random.lambdaproduct(theta, u)
+    dr2 = -2 * random.thetasum(Zte, u)
+    grad = random.logdetgradient(theta, self.factor)
+    if reml:
+      C = self.S[:, :p]
+      H = random.ZtZ * random.lambdaproduct(theta, C)
+      grad = grad + 2 * random.thetasum(numpy.linalg.solve(self.XtVX, (H - cp.ZtX).T).T, C)
+      return grad + (n - p) * dr2 / self.r2
+    return grad + n * dr2 / self.r2
+
+  def deviance(self, reml=False):
+    n, p, r2 = self.n, self.p, self.r2
+    if reml:
+      logdetX = numpy.linalg.slogdet(self.XtVX)[1]
+      return self.logdetA + logdetX + (n - p) * (1 + math.log(2 * math.pi * r2 / (n - p)))
+    return self.logdetA + n * (1 + math.log(2 * math.pi * r2 / n))
+
+  def sigma2(self, reml=False):
+    if reml:
+      return self.r2 / (self.n - self.p)
+    return self.r2 / self.n
+
+  def fulldeviance(self, sigma2, reml=False):
+    """the deviance at a given sigma2 instead of the optimal one"""
+    n, p = self.n, self.p
+    res = self.logdetA + self.r2 / sigma2
+    if reml:
+      return res + numpy.linalg.slogdet(self.XtVX)[1] + (n - p) * math.log(2 * math.pi * sigma2)
+    return res + n * math.log(2 * math.pi * sigma2)
+
+
+def devianceandgradient(theta, cp, reml=False):
+  solution = Solution(cp, theta)
+  return solution.deviance(reml), solution.gradient(cp, reml)
+
+
+def optimizetheta(cp, reml=False, start=None):
+  """Minimize the profiled deviance over theta, from start (default T
+  the identity), by L-BFGS-B with the analytic gradient and the
+  diagonal of T bounded at zero; return theta, the number of
+  iterations and whether it converged.
+
+  The deviance is even in every relative standard deviation (the
+  diagonal of T), so its slope at zero is zero and an optimizer that
+  reaches the bound tends to stay there, also when the optimum is just
+  inside.  So a fit that ends on the bound is started again a step
+  inside, if that is better."""
+  if not cp.q:
+    return numpy.zeros(0), 0, True
+  random = cp.random
+  if start is None:
+    start = random.starttheta()
+  deviance = lambda theta: Solution(cp, theta).deviance(reml)
+  (theta, iterations, converged) = (numpy.asarray(start, dtype=float), 0, False)
+  for attempt in range(random.ntheta + 1):
+    res = scipy.optimize.minimize(devianceandgradient, theta, args=(cp, reml), jac=True,
+                                  method='L-BFGS-B', bounds=random.bounds(),
+                                  options=dict(maxiter=MXITER, ftol=PCONVERGE * 1e-4))
+    (theta, iterations, converged) = (res.x, iterations + int(res.nit), bool(res.success))
+    inside = numpy.where(random.thetadiag & (theta <= 0), STARTFLOOR, theta)
+    if (inside == theta).all() or deviance(inside) >= res.fun:
+      break
+    theta = inside
+  return theta, iterations, converged
+
+
+def starttheta(phi):
+  """The theta to start the optimizer from, given variance components
+  (random..., residual) of an earlier model, say a nested one; a
+  component that model did not have (None) starts at 1"""
+  residual = phi[-1]
+  if not residual or residual <= 0:
+    return None
+  theta = [ 1.0 if v is None else math.sqrt(max(v, 0) / residual) for v in phi[:-1] ]
+  return numpy.maximum(theta, STARTFLOOR)
+
+
+def numhessian(f, x, steps):
+  """central difference hessian of f at x"""
+  k = len(x)
+  H = numpy.zeros((k, k))
+  f0 = f(x)
+  for i in range(k):
+    ei = numpy.zeros(k); ei[i] = steps[i]
+    H[i, i] = (f(x + ei) - 2 * f0 + f(x - ei)) / steps[i] ** 2
+    for j in range(i):
+      ej = numpy.zeros(k); ej[j] = steps[j]
+      H[i, j] = H[j, i] = (f(x + ei + ej) - f(x + ei - ej) - f(x - ei + ej) + f(x - ei - ej)) \
+                          / (4 * steps[i] * steps[j])
+  return H
+
+
+class NativeModel(object):
+  """A mixed model fitted by djnative.  The interesting bits are in
+  'output', which holds the same pivot tables as the OXML of an SPSS fit."""
+
+  def __init__(self, columns, dv, predictors=None, pps=None, items=None,
+               modeltype=None, method='ML', estimate=True, start=None, randomslopes=None,
+               slopecov='UN', dfmethod='satterthwaite'):
+    if predictors and predictors != 'None':
+      if isinstance(predictors, basestring):
+        predictors = predictors.split()
+      predictors, mainpredictors = djterms.reparsepredictors(predictors)
+      if modeltype and modeltype.lower() == "fullfactorial":
+        predictors = djterms.fullfactorial(mainpredictors)
+    else:
+      predictors = ""
+    terms = djterms.fixedterms(predictors)
+    factors = list()
+    for term in terms:
+      for f in term:
+        if f not in factors:
+          factors.append(f)
+    self.dv = dv
+    self.subjects = [ s for s in (pps, items) if s ]
+    self.reml = method.upper() == 'REML'
+    try:
+      self.dfmethod = djdf.dfmethodname(dfmethod)
+    except djdf.DfError, v:
+      raise NativeError(str(v))
+    self.data = ModelData(columns, dv, factors, self.subjects)
+    self.design = FixedDesign(self.data, terms)
+    try:
+      slopes = [ s for (s, subject) in zip(djterms.splitslopes(randomslopes), (pps, items))
+                 if subject ]
+    except ValueError, v:
+      raise NativeError(str(v))
+    self.terms = [ RandomTerm(s, [ self.data.factor(f) for f in fs ], slopecov)
+                   for (s, fs) in zip(self.data.subjects, slopes) ]
+    self.cp = CrossProducts(self.data, self.design, self.terms)
+    if estimate:
+      self.fit(self.starttheta(start))
+      self.output = self.buildoutput()
+
+  def starttheta(self, start):
+    """theta to start from for the variance components start, see
+    starttheta; only the random intercepts are taken from it"""
+    intercepts = starttheta(start) if start is not None else None
+    if intercepts is None or not self.cp.q:
+      return None
+    return self.cp.random.starttheta(intercepts)
+
+  def fit(self, start=None):
+    cp = self.cp
+    (theta, self.iterations, self.converged) = optimizetheta(cp, self.reml, start)
+    self.solution = Solution(cp, theta)
+    self.theta = self.solution.theta
+    self.sigma2 = self.solution.sigma2(self.reml)
+    self.m2ll = self.solution.deviance(self.reml)
+    self.phi = numpy.concatenate([self.phirandom(self.theta, self.sigma2), [self.sigma2]])
+    # variances estimated at zero are redundant, like SPSS says, and so
+    # are the covariances with them
+    free = [ t.free(phi, self.sigma2) for (t, phi) in zip(self.terms, self.splitterms(self.phi)) ]
+    self.free = list(numpy.flatnonzero(numpy.concatenate(free + [[True]])))
+    self.covphi = self.phicovariance()
+    self.beta = self.solution.beta
+    self.covbeta = self.sigma2 * numpy.linalg.inv(self.solution.XtVX)
+    self.dfs = None
+
+  def responsedeviance(self, y, start=None):
+    """Refit the model on response y instead of the data, for a
+    simulation; return the deviance, theta and whether it converged"""
+    cp = self.cp.withresponse(y)
+    (theta, iterations, converged) = optimizetheta(cp, self.reml, start)
+    return Solution(cp, theta).deviance(self.reml), theta, converged
+
+  def simulate(self, randomstate, beta=None, phi=None):
+    """Draw a response from the model with fixed effects beta and
+    variance components phi (default: the estimates)"""
+    self.rowwise('simulate')
+    if beta is None:
+      beta = self.beta
+    if phi is None:
+      phi = self.phi
+    mu = numpy.dot(self.design.cells, beta)[self.data.cell]
+    y = mu + randomstate.normal(0.0, math.sqrt(phi[-1]), self.data.n)
+    for (t, p) in zip(self.terms, self.splitterms(phi)):
+      if t.d == 1:
+        y += randomstate.normal(0.0, math.sqrt(p[0]), t.nlevels)[t.subject.codes]
+      else:
+        R = semicholesky(t.covariance(p))
+        y += t.Z * numpy.dot(randomstate.normal(0.0, 1.0, (t.nlevels, t.d)), R.T).ravel()
+    return y
+
+  def rowwise(self, what):
+    if self.data.weights is not None:
+      raise NativeError("Cannot %s without the data row by row, the model was fitted on "
+                        "sufficient statistics" % what)
+
+  def splitterms(self, values):
+    """theta or the components split over the random terms"""
+    if not self.cp.q:
+      return []
+    return self.cp.random.splittheta(values)
+
+  def phirandom(self, theta, sigma2):
+    if not self.cp.q:
+      return numpy.zeros(0)
+    return self.cp.random.components(theta, sigma2)
+
+  def phitotheta(self, phi):
+    """the components (random..., residual) to theta"""
+    if not self.cp.q:
+      return numpy.zeros(0)
+    return self.cp.random.theta(phi[:-1], phi[-1])
+
+  def phisteps(self):
+    """the steps of the numerical derivatives to the components"""
+    scales = [ t.scales(phi) for (t, phi) in zip(self.terms, self.splitterms(self.phi)) ]
+    return 1e-4 * numpy.concatenate(scales + [[self.phi[-1]]])
+
+  def devianceatphi(self, phifree):
+    phi = self.phi.copy()
+    phi[self.free] = phifree
+    return Solution(self.cp, self.phitotheta(phi)).fulldeviance(phi[-1], self.reml)
+
+  def phicovariance(self):
+    """asymptotic covariance of the free variance components, the
+    inverse of half the hessian of the deviance"""
+    phifree = self.phi[self.free]
+    H = numhessian(self.devianceatphi, phifree, self.phisteps()[self.free])
+    cov = numpy.zeros((len(self.phi), len(self.phi)))
+    try:
+      cov[numpy.ix_(self.free, self.free)] = 2 * numpy.linalg.inv(H)
+    except numpy.linalg.LinAlgError:
+      cov[:] = numpy.nan
+    return cov
+
+  def precision(self, phi):
+    """X'V^-1 X, the inverse of cov(beta), at components phi"""
+    return Solution(self.cp, self.phitotheta(phi)).XtVX / phi[-1]
+
+  def dfapproximation(self):
+    """the df of the tests of this fit (see djdf), computed once"""
+    if self.dfs is None:
+      (first, second) = djdf.derivatives(self.precision, self.phi, self.free, self.phisteps(),
+                                         self.dfmethod == 'kenwardroger')
+      W = self.covphi[numpy.ix_(self.free, self.free)]
+      self.dfs = djdf.DfApproximation(self.covbeta, first, W, second, self.design.keep)
+    return self.dfs
+
+  def typeIIItests(self):
+    """(term label, numerator df, denominator df, F, p) for every term"""
+    dfs = self.dfapproximation()
+    res = list()
+    for (t, L) in self.design.typeIIIcontrasts():
+      (F, r, ddf) = dfs.test(L, self.beta)
+      res.append((self.design.termlabel(t), r, ddf, F,
+                  djstats.pf(F, r, ddf, lowertail=False)))
+    return res
+
+  def nparameters(self):
+    """the number of parameters as SPSS counts them, see
+    RandomTerm.nparameters"""
+    return self.design.p + self.ncovparameters()
+
+  def ncovparameters(self):
+    return sum([ t.nparameters() for t in self.terms ]) + 1
+
+  def randomeffects(self):
+    """The predicted random effects (BLUPs) of all levels of all random
+    terms, one block per term with the d effects of a level together"""
+    cp = self.cp
+    if not cp.q:
+      return numpy.zeros(0)
+    (random, theta) = (cp.random, self.theta)
+    u = random.factor(theta).solve(
+      random.lambdaproduct(theta, cp.Zty - numpy.dot(cp.ZtX, self.beta), transpose=True))
+    return random.lambdaproduct(theta, u)
+
+  def fitted(self):
+    """The fitted value of every row: the fixed part plus the predicted
+    random effects, like /SAVE PRED of MIXED"""
+    self.rowwise('compute fitted values')
+    data = self.data
+    res = numpy.dot(self.design.cells, self.beta)[data.cell]
+    if self.cp.q:
+      res = res + self.cp.random.product(self.randomeffects())
+    return res
+
+  def residuals(self):
+    """the residual of every row, like /SAVE RESID of MIXED"""
+    return self.data.y - self.fitted()
+
+  def celllabels(self):
+    """the label of every design cell: the levels of the factors"""
+    data = self.data
+    return [ ' '.join([ f.leveltext(level) for (f, level) in zip(data.factors, codes) ]) or 'All'
+             for codes in data.cellcodes ]
+
+  def buildoutput(self):
+    """The pivot tables an SPSS fit of this model would produce, at
+    least those parts that DJMIXED reads"""
+    output = djoxml.OutputTree()
+    output.commands.append(('Mixed', 'Mixed Model Analysis'))
+    design = self.design
+    npar = self.nparameters()
+
+    dims = output.addpivot(djoxml.PivotTable('Model Dimension'))
+    for t in range(len(design.terms)):
+      dims.addline(('Fixed Effects', design.termlabel(t)),
+                   [('Number of Levels', '%d' % design.nlevels(t)),
+                    ('Number of Parameters', '%d' % design.nparameters(t))])
+    for (t, s) in zip(self.terms, self.subjects):
+      dims.addline(('Random Effects', t.effect()),
+                   [('Number of Levels', '%d' % t.ncolumns()),
+                    ('Covariance Structure', t.structure()),
+                    ('Number of Parameters', '%d' % t.nparameters()),
+                    ('Subject Variables', s)])
+    dims.addline(('Residual',), [('Number of Parameters', '1')])
+    nlevels = len(design.termof) + sum([ t.ncolumns() for t in self.terms ])
+    dims.addline(('Total',), [('Number of Levels', '%d' % nlevels),
+                              ('Number of Parameters', '%d' % npar)])
+
+    info = output.addpivot(djoxml.PivotTable('Information Criteria'))
+    if self.reml:
+      label, k, n = '-2 Restricted Log Likelihood', self.ncovparameters(), self.data.n - design.p
+    else:
+      label, k, n = '-2 Log Likelihood', npar, self.data.n
+    m2ll = self.m2ll
+    for (row, value) in ((label, m2ll),
+                         ("Akaike's Information Criterion (AIC)", m2ll + 2 * k),
+                         ("Hurvich and Tsai's Criterion (AICC)", m2ll + 2 * k * n / float(n - k - 1)),
+                         ("Bozdogan's Criterion (CAIC)", m2ll + k * (math.log(n) + 1)),
+                         ("Schwarz's Bayesian Criterion (BIC)", m2ll + k * math.log(n))):
+      info.addline((row,), [('Value', '%.3f' % value)])
+
+    tests = output.addpivot(djoxml.PivotTable('Tests of Fixed Effects'))
+    for (term, ndf, ddf, F, p) in self.typeIIItests():
+      tests.addline((term,), [('Numerator df', '%d' % ndf), ('Denominator df', '%.3f' % ddf),
+                              ('F', '%.3f' % F), ('Sig.', sigtext(p))])
+
+    # Kenward-Roger adjusts the covariance matrix of beta as well
+    dfs = self.dfapproximation()
+    covbeta = dfs.adjusted
+    dfs1 = dfs.contrastdf(numpy.eye(design.p))
+    estimates = output.addpivot(djoxml.PivotTable('Parameter Estimates'))
+    position = dict([ (k, i) for (i, k) in enumerate(design.keep) ])
+    for (j, label) in enumerate(design.labels):
+      if j not in position:
+        estimates.addline((label,), [('Estimate', '0', [REDUNDANTBETA])])
+        continue
+      i = position[j]
+      se = math.sqrt(covbeta[i, i])
+      df = dfs1[i]
+      t = self.beta[i] / se
+      estimates.addline((label,), [('Estimate', '%f' % self.beta[i]), ('Std. Error', '%f' % se),
+                                   ('df', '%.3f' % df), ('t', '%.3f' % t),
+                                   ('Sig.', sigtext(djstats.pf(t * t, 1, df, lowertail=False)))])
+
+    # /PRINT=COVB, with the redundant parameters zero
+    covb = output.addpivot(djoxml.PivotTable(djcontrast.COVBTYPE))
+    full = numpy.zeros((len(design.labels), len(design.labels)))
+    full[numpy.ix_(design.keep, design.keep)] = covbeta
+    for (i, label) in enumerate(design.labels):
+      covb.addline((label,), [ (other, '%.10g' % full[i, j])
+                               for (j, other) in enumerate(design.labels) ])
+
+    covparms = output.addpivot(djoxml.PivotTable('Covariance Parameter Estimates'))
+    covparms.addline(('Residual',), self.covparmcells(len(self.phi) - 1))
+    k = 0
+    for t in self.terms:
+      for j in range(t.ntheta):
+        covparms.addline((t.label(), t.statistic(j)), self.covparmcells(k))
+        k += 1
+
+    messages = list()
+    if not self.converged:
+      messages.append(NOTCONVERGED)
+    elif not numpy.all(numpy.diag(self.covphi)[self.free] > 0):
+      messages.append(NOTPOSITIVE)
+    if dfs.method != self.dfmethod:
+      messages.append(NOKENWARDROGER)
+    if messages:
+      warnings = output.addpivot(djoxml.PivotTable('Warnings'))
+      for message in messages:
+        warnings.addline(('Warning',), [('', ' '.join(message.split()))])
+    output.dfs = dfs
+    return output
+
+  def covparmcells(self, k):
+    estimate = self.phi[k]
+    if k not in self.free:
+      return [('Estimate', '%f' % 0.0, [' '.join(REDUNDANTCOV.split())]),
+              ('Std. Error', '.'), ('Wald Z', '.'), ('Sig.', '.')]
+    if not self.covphi[k, k] > 0:
+      return [('Estimate', '%f' % estimate), ('Std. Error', '.'), ('Wald Z', '.'), ('Sig.', '.')]
+    se = math.sqrt(self.covphi[k, k])
+    z = estimate / se
+    return [('Estimate', '%f' % estimate), ('Std. Error', '%f' % se),
+            ('Wald Z', '%.3f' % z), ('Sig.', sigtext(2 * djstats.pnorm(-abs(z))))]
+
+
+def sigtext(p):
+  """format a p value the way SPSS shows it: .024"""
+  text = '%.3f' % p
+  if text.startswith('0'):
+    text = text[1:]
+  return text
+
+
+def fitmixedmodel(columns, dv, predictors=None, pps=None, items=None,
+                  modeltype=None, method='ML', start=None, randomslopes=None, slopecov='UN',
+                  dfmethod='satterthwaite'):
+  """Fit the model mixedmodel would submit to SPSS, with the same
+  arguments, on 'columns': a mapping from variable name to a sequence
+  of values (None is missing), for example from djdata.readsav, or
+  the ColumnStore of djdata.readcolumns for data too big for lists, or
+  the Statistics of djdata.readstatistics for data too big for that.
+  'start' gives variance components to start from (one per random
+  factor, None if unknown, and the residual last), see starttheta.
+  'randomslopes' and 'slopecov' are as for mixedmodel, see RandomTerm.
+  'dfmethod' is satterthwaite or kenwardroger, see djdf."""
+  return NativeModel(columns, dv, predictors, pps, items, modeltype, method, start=start,
+                     randomslopes=randomslopes, slopecov=slopecov, dfmethod=dfmethod)
+
+
+
+if __name__ == '__main__':
+  pass
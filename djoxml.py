@@ -0,0 +1,254 @@
+# djoxml.py
+#
+# Every question djmixedcore asks of a model (what is the -2LL, what are
+# the fixed terms, what is the F of this term) used to be one
+# spss.EvaluateXPath call, and every such call walks the whole output
+# tree of the model again.  Here we walk the tree once and keep the
+# pivot tables around in a form that is cheap to query.
+#
+# The output tree is the OXML document that OMS writes to the xml
+# workspace, see spss.GetXmlUtf16.  Only pivot tables and the command
+# elements are kept, the rest is thrown away.
+#
+# $Revision$
+
+import re
+
+try:
+  import xml.etree.cElementTree as ElementTree
+except ImportError:
+  import xml.etree.ElementTree as ElementTree
+
+
+re_declaration = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+
+def localname(tag):
+  """strip the namespace from an ElementTree tag, OXML is all in one namespace anyway"""
+  return tag.rsplit('}', 1)[-1]
+
+
+class Cell(object):
+  """One cell of a pivot table: its text, the labels of the row and
+  column categories (and groups) it sits under, outermost first, and
+  the texts of its footnotes"""
+  __slots__ = ('text', 'rows', 'cols', 'footnotes')
+
+  def __init__(self, text, rows, cols, footnotes):
+    self.text = text
+    self.rows = rows
+    self.cols = cols
+    self.footnotes = footnotes
+
+  def hasnote(self, fragment):
+    for note in self.footnotes:
+      if fragment in note:
+        return True
+    return False
+
+
+class PivotTable(object):
+  """The cells of one pivot table, in document order, indexed on the
+  outermost row label"""
+
+  def __init__(self, subtype):
+    self.subtype = subtype
+    # texts of the categories/groups directly below the outer row dimension
+    self.rowitems = list()
+    self.cells = list()
+    self.byrow = dict()
+
+  def addcell(self, cell):
+    self.cells.append(cell)
+    if cell.rows:
+      self.byrow.setdefault(cell.rows[0], list()).append(cell)
+
+  def addline(self, rows, cells):
+    """Add the cells of one row, given as (column label, text) or
+    (column label, text, footnotes) tuples.  This is how tables that do
+    not come from OXML (see djnative) are built."""
+    if rows[0] not in self.rowitems:
+      self.rowitems.append(rows[0])
+    for c in cells:
+      notes = c[2] if len(c) > 2 else []
+      self.addcell(Cell(c[1], tuple(rows), (c[0],), notes))
+
+  def rowcells(self, row):
+    """all cells below the outer row item with text 'row'"""
+    return self.byrow.get(row, [])
+
+  def find(self, row=None, col=None):
+    """Return the cells that have 'row' among their row labels and
+    'col' among their column labels; None matches anything"""
+    if row is not None and row in self.byrow:
+      cells = self.byrow[row]
+    else:
+      cells = self.cells
+    return [ c for c in cells
+             if (row is None or row in c.rows) and (col is None or col in c.cols) ]
+
+
+def quoteattr(text):
+  """text as a quoted attribute value, like xml.sax.saxutils.quoteattr,
+  which takes longer to import than all of djoxml"""
+  for (char, entity) in (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'),
+                         ('\n', '&#10;'), ('\r', '&#13;'), ('\t', '&#9;')):
+    text = text.replace(char, entity)
+  return '"%s"' % text
+
+
+def labeltree(cells, labels):
+  """Arrange cells in a tree on their labels (rows or cols), in order of
+  appearance: a list of (label, children) pairs, where children are more
+  pairs or cells"""
+  root = list()
+  for cell in cells:
+    node = root
+    for label in labels(cell):
+      for item in node:
+        if isinstance(item, tuple) and item[0] == label:
+          children = item[1]
+          break
+      else:
+        children = list()
+        node.append((label, children))
+      node = children
+    node.append(cell)
+  return root
+
+
+def writenodes(res, nodes, axis):
+  """append the OXML of a labeltree to res; the cells of the row axis
+  get a column dimension of their own"""
+  cells = [ n for n in nodes if isinstance(n, Cell) ]
+  if cells and axis == 'row':
+    res.append('<dimension axis="column" text="Statistics">')
+    writenodes(res, labeltree(cells, lambda cell: cell.cols), 'column')
+    res.append('</dimension>')
+  elif cells:
+    for cell in cells:
+      notes = ''.join([ '<note text=%s/>' % quoteattr(n) for n in cell.footnotes ])
+      if notes:
+        notes = '<footnote>%s</footnote>' % notes
+      res.append('<cell text=%s>%s</cell>' % (quoteattr(cell.text or ''), notes))
+  for node in nodes:
+    if isinstance(node, Cell):
+      continue
+    (label, children) = node
+    tag = 'category' if [ n for n in children if isinstance(n, Cell) ] else 'group'
+    res.append('<%s text=%s>' % (tag, quoteattr(label)))
+    writenodes(res, children, axis)
+    res.append('</%s>' % tag)
+
+
+class OutputTree(object):
+  """The parsed OXML output of one model"""
+
+  def __init__(self, xmltext=None):
+    self.pivots = dict()   # subtype -> list of PivotTable, in document order
+    self.commands = list() # (command, text) for every command element
+    self.dfs = None        # the df approximation of a native fit, see djdf
+    if xmltext is None:
+      return
+    if isinstance(xmltext, unicode):
+      # ElementTree wants bytes, and the declaration would claim utf-16
+      xmltext = re_declaration.sub('', xmltext).encode('utf-8')
+    root = ElementTree.fromstring(xmltext)
+    self.walk(root)
+
+  def walk(self, elem):
+    for child in elem:
+      tag = localname(child.tag)
+      if tag == 'pivotTable':
+        pivot = PivotTable(child.get('subType'))
+        self.walkpivot(pivot, child, None, (), (), True)
+        self.addpivot(pivot)
+      else:
+        if tag == 'command':
+          self.commands.append((child.get('command'), child.get('text')))
+        self.walk(child)
+
+  def walkpivot(self, pivot, elem, axis, rows, cols, outer):
+    for child in elem:
+      tag = localname(child.tag)
+      if tag == 'dimension':
+        # only the row dimension directly below pivotTable lists the row items
+        isouter = outer and child.get('axis') == 'row'
+        self.walkpivot(pivot, child, child.get('axis'), rows, cols, isouter)
+      elif tag in ('category', 'group'):
+        text = child.get('text')
+        if outer:
+          pivot.rowitems.append(text)
+        if axis == 'row':
+          self.walkpivot(pivot, child, axis, rows + (text,), cols, False)
+        else:
+          self.walkpivot(pivot, child, axis, rows, cols + (text,), False)
+      elif tag == 'cell':
+        notes = [ note.get('text', '') for note in child.getiterator()
+                  if localname(note.tag) == 'note' ]
+        pivot.addcell(Cell(child.get('text'), rows, cols, notes))
+
+  def addpivot(self, pivot):
+    self.pivots.setdefault(pivot.subtype, list()).append(pivot)
+    return pivot
+
+  def tables(self, subtype):
+    return self.pivots.get(subtype, [])
+
+  def texts(self, subtype, row=None, col=None):
+    """Return the texts of the matching cells of all pivot tables of this
+    subtype, see PivotTable.find"""
+    res = list()
+    for pivot in self.tables(subtype):
+      res.extend([ c.text for c in pivot.find(row, col) ])
+    return res
+
+  def rowitems(self, subtype):
+    res = list()
+    for pivot in self.tables(subtype):
+      res.extend(pivot.rowitems)
+    return res
+
+  def rowcells(self, subtype, row):
+    res = list()
+    for pivot in self.tables(subtype):
+      res.extend(pivot.rowcells(row))
+    return res
+
+  def commandcount(self, command):
+    return len([ c for c in self.commands if c[0] == command ])
+
+  def toxml(self):
+    """Return the tree as OXML text, as OMS would write it, so that a
+    tree that did not come from SPSS (see djnative) can be replayed
+    (see replay/spss.py).  All pivot tables go under the first command."""
+    (command, text) = self.commands[0] if self.commands else ('Mixed', 'Mixed Model Analysis')
+    res = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<outputTree xmlns="http://xml.spss.com/spss/oms">',
+           '<command command=%s text=%s>' % (quoteattr(command), quoteattr(text))]
+    for (subtype, pivots) in self.pivots.items():
+      for pivot in pivots:
+        res.append('<pivotTable subType=%s text=%s>' % (quoteattr(subtype), quoteattr(subtype)))
+        res.append('<dimension axis="row" text="Rows">')
+        writenodes(res, labeltree(pivot.cells, lambda cell: cell.rows), 'row')
+        res.append('</dimension>')
+        res.append('</pivotTable>')
+    res.append('</command>')
+    res.append('</outputTree>')
+    return u'\n'.join(res)
+
+  def summary(self, subtypes):
+    """Return a copy of this tree with only the pivot tables of these
+    subtypes (and the commands)"""
+    res = OutputTree()
+    res.commands = list(self.commands)
+    res.dfs = getattr(self, 'dfs', None)
+    for subtype in subtypes:
+      if subtype in self.pivots:
+        res.pivots[subtype] = self.pivots[subtype]
+    return res
+
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,329 @@
+# djparallel.py
+#
+# Fitting many independent models at the same time with the native
+# backend (djnative), one model per worker process.
+#
+# The data columns are copied once into shared memory (RawArray) and
+# handed to the workers when the pool starts, so a worker never gets its
+# own copy of the data and a spec is all that travels per model.  Only
+# the output tree of a fit travels back.
+#
+# On Windows multiprocessing starts a worker as a new interpreter, from
+# sys.executable.  Within SPSS that is stats.exe, which would start
+# another SPSS, so the python.exe that comes with SPSS is used instead,
+# and where there is none the models are fitted one after the other in
+# this process (see canspawn).
+#
+# $Revision$
+
+import multiprocessing, multiprocessing.sharedctypes
+import os, sys, traceback
+
+import numpy
+import djnative, djregistry, djdata
+from djterms import modelvariables
+
+
+# the columns of a worker, set by initworker
+workercolumns = None
+
+
+def codedcolumn(values):
+  """values that are not all numbers (None is missing) as a
+  djdata.CodedColumn; strings stay strings, so '007' and '7' differ"""
+  values = numpy.array(list(values), dtype=object)
+  coder = djdata.Coder()
+  codes = coder.code(values, numpy.array([ x is None for x in values ], dtype=bool))
+  return coder.column([codes])
+
+
+def sharecolumns(columns, variables):
+  """Return a dictionary with the columns in 'variables': numeric
+  columns in shared memory, with None as NaN, coded columns
+  (djdata.CodedColumn, and any column with strings, see codedcolumn)
+  as their levels and their codes in shared memory"""
+  res = dict()
+  for v in variables:
+    col = djnative.getcolumn(columns, v)
+    values = None
+    if not hasattr(col, 'codes'):
+      if isinstance(col, numpy.ndarray) and col.dtype.kind in 'fiub':
+        values = col.astype(float)
+      elif not [ x for x in col if isinstance(x, basestring) ]:
+        try:
+          values = numpy.array([ numpy.nan if x is None else x for x in col ], dtype=float)
+        except (TypeError, ValueError):
+          pass
+      if values is None:
+        col = codedcolumn(col)
+    if values is None:
+      shared = multiprocessing.sharedctypes.RawArray('i', len(col.codes))
+      numpy.frombuffer(shared, dtype=numpy.int32)[:] = col.codes
+      res[v] = (col.levels, shared)
+    else:
+      shared = multiprocessing.sharedctypes.RawArray('d', len(values))
+      numpy.frombuffer(shared)[:] = values
+      res[v] = shared
+  return res
+
+
+def canspawn():
+  """Whether worker processes can be started.  On Windows the workers
+  are started from the python.exe next to the interpreter when that is
+  not python.exe itself (but stats.exe of SPSS), see the top of this
+  file."""
+  if sys.platform != 'win32':
+    return True
+  if os.path.basename(sys.executable).lower() in ('python.exe', 'pythonw.exe'):
+    return True
+  for directory in (sys.exec_prefix, os.path.dirname(sys.executable)):
+    executable = os.path.join(directory, 'python.exe')
+    if os.path.isfile(executable):
+      multiprocessing.set_executable(executable)
+      return True
+  return False
+
+
+def imapworkers(function, items, processes, initializer, initargs, chunksize=1):
+  """function over items in a pool of 'processes' worker processes set
+  up by initializer(*initargs), the results in any order.  Without a
+  pool (one process, or see canspawn) it all runs in this process."""
+  if processes < 2 or not canspawn():
+    initializer(*initargs)
+    for item in items:
+      yield function(item)
+    return
+  pool = multiprocessing.Pool(processes, initializer=initializer, initargs=initargs)
+  try:
+    for result in pool.imap_unordered(function, items, chunksize):
+      yield result
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+
+def initworker(shared):
+  global workercolumns
+  workercolumns = dict()
+  for (v, col) in shared.items():
+    if isinstance(col, tuple):
+      workercolumns[v] = djdata.CodedColumn(col[0], numpy.frombuffer(col[1], dtype=numpy.int32))
+    else:
+      workercolumns[v] = numpy.frombuffer(col)
+
+
+def subsetcolumns(columns, subset):
+  """the rows where every variable in subset has the given value"""
+  keep = None
+  for (v, value) in subset.items():
+    match = numpy.asarray(djnative.getcolumn(columns, v)) == value
+    keep = match if keep is None else keep & match
+  return dict([ (v, col.subset(keep) if hasattr(col, 'subset') else numpy.asarray(col)[keep])
+                for (v, col) in columns.items() ])
+
+
+specarguments = "dv predictors pps items modeltype method randomslopes slopecov dfmethod".split()
+
+def fitone(spec):
+  """Fit one model spec in a worker, return (name, output, error)"""
+  try:
+    columns = workercolumns
+    if spec.get('subset'):
+      columns = subsetcolumns(columns, spec['subset'])
+    args = dict([ (k, spec[k]) for k in specarguments if k in spec ])
+    model = djnative.fitmixedmodel(columns, **args)
+    return (spec['name'], model.output, None)
+  except Exception:
+    return (spec.get('name'), None, traceback.format_exc())
+
+
+def specvariables(specs):
+  res = set()
+  for spec in specs:
+    res.update(modelvariables(spec['dv'], spec.get('predictors'), spec.get('pps'),
+                              spec.get('items'), spec.get('randomslopes')))
+    res.update((spec.get('subset') or {}).keys())
+  return sorted(res)
+
+
+def fitmodels(columns, specs, processes=None, registry=None):
+  """Fit the model specs in parallel on 'columns' and register every
+  output tree under its name in 'registry' (a djregistry.ModelRegistry,
+  a new one if not given), which is returned.
+
+  A spec is a dictionary with 'name' and the arguments of
+  djnative.fitmixedmodel (dv, predictors, pps, items, modeltype,
+  method), and optionally 'subset', a dictionary from variable to value
+  that restricts the fit to the matching rows.  Models that fail are
+  listed in the 'errors' attribute of the registry, name -> traceback."""
+  if registry is None:
+    registry = djregistry.ModelRegistry()
+  if not hasattr(registry, 'errors'):
+    registry.errors = dict()
+  names = [ spec.get('name') for spec in specs ]
+  if None in names or len(set(names)) != len(names):
+    raise ValueError("Every model spec needs a name of its own")
+  shared = sharecolumns(columns, specvariables(specs))
+  processes = min(processes or multiprocessing.cpu_count(), len(specs)) or 1
+  for (name, output, error) in imapworkers(fitone, specs, processes, initworker, (shared,)):
+    if error is None:
+      registry.register(name, output)
+    else:
+      registry.errors[name] = error
+  return registry
+
+
+
+def completecases(columns, variables):
+  """the columns, restricted to the rows without missing values in any
+  of the variables, so that several models are fitted on the same rows"""
+  raw = [ djnative.getcolumn(columns, v) for v in variables ]
+  keep = ~numpy.any([ djnative.missingmask(col) for col in raw ], axis=0)
+  return dict([ (v, djnative.subsetrows(col, keep)) for (v, col) in zip(variables, raw) ])
+
+
+class BootstrapResult(object):
+  """The outcome of parametricbootstrap: the observed LRT statistic, the
+  statistic of every replicate, and whether both refits converged"""
+
+  def __init__(self, observed, statistics, converged):
+    self.observed = observed
+    self.statistics = statistics
+    self.converged = converged
+    self.nsim = len(statistics)
+    self.nfailed = int((~converged).sum())
+    # replicates at least as extreme, counting the observed data as one
+    valid = statistics[converged]
+    self.exceed = int((valid >= observed - 1e-8 * abs(observed)).sum())
+    self.pvalue = (self.exceed + 1.0) / (len(valid) + 1.0)
+    self.mcerror = numpy.sqrt(self.pvalue * (1 - self.pvalue) / max(len(valid), 1))
+
+
+# the null and alternative model of a bootstrap worker, set by initbootstrap
+bootstrapmodels = None
+
+
+def initbootstrap(shared, nullspec, altspec, null, alt, seed):
+  """Set up a bootstrap worker: the models are built on the shared
+  columns (without fitting), the estimates come from the parent, as
+  (beta, phi, theta) of null and the start values of alt"""
+  global bootstrapmodels
+  initworker(shared)
+  models = list()
+  for spec in (nullspec, altspec):
+    args = dict([ (k, spec[k]) for k in specarguments if k in spec ])
+    models.append(djnative.NativeModel(workercolumns, estimate=False, **args))
+  bootstrapmodels = (models[0], models[1], null, alt, seed)
+
+
+def bootstrapreplicate(replicate):
+  """Simulate from the null model and refit both models, warm started
+  at their estimates; return (replicate, LRT statistic, converged)"""
+  (nullmodel, altmodel, (beta, phi, nulltheta), altstarts, seed) = bootstrapmodels
+  # the seed of a replicate only depends on its number
+  randomstate = numpy.random.RandomState([seed, replicate])
+  y = nullmodel.simulate(randomstate, beta, phi)
+  (d0, theta0, c0) = nullmodel.responsedeviance(y, nulltheta)
+  # the deviance is flat near the boundary, so the alternative is fitted
+  # from its own estimates and from the null estimates, the best one wins
+  fits = [ altmodel.responsedeviance(y, start) for start in altstarts ]
+  (d1, theta1, c1) = min(fits, key=lambda fit: fit[0])
+  # the alternative contains the null model, less is rounding
+  return (replicate, max(d0 - d1, 0.0), c0 and c1)
+
+
+def embedtheta(null, alt):
+  """the theta of null as a start for alt: zero for the random factors
+  and slopes that are not in null.  A random term of null is either the
+  same as that of alt or only its intercept."""
+  if not alt.terms:
+    return numpy.zeros(0)
+  res = numpy.zeros(alt.cp.random.ntheta)
+  offsets = alt.cp.random.thetaoffsets
+  for (k, term) in enumerate(alt.terms):
+    for (nullterm, theta) in zip(null.terms, null.splitterms(null.theta)):
+      if nullterm.subject.name != term.subject.name:
+        continue
+      if nullterm.d == 1:
+        res[offsets[k]] = theta[0]
+      else:
+        res[offsets[k]:offsets[k+1]] = theta
+  return res
+
+
+def nestedterms(null, alt):
+  """whether the random terms of null are in alt: the same subject
+  variables, and per subject the same random effects or only the
+  intercept"""
+  altterms = dict([ (t.subject.name, t) for t in alt.terms ])
+  for t in null.terms:
+    other = altterms.get(t.subject.name)
+    if other is None:
+      return False
+    if t.d > 1 and ([ f.name for f in t.slopes ], t.covtype) != \
+                   ([ f.name for f in other.slopes ], other.covtype):
+      return False
+  return True
+
+
+def fixedterms(model):
+  """the fixed terms of a model as a set, with a * b the same as b * a"""
+  return frozenset([ frozenset(term) for term in model.design.terms ])
+
+
+def nestedmodels(null, alt):
+  """raise a NativeError unless null is nested in alt: its random and
+  fixed terms are in alt, and with REML (for both, or the likelihoods
+  do not compare) the fixed terms are the same"""
+  if not nestedterms(null, alt):
+    raise djnative.NativeError("The random effects of the null model are not all in the "
+                               "alternative")
+  if not fixedterms(null) <= fixedterms(alt):
+    raise djnative.NativeError("The fixed effects of the null model are not all in the alternative")
+  if null.reml != alt.reml:
+    raise djnative.NativeError("One model is fitted by REML and the other by ML")
+  if null.reml and fixedterms(null) != fixedterms(alt):
+    raise djnative.NativeError("REML likelihoods only compare models with the same fixed "
+                               "effects, fit both models with METHOD=ML")
+
+
+def parametricbootstrap(columns, nullspec, altspec, nsim, processes=None, seed=0):
+  """Parametric bootstrap of the LRT of the null model against the
+  alternative model that contains it: simulate 'nsim' responses from the
+  fitted null model and refit both models on each, spread over a pool
+  of 'processes' workers.  Specs are as for fitmodels (without subset).
+  Replicate i always uses the same random numbers for a given seed, so
+  the result does not depend on the number of processes.  The models
+  must be nested, see nestedmodels.  Returns a BootstrapResult."""
+  variables = sorted(set(specvariables([nullspec]) + specvariables([altspec])))
+  columns = completecases(columns, variables)
+  models = list()
+  for spec in (nullspec, altspec):
+    args = dict([ (k, spec[k]) for k in specarguments if k in spec ])
+    models.append(djnative.NativeModel(columns, estimate=False, **args))
+  (null, alt) = models
+  nestedmodels(null, alt)
+  null.fit()
+  alt.fit()
+  observed = null.m2ll - alt.m2ll
+
+  shared = sharecolumns(columns, variables)
+  altstarts = (alt.theta, embedtheta(null, alt))
+  initargs = (shared, nullspec, altspec, (null.beta, null.phi, null.theta), altstarts, seed)
+  processes = min(processes or multiprocessing.cpu_count(), nsim) or 1
+  statistics = numpy.zeros(nsim)
+  converged = numpy.zeros(nsim, dtype=bool)
+  chunksize = max(1, nsim // (4 * processes))
+  for (replicate, statistic, ok) in imapworkers(bootstrapreplicate, range(nsim), processes,
+                                                initbootstrap, initargs, chunksize):
+    statistics[replicate] = statistic
+    converged[replicate] = ok
+  return BootstrapResult(observed, statistics, converged)
+
+
+
+if __name__ == '__main__':
+  pass
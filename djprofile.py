@@ -0,0 +1,183 @@
+# djprofile.py
+#
+# Where does the time of a DJMIXED job go?  When profiling is on, every
+# call of the spss functions that talk to SPSS (Submit, GetXmlUtf16,
+# EvaluateXPath, StartProcedure, EndProcedure, building a pivot table)
+# is timed and counted, and so are the stages of mixedmodel (see
+# djmixedcore): the OUTPUT juggling for split output, the OMS capture,
+# the MIXED fit, the check of the output in stopmodel and the summary
+# tables.  Everything is kept per DJMIXED subcommand and model name.
+#
+# Profiling is switched on with DJMIXED /PROFILE STATE=ON, or for a
+# whole job with the environment variable DJMIXED_PROFILE (its value is
+# the trace file, or 1 for the default).  The trace file is JSON and is
+# rewritten after every DJMIXED command, so a batch job always leaves
+# one behind; /PROFILE STATE=REPORT (or OFF) shows the summary table.
+#
+# $Revision$
+
+import os, time
+
+
+TRACEFILE = os.path.join(os.path.expanduser('~'), '.djmixed', 'profile.json')
+# the trace keeps at most this many single calls, the totals are always complete
+MAXEVENTS = 100000
+# the functions of spss that are timed; BasePivotTable.SimplePivotTable
+# is the pivot table build
+SPSSCALLS = ['Submit', 'GetXmlUtf16', 'EvaluateXPath', 'StartProcedure', 'EndProcedure']
+
+
+class Profiler(object):
+  """Totals and a trace of timed calls, per (subcommand, model)"""
+
+  def __init__(self):
+    self.enabled = False
+    self.tracefile = None
+    self.subcommand = ''
+    self.model = ''
+    self.started = None
+    self.totals = dict()   # (subcommand, model, call) -> [count, seconds]
+    self.events = list()   # (subcommand, model, call, start, seconds)
+    self.patched = list()  # (object, attribute, original) to undo install
+
+  def reset(self):
+    self.started = time.time()
+    self.totals = dict()
+    self.events = list()
+
+  def add(self, call, start, seconds):
+    key = (self.subcommand, self.model, call)
+    total = self.totals.get(key)
+    if total is None:
+      total = self.totals[key] = [0, 0.0]
+    total[0] += 1
+    total[1] += seconds
+    if len(self.events) < MAXEVENTS:
+      self.events.append((self.subcommand, self.model, call, start - self.started, seconds))
+
+  def call(self, name, function, *args, **kwds):
+    """call function, timed under name when profiling is on"""
+    if not self.enabled:
+      return function(*args, **kwds)
+    start = time.time()
+    try:
+      return function(*args, **kwds)
+    finally:
+      self.add(name, start, time.time() - start)
+
+  def timed(self, name, function):
+    """function, wrapped to be timed under name"""
+    def wrapper(*args, **kwds):
+      return self.call(name, function, *args, **kwds)
+    wrapper.__name__ = getattr(function, '__name__', name)
+    wrapper.__doc__ = getattr(function, '__doc__', None)
+    return wrapper
+
+  def install(self, spss):
+    """Time the calls in SPSSCALLS of module spss from now on"""
+    if self.patched:
+      return
+    for name in SPSSCALLS:
+      if hasattr(spss, name):
+        self.patch(spss, name, 'spss.' + name)
+    if hasattr(spss, 'BasePivotTable'):
+      self.patch(spss.BasePivotTable, 'SimplePivotTable', 'spss.BasePivotTable.SimplePivotTable')
+
+  def patch(self, owner, attribute, name):
+    # None if inherited, then the wrapper is simply deleted again
+    original = owner.__dict__.get(attribute)
+    self.patched.append((owner, attribute, original))
+    setattr(owner, attribute, self.timed(name, getattr(owner, attribute)))
+
+  def uninstall(self):
+    for (owner, attribute, original) in reversed(self.patched):
+      if original is None:
+        delattr(owner, attribute)
+      else:
+        setattr(owner, attribute, original)
+    self.patched = list()
+
+  def summary(self):
+    """(subcommand, model, call, count, seconds), in the order the calls
+    first finished"""
+    first = dict()
+    for (i, event) in enumerate(self.events):
+      first.setdefault(event[:3], i)
+    keys = sorted(self.totals, key=lambda k: (first.get(k, len(self.events)), k))
+    return [ key + tuple(self.totals[key]) for key in keys ]
+
+  def writetrace(self, filename=None):
+    try:
+      import json
+    except ImportError:
+      import simplejson as json
+    filename = filename or self.tracefile or TRACEFILE
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    fields = ['subcommand', 'model', 'call', 'count', 'seconds']
+    trace = dict(pid=os.getpid(), started=self.started,
+                 summary=[ dict(zip(fields, line)) for line in self.summary() ],
+                 events=[ dict(zip(['subcommand', 'model', 'call', 'start', 'seconds'], e))
+                          for e in self.events ],
+                 truncated=len(self.events) >= MAXEVENTS)
+    stream = open(filename, 'w')
+    try:
+      json.dump(trace, stream, indent=0)
+    finally:
+      stream.close()
+    return filename
+
+
+profiler = Profiler()
+
+
+def enable(spss, tracefile=None):
+  """start profiling, afresh"""
+  profiler.tracefile = tracefile
+  profiler.reset()
+  profiler.install(spss)
+  profiler.enabled = True
+
+
+def disable():
+  profiler.enabled = False
+  profiler.uninstall()
+
+
+def call(name, function, *args, **kwds):
+  return profiler.call(name, function, *args, **kwds)
+
+
+def setmodel(name):
+  profiler.model = name or ''
+
+
+def begincommand(subcommand):
+  profiler.subcommand = subcommand
+  profiler.model = ''
+
+
+def endcommand():
+  """the end of a DJMIXED command: bring the trace file up to date"""
+  if profiler.enabled:
+    try:
+      profiler.writetrace()
+    except (IOError, OSError), v:
+      print "Could not write the DJMIXED profile trace: %s" % v
+  profiler.subcommand = profiler.model = ''
+
+
+def fromenvironment(spss):
+  """switch profiling on if DJMIXED_PROFILE says so"""
+  value = os.environ.get('DJMIXED_PROFILE', '')
+  if value.lower() in ('', '0', 'no', 'off'):
+    return
+  if value.lower() in ('1', 'yes', 'on'):
+    value = None
+  enable(spss, value)
+
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,169 @@
+# djregistry.py
+#
+# A registry of fitted models by name.
+#
+# A model fitted by SPSS has its full OXML output in the xml workspace
+# of SPSS under a handle with the name of the model, and these add up in
+# a long session.  The registry keeps the handles of only the most
+# recently used models; the handle of an older model is released, but
+# not before the tables we need from it (SUMMARYTYPES) are copied into
+# its output tree, so summaries and comparisons keep working on it.  A
+# model fitted by the native backend (djnative) never had a handle, it
+# only has its output tree.
+#
+# Results of a parallel sweep (see djparallel) arrive in a result
+# handler thread, so every access goes through a lock.
+#
+# $Revision$
+
+import threading
+
+
+# the pivot tables djmixedcore reads from a model, see OutputTree.summary
+SUMMARYTYPES = ['Model Dimension', 'Information Criteria', 'Warnings',
+                'Tests of Fixed Effects', 'Parameter Estimates',
+                'Covariance Parameter Estimates',
+                # djcontrast.COVBTYPE, for contrasts without fitting again
+                'Covariance Matrix for Estimates of Fixed Effects']
+
+
+class ModelRegistry(object):
+  """Thread-safe mapping from model name to the output tree of the
+  model (see djoxml.OutputTree), that keeps at most 'maxhandles' (None
+  is no limit) handles in the xml workspace.
+
+  'load' is called with a name to get the output tree of a handle,
+  'release' to delete a handle from the workspace."""
+
+  def __init__(self, maxhandles=None, load=None, release=None):
+    self.lock = threading.RLock()
+    self.maxhandles = maxhandles
+    self.load = load
+    self.release = release
+    self.outputs = dict()  # name -> output tree, full or summary
+    self.order = list()    # names in order of registration
+    self.handles = list()  # names with a handle, least recently used first
+    self.current = None    # the model between startmodel and stopmodel
+    self.specs = dict()    # name -> arguments the model was fitted with, if known
+
+  def register(self, name, output):
+    """register the output tree of a model without a handle"""
+    self.lock.acquire()
+    try:
+      self.remove(name)
+      self.outputs[name] = output
+      self.order.append(name)
+    finally:
+      self.lock.release()
+
+  def addhandle(self, name):
+    """register a model whose output is (or will be) in the workspace
+    under handle 'name'"""
+    self.lock.acquire()
+    try:
+      self.remove(name)
+      self.handles.append(name)
+      self.order.append(name)
+      self.evict()
+    finally:
+      self.lock.release()
+
+  def setspec(self, name, spec):
+    """remember how a model was specified (dv, predictors, ...), so it
+    can be fitted again, as in a bootstrap"""
+    self.lock.acquire()
+    try:
+      self.specs[name] = spec
+    finally:
+      self.lock.release()
+
+  def spec(self, name):
+    return self.specs.get(name)
+
+  def hashandle(self, name):
+    return name in self.handles
+
+  def get(self, name):
+    """Return the output tree of a model, loading it from the workspace
+    the first time, and mark the model as recently used"""
+    self.lock.acquire()
+    try:
+      if name in self.handles:
+        if not name in self.outputs:
+          self.outputs[name] = self.load(name)
+        self.handles.remove(name)
+        self.handles.append(name)
+        self.evict()
+      return self.outputs[name]
+    finally:
+      self.lock.release()
+
+  def evict(self):
+    """Release the least recently used handles beyond maxhandles, after
+    keeping the summary of their output"""
+    if self.maxhandles is None:
+      return
+    candidates = [ h for h in self.handles if h != self.current ]
+    while len(self.handles) > self.maxhandles and candidates:
+      name = candidates.pop(0)
+      try:
+        output = self.outputs.get(name) or self.load(name)
+        self.outputs[name] = output.summary(SUMMARYTYPES)
+      except Exception:
+        # a handle without usable output, nothing to keep
+        pass
+      self.release(name)
+      self.handles.remove(name)
+
+  def remove(self, name):
+    """drop a model, releasing its handle; returns whether it had one"""
+    self.lock.acquire()
+    try:
+      hadhandle = name in self.handles
+      if hadhandle:
+        self.release(name)
+        self.handles.remove(name)
+      if name in self.order:
+        self.order.remove(name)
+      self.outputs.pop(name, None)
+      self.specs.pop(name, None)
+      if self.current == name:
+        self.current = None
+      return hadhandle
+    finally:
+      self.lock.release()
+
+  def clear(self):
+    self.lock.acquire()
+    try:
+      for name in self.handles:
+        self.release(name)
+      self.handles = list()
+      self.order = list()
+      self.outputs.clear()
+      self.specs.clear()
+      self.current = None
+    finally:
+      self.lock.release()
+
+  def names(self):
+    self.lock.acquire()
+    try:
+      return list(self.order)
+    finally:
+      self.lock.release()
+
+  def __contains__(self, name):
+    self.lock.acquire()
+    try:
+      return name in self.order
+    finally:
+      self.lock.release()
+
+  def __len__(self):
+    return len(self.order)
+
+
+
+if __name__ == '__main__':
+  pass
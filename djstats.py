@@ -13,29 +13,48 @@
 # $Revision$
 #
 # Being lazy, I only wrap those function that I need
-# which is currently ONE
+# which are currently pchisq, pf, qt and pnorm, and a chi-square mixture
+# (pchibarsq) on top.
+#
+# The cephes functions are numpy ufuncs, so value and df can be arrays
+# (or lists) as well as numbers and are then evaluated in one call,
+# with the usual numpy broadcasting.
 
 
 import sys, os
 
-try:
-  import _cephes as cephes
-except ImportError:
-  """when unpacking an extension bundle, spss leaves non-python files in a directory with the 
-  name of the bundle. so we temporarily add that name and then reload.  sigh """
-  newdirs = [os.path.join(x, 'djmixed') for x in sys.path if 'SPSSInc' in x ]
-  # TODO this only works when code is placed under SPSS, obviously
-  sys.path.extend(newdirs)
+
+# the cephes module, found on first use by loadcephes: numpy and scipy
+# take longer to import than all of djmixed, and most jobs never compute
+# a p-value
+cephes = None
+
+def loadcephes():
+  global cephes
   try:
-    import _cephes as cephes
-    sys.path[-(len(newdirs)):] = []
+    import _cephes as module
   except ImportError:
-      """ if all fails, we see if scipy is present """
-      sys.path[-(len(newdirs)):] = []
-      try:
-        import scipy.special._cephes as cephes
-      except ImportError:
-        raise ImportError("Could not find the _cephes.pyd library (or equivalent)")
+    """when unpacking an extension bundle, spss leaves non-python files in a directory with the 
+    name of the bundle. so we temporarily add that name and then reload.  sigh """
+    newdirs = [os.path.join(x, 'djmixed') for x in sys.path if 'SPSSInc' in x ]
+    # TODO this only works when code is placed under SPSS, obviously
+    sys.path.extend(newdirs)
+    try:
+      import _cephes as module
+      sys.path[len(sys.path) - len(newdirs):] = []
+    except ImportError:
+        """ if all fails, we see if scipy is present """
+        sys.path[len(sys.path) - len(newdirs):] = []
+        try:
+          import scipy.special._cephes as module
+        except ImportError:
+          try:
+            # newer scipy has no _cephes, but exports the same functions
+            import scipy.special as module
+          except ImportError:
+            raise ImportError("Could not find the _cephes.pyd library (or equivalent)")
+  cephes = module
+  return cephes
 
 
 
@@ -48,9 +67,59 @@ except ImportError:
 
 def pchisq(value, df, lowertail=True):
   if lowertail:
-    return cephes.chdtr(df, value)
+    return (cephes or loadcephes()).chdtr(df, value)
+  else:
+    return (cephes or loadcephes()).chdtrc(df, value)
+
+
+#####  pchibarsq(value, weights, dfs)  -> probability
+# the chi-bar-square distribution: a mixture of chi-square
+# distributions with weights[i] on dfs[i] degrees of freedom, where 0 df
+# is a point mass at zero.  This is the null distribution of the LRT
+# for variance components on the boundary of the parameter space (Stram
+# and Lee, 1994; Self and Liang, 1987).  Value can be an array, weights
+# and dfs are sequences of the same length; an element of dfs can be an
+# array as well, one df per value.
+
+def pchibarsq(value, weights, dfs, lowertail=True):
+  import numpy
+  value = numpy.asarray(value, dtype=float)
+  res = numpy.zeros(value.shape)
+  for (weight, df) in zip(weights, dfs):
+    df = numpy.asarray(df, dtype=float)
+    point = (value >= 0) if lowertail else (value <= 0)
+    res = res + weight * numpy.where(df > 0, pchisq(value, numpy.maximum(df, 1), lowertail),
+                                     point)
+  if res.ndim == 0:
+    return float(res)
+  return res
+
+
+#####  pf(value, df1, df2)  -> probability
+# compare to scipy.stats.f.cdf(value, df1, df2), R: pf(value, df1, df2)
+
+def pf(value, df1, df2, lowertail=True):
+  if lowertail:
+    return (cephes or loadcephes()).fdtr(df1, df2, value)
+  else:
+    return (cephes or loadcephes()).fdtrc(df1, df2, value)
+
+
+#####  qt(p, df)  -> quantile
+# compare to scipy.stats.t.ppf(p, df), R: qt(p, df)
+
+def qt(p, df):
+  return (cephes or loadcephes()).stdtrit(df, p)
+
+
+#####  pnorm(value)  -> probability
+# compare to scipy.stats.norm.cdf(value), R: pnorm(value)
+
+def pnorm(value, lowertail=True):
+  if lowertail:
+    return (cephes or loadcephes()).ndtr(value)
   else:
-    return cephes.chdtrc(df, value)
+    return (cephes or loadcephes()).ndtr(-value)
 
 
 
@@ -0,0 +1,100 @@
+# djstore.py
+#
+# A store on disk for the results of SPSS fits, so that running the same
+# syntax file again does not refit the models it fitted last time.
+#
+# The key of a result is the sha1 of the MIXED command that produced it
+# and of the data it was fitted on (see datafingerprint), which is read
+# in chunks so that it never needs more memory than a chunk.  The result is
+# the summary of the output tree of the model (see djregistry), pickled
+# into one file per key.  Files are written under a temporary name and
+# then renamed, so a reader never sees half a file, and a file that
+# cannot be read is treated as a miss.
+#
+# $Revision$
+
+import os, hashlib
+# tempfile and cPickle are imported when a result is read or written
+
+
+# bump when the pickled output trees change shape, old files are then
+# ignored: 2 added the COVB table (djcontrast) and OutputTree.dfs (djdf)
+STOREVERSION = 2
+
+
+def datafingerprint(chunks, extra=()):
+  """sha1 hex digest of the data in 'chunks', each a mapping from
+  variable name to a numpy array (float, or object for strings), as
+  djmixedcore.activechunks gives them, with the variables of a chunk
+  taken in sorted order of name; and of the strings in extra"""
+  digest = hashlib.sha1()
+  for chunk in chunks:
+    for v in sorted(chunk):
+      col = chunk[v]
+      digest.update('%s\0%d\0' % (v.lower(), len(col)))
+      if col.dtype == object:
+        digest.update('\0'.join([ repr(x) for x in col ]))
+      else:
+        digest.update(col.tobytes())
+  for e in extra:
+    digest.update('\0%s' % (e,))
+  return digest.hexdigest()
+
+
+class ResultStore(object):
+  """A directory with one pickled output tree per key"""
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def key(self, cmd, fingerprint):
+    if isinstance(cmd, unicode):
+      cmd = cmd.encode('utf-8')
+    return hashlib.sha1('%d\0%s\0%s' % (STOREVERSION, cmd, fingerprint)).hexdigest()
+
+  def path(self, key):
+    return os.path.join(self.directory, key[:2], key + '.pickle')
+
+  def get(self, key):
+    """the output tree stored under key, or None"""
+    import cPickle as pickle
+    try:
+      stream = open(self.path(key), 'rb')
+    except IOError:
+      return None
+    try:
+      try:
+        return pickle.load(stream)
+      except Exception:
+        return None
+    finally:
+      stream.close()
+
+  def put(self, key, output):
+    import tempfile
+    import cPickle as pickle
+    path = self.path(key)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    (fd, tmppath) = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    stream = os.fdopen(fd, 'wb')
+    try:
+      pickle.dump(output, stream, pickle.HIGHEST_PROTOCOL)
+    finally:
+      stream.close()
+    if os.path.exists(path):
+      # windows will not rename onto an existing file
+      os.remove(path)
+    os.rename(tmppath, path)
+
+  def remove(self, key):
+    try:
+      os.remove(self.path(key))
+    except OSError:
+      pass
+
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,99 @@
+# djterms.py
+#
+# Handling of the fixed terms of a model, shared by the syntax builder in
+# djmixedcore and the native fitter in djnative.  Nothing in here needs
+# spss, so the native fitter can run on machines without it.
+#
+# $Revision$
+
+
+def fullfactorial(preds):
+  """return a list with all n-way interactions added, input and output
+  are space separated strings"""
+  def innerff(plist):
+    if len(plist)==1:
+      return plist
+    else:
+      assert(len(plist)>0)
+      restff = innerff(plist[1:])
+      me = plist[0]
+      res = [me]
+      for p in restff:
+        res.append(p)
+        res.append(me+"*"+p)
+      return res
+  predlist = preds.split()
+  return ' '.join(innerff(predlist))
+
+
+def reparsepredictors(predictors):
+  """Join all interactions into one word (a * b -> a*b) to produce a
+  standardized list of actual predictors; Produce a list of all main
+  effects that are mentioned or involved in interaction terms"""
+  star = '*'
+  predictors = predictors[:]
+  while star in predictors:
+    pos = predictors.index(star)
+    predictors[pos-1:pos+2] = [''.join(predictors[pos-1:pos+2])]
+
+  #mainpredictors = list(set(filter(lambda x: x!=star, predictors)))
+  mainpredictors = set()
+  for p in predictors:
+    if not star in p:
+      mainpredictors.add(p)
+    else:
+      for ppart in p.split(star):
+        mainpredictors.add(ppart)
+  
+  return (' '.join(predictors), 
+          ' '.join(mainpredictors))
+
+
+def fixedterms(predictors):
+  """Split the standardized predictor string of reparsepredictors into
+  a list of terms, each term a tuple of the main predictors it involves
+  in the order given: 'a b a*b' becomes [('a',), ('b',), ('a','b')]"""
+  return [ tuple(t.split('*')) for t in predictors.split() ]
+
+
+def modelvariables(dv, predictors=None, pps=None, items=None, randomslopes=None):
+  """Return the sorted names of all variables a model refers to;
+  predictors as in mixedmodel, a string or a list of strings"""
+  res = set([dv] + [ v for v in (pps, items) if v ])
+  if isinstance(predictors, basestring):
+    predictors = predictors.split()
+  for p in predictors or []:
+    res.update([ v for v in p.split('*') if v and v != 'None' ])
+  for slopes in splitslopes(randomslopes):
+    res.update(slopes)
+  return sorted(res)
+
+
+def splitslopes(randomslopes):
+  """Split the RANDOMSLOPES list into the slopes by participant and the
+  slopes by item: 'a b | a' gives (['a', 'b'], ['a']).  Without a '|'
+  both get the same slopes.  A string is split on white space."""
+  if not randomslopes:
+    return ([], [])
+  if isinstance(randomslopes, basestring):
+    randomslopes = randomslopes.split()
+  if isinstance(randomslopes[0], (list, tuple)):
+    # already split
+    parts = [ list(s) for s in randomslopes ]
+  else:
+    parts = [list()]
+    for s in randomslopes:
+      if s == '|':
+        parts.append(list())
+      else:
+        parts[-1].extend(s.split())
+  if len(parts) == 1:
+    parts = parts * 2
+  if len(parts) != 2:
+    raise ValueError("RANDOMSLOPES takes at most two lists of slopes, separated by '|'")
+  return tuple([ [ s for s in part if s and s != 'None' ] for part in parts ])
+
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,345 @@
+# spss.py -- replay stand-in
+#
+# A pure python stand-in for the spss module of the SPSS python plugin,
+# so that djmixedcore can run (and be profiled) without SPSS.  Put the
+# replay directory in front of sys.path, before importing djmixedcore:
+#
+#   sys.path.insert(0, '.../djmixed/replay')
+#   import spss, djmixedcore
+#   spss.LoadOutputs('captured')         # every captured/<name>.xml is a model
+#   djmixedcore.comparemodels('m1', 'm2')
+#   print spss.procedures[-1].pivots[0].cells
+#
+# Output trees are OXML files as written by djmixedcore.captureoutput
+# (or by OMS with /DESTINATION format=oxml outfile=...).  A file can be
+# loaded as a handle straight away (LoadOutput), or kept aside until the
+# OMS block that would have produced it ends (AddOutput): then
+# mixedmodel itself runs as in SPSS, with the MIXED output coming from
+# the file.
+#
+# Everything that would go to the viewer is kept in 'procedures': one
+# Procedure per StartProcedure with its pivot tables and text blocks.
+# Every Submit is kept in 'submits'.  Data for spss.Cursor and friends
+# come from LoadData.
+#
+# $Revision$
+
+import os, re, codecs, glob
+
+__version__ = 'replay'
+
+OMSNAMESPACE = 'http://xml.spss.com/spss/oms'
+
+
+class errMsg(object):
+  class SpssError(Exception):
+    pass
+
+
+class PyInvokeSpss(object):
+  @staticmethod
+  def IsUTF8mode():
+    return False
+
+
+def GetDefaultPlugInVersion():
+  return 'spss190'
+
+
+########## output trees
+
+handles = dict()    # handle -> OXML text, the xml workspace
+pending = dict()    # handle -> OXML text, for when its OMS block ends
+omsblocks = list()  # xmlworkspace names of the open OMS blocks, innermost last
+submits = list()
+lasterrorlevel = 0
+
+re_workspace = re.compile(r"xmlworkspace\s*=\s*['\"]([^'\"]+)['\"]", re.I)
+re_omsend = re.compile(r"^\s*omsend\b(?:\s+tag\s*=\s*['\"]([^'\"]+)['\"])?", re.I | re.M)
+
+
+def readoxml(filename):
+  stream = codecs.open(filename, 'r', 'utf-8')
+  try:
+    return stream.read()
+  finally:
+    stream.close()
+
+
+def LoadOutput(name, filename):
+  """make the OXML in filename available under handle 'name'"""
+  handles[name] = readoxml(filename)
+
+
+def LoadOutputs(directory):
+  """LoadOutput every <name>.xml in directory; returns the names"""
+  names = list()
+  for filename in sorted(glob.glob(os.path.join(directory, '*.xml'))):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    LoadOutput(name, filename)
+    names.append(name)
+  return names
+
+
+def AddOutput(name, filename):
+  """the OXML in filename appears under handle 'name' when an OMS block
+  with xmlworkspace='name' ends"""
+  pending[name] = readoxml(filename)
+
+
+def Submit(cmd):
+  """Record the commands; OMS and OMSEND are followed to make pending
+  outputs appear under their handles"""
+  if isinstance(cmd, (list, tuple)):
+    cmd = '\n'.join(cmd)
+  submits.append(cmd)
+  # a submitted block can open and close several OMS blocks, in order
+  events = [ (m.start(), 'oms', m.group(1)) for m in re_workspace.finditer(cmd) ]
+  events += [ (m.start(), 'omsend', m.group(1)) for m in re_omsend.finditer(cmd) ]
+  for (position, event, name) in sorted(events):
+    if event == 'oms':
+      omsblocks.append(name)
+    elif name is None:
+      while omsblocks:
+        endoms(omsblocks.pop())
+    elif name in omsblocks:
+      omsblocks.remove(name)
+      endoms(name)
+
+
+def endoms(name):
+  if name in pending:
+    handles[name] = pending.pop(name)
+
+
+def GetLastErrorLevel():
+  return lasterrorlevel
+
+
+def GetHandleList():
+  return handles.keys()
+
+
+def DeleteXPathHandle(handle):
+  if not handle in handles:
+    raise errMsg.SpssError("Invalid handle '%s'" % handle)
+  del handles[handle]
+
+
+def GetXmlUtf16(handle):
+  try:
+    return handles[handle]
+  except KeyError:
+    raise errMsg.SpssError("Invalid handle '%s'" % handle)
+
+
+def EvaluateXPath(handle, context, xpath):
+  """Evaluate xpath (with the oms namespace as prefix 'oms') on every
+  node selected by context, like SPSS: a list of strings"""
+  try:
+    import lxml.etree
+  except ImportError:
+    raise ImportError("EvaluateXPath in the replay spss module needs lxml")
+  text = GetXmlUtf16(handle)
+  text = re.sub(r'^\s*<\?xml[^>]*\?>', '', text).encode('utf-8')
+  root = lxml.etree.fromstring(text).getroottree()
+  namespaces = dict(oms=OMSNAMESPACE)
+  res = list()
+  for node in root.xpath(context, namespaces=namespaces):
+    for item in node.xpath(xpath, namespaces=namespaces):
+      if isinstance(item, basestring):
+        res.append(unicode(item))
+      else:
+        res.append(unicode(lxml.etree.tostring(item)))
+  return res
+
+
+########## viewer output
+
+class Procedure(object):
+  """What one StartProcedure ... EndProcedure put in the viewer"""
+
+  def __init__(self, name):
+    self.name = name
+    self.pivots = list()
+    self.textblocks = list()
+    self.items = list()   # pivots and text blocks in order
+
+  def add(self, item):
+    self.items.append(item)
+    if isinstance(item, BasePivotTable):
+      self.pivots.append(item)
+    else:
+      self.textblocks.append(item)
+
+
+procedures = list()
+current = list()     # the open procedure, if any
+
+
+def StartProcedure(name, omsid=None):
+  if current:
+    raise errMsg.SpssError("StartProcedure within procedure '%s'" % current[0].name)
+  current.append(Procedure(name))
+
+
+def EndProcedure():
+  if not current:
+    raise errMsg.SpssError("EndProcedure without StartProcedure")
+  procedures.append(current.pop())
+
+
+def inprocedure():
+  if not current:
+    raise errMsg.SpssError("Output outside StartProcedure/EndProcedure")
+  return current[0]
+
+
+class TextBlock(object):
+  def __init__(self, name, content, outline=''):
+    self.name = name
+    self.content = content
+    inprocedure().add(self)
+
+
+class FormatSpec(object):
+  Coefficient = 'Coefficient'
+  GeneralStat = 'GeneralStat'
+  Count = 'Count'
+  Percent = 'Percent'
+
+
+class CellText(object):
+  class Number(object):
+    def __init__(self, value, formatspec=None, varIndex=None):
+      self.value = value
+      self.formatspec = formatspec
+    def __repr__(self):
+      return repr(self.value)
+    def __eq__(self, other):
+      return self.value == getattr(other, 'value', other)
+
+  class String(object):
+    def __init__(self, value):
+      self.value = value
+    def __repr__(self):
+      return repr(self.value)
+    def __eq__(self, other):
+      return self.value == getattr(other, 'value', other)
+
+
+class BasePivotTable(object):
+  """A pivot table as a title, the row and column labels and the cells,
+  one list per row"""
+
+  def __init__(self, title, templateName, outline='', isSplit=True, caption=''):
+    self.title = title
+    self.subtype = templateName
+    self.caption = caption
+    self.footnotes = ''
+    self.rowdim = self.coldim = ''
+    self.rowlabels = self.collabels = self.cells = None
+    inprocedure().add(self)
+
+  def SimplePivotTable(self, rowdim='', rowlabels=[], coldim='', collabels=[], cells=None):
+    self.rowdim = rowdim
+    self.coldim = coldim
+    self.rowlabels = list(rowlabels)
+    self.collabels = list(collabels)
+    cells = list(cells or [])
+    if cells and not isinstance(cells[0], (list, tuple)):
+      # a flat list is filled in row by row, like SPSS does
+      width = max(len(self.collabels), 1)
+      cells = [ cells[i:i+width] for i in range(0, len(cells), width) ]
+    self.cells = [ list(row) for row in cells ]
+
+  def TitleFootnotes(self, text):
+    self.footnotes = text
+
+  def cell(self, rowlabel, collabel):
+    return self.cells[self.rowlabels.index(rowlabel)][self.collabels.index(collabel)]
+
+
+def SetOutput(state):
+  pass
+
+
+########## data
+
+dataset = dict(names=[], labels=[], columns=[], weight=None, split=[])
+
+
+def LoadData(data, labels=None, weight=None, split=None):
+  """Make data the active dataset: a mapping from variable name to a
+  list of values (None is missing), or the name of a .sav file; weight
+  and split are as WEIGHT BY and SPLIT FILE BY"""
+  if isinstance(data, basestring):
+    import djdata
+    data = djdata.readsav(data)
+  names = sorted(data)
+  dataset['names'] = names
+  dataset['labels'] = [ (labels or {}).get(n, '') for n in names ]
+  dataset['columns'] = [ list(data[n]) for n in names ]
+  dataset['weight'] = weight
+  dataset['split'] = list(split or [])
+
+
+def GetVariableCount():
+  return len(dataset['names'])
+
+
+def GetVariableName(index):
+  return dataset['names'][index]
+
+
+def GetVariableLabel(index):
+  return dataset['labels'][index]
+
+
+def GetVariableType(index):
+  """0 for numeric, else the width of the string"""
+  strings = [ x for x in dataset['columns'][index] if isinstance(x, basestring) ]
+  if not strings:
+    return 0
+  return max(8, max([ len(x) for x in strings ]))
+
+
+def GetVariableFormat(index):
+  width = GetVariableType(index)
+  if width:
+    return 'A%d' % width
+  return 'F8.2'
+
+
+def GetCaseCount():
+  if not dataset['columns']:
+    return 0
+  return len(dataset['columns'][0])
+
+
+def GetWeightVar():
+  return dataset['weight']
+
+
+def GetSplitVariableNames():
+  return list(dataset['split'])
+
+
+class Cursor(object):
+  def __init__(self, var=None, accessType='r'):
+    if var is None:
+      var = range(GetVariableCount())
+    self.columns = [ dataset['columns'][i] for i in var ]
+    self.position = 0
+
+  def fetchall(self):
+    return [ tuple(case) for case in zip(*self.columns) ]
+
+  def fetchmany(self, n):
+    cases = [ tuple(case) for case in zip(*[ col[self.position:self.position+n]
+                                             for col in self.columns ]) ]
+    self.position += len(cases)
+    return cases
+
+  def close(self):
+    pass
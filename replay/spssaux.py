@@ -0,0 +1,51 @@
+# spssaux.py -- replay stand-in
+#
+# The little of spssaux that djmixedcore and extension16 use, on the
+# dataset of the replay spss module (see spss.LoadData).
+#
+# $Revision$
+
+import spss
+
+
+class VariableDict(object):
+  """The variables of the active dataset"""
+
+  def __init__(self, *args, **kwds):
+    self.names = list(spss.dataset['names'])
+
+  def __contains__(self, name):
+    return name.lower() in [ n.lower() for n in self.names ]
+
+  def __iter__(self):
+    return iter(self.names)
+
+  def __len__(self):
+    return len(self.names)
+
+  def expand(self, varlist):
+    """the list of variable names in varlist, with TO and ALL worked
+    out; unknown names raise a ValueError"""
+    if isinstance(varlist, basestring):
+      varlist = varlist.split()
+    lowered = [ n.lower() for n in self.names ]
+    res = list()
+    i = 0
+    while i < len(varlist):
+      word = varlist[i]
+      if word.lower() == 'all':
+        res.extend(self.names)
+      elif i + 2 < len(varlist) and varlist[i+1].lower() == 'to':
+        start, end = self.index(word, lowered), self.index(varlist[i+2], lowered)
+        res.extend(self.names[start:end+1])
+        i += 2
+      else:
+        res.append(self.names[self.index(word, lowered)])
+      i += 1
+    return res
+
+  def index(self, name, lowered):
+    try:
+      return lowered.index(name.lower())
+    except ValueError:
+      raise ValueError("Variable '%s' not found in the active dataset" % name)
@@ -0,0 +1,35 @@
+# test_djcontrast.py
+#
+# The adjustment of p values for multiple comparisons.
+#
+# $Revision$
+
+import os, sys, unittest
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+
+import numpy
+import djcontrast
+
+
+class AdjustTest(unittest.TestCase):
+
+  def testsidak(self):
+    numpy.testing.assert_allclose(djcontrast.adjust([0.01, 0.04], 'sidak'), [0.0199, 0.0784])
+    numpy.testing.assert_allclose(djcontrast.adjust([0.5], 'sidak'), [0.5])
+
+  def testholm(self):
+    # sorted .01 .03 .04 .2 times 4 3 2 1 is .04 .09 .08 .2, kept in order
+    numpy.testing.assert_allclose(djcontrast.adjust([0.01, 0.04, 0.03, 0.2], 'holm'),
+                                  [0.04, 0.09, 0.09, 0.2])
+    numpy.testing.assert_allclose(djcontrast.adjust([0.3, 0.6, 0.2], 'holm'), [0.6, 0.6, 0.6])
+    numpy.testing.assert_allclose(djcontrast.adjust([0.02, 0.02], 'holm'), [0.04, 0.04])
+
+  def testunknown(self):
+    self.assertRaises(djcontrast.ContrastError, djcontrast.adjust, [0.01], 'tukey')
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,107 @@
+# test_djdata.py
+#
+# The chunked readers (readcolumns, readstatistics) against the plain
+# lists of readsav, on tw-set1d-spss.sav and on a CSV copy of it with
+# some values left out.
+#
+# $Revision$
+
+import os, sys, csv, shutil, tempfile, unittest
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+
+import numpy
+import djdata
+
+SAVFILE = os.path.join(TOP, 'tw-set1d-spss.sav')
+VARIABLES = ['RT', 'Priming', 'Morph', 'Participant', 'Word', 'wordstr']
+CATEGORICAL = ['Priming', 'Morph', 'Participant', 'Word', 'wordstr']
+
+
+def complete(columns, variables):
+  """the rows of readsav columns without a missing value"""
+  return [ i for i in range(len(columns[variables[0]]))
+           if not [ v for v in variables if columns[v][i] is None ] ]
+
+
+class ReaderTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.lists = djdata.readsav(SAVFILE, VARIABLES)
+    cls.directory = tempfile.mkdtemp()
+    # a CSV copy, with a blank every 7th value of RT and 11th of Word
+    cls.csvlists = dict([ (v, list(cls.lists[v])) for v in VARIABLES ])
+    for i in range(0, len(cls.csvlists['RT']), 7):
+      cls.csvlists['RT'][i] = None
+    for i in range(3, len(cls.csvlists['Word']), 11):
+      cls.csvlists['Word'][i] = None
+    cls.csvfile = os.path.join(cls.directory, 'tw.csv')
+    stream = open(cls.csvfile, 'wb')
+    try:
+      writer = csv.writer(stream)
+      writer.writerow([ v.lower() for v in VARIABLES ])
+      for i in range(len(cls.csvlists['RT'])):
+        writer.writerow([ '' if cls.csvlists[v][i] is None else
+                          (repr(cls.csvlists[v][i]) if isinstance(cls.csvlists[v][i], float)
+                           else cls.csvlists[v][i].encode('utf-8'))
+                          for v in VARIABLES ])
+    finally:
+      stream.close()
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.directory)
+
+  def checkcolumns(self, store, lists, rows):
+    self.assertEqual(store.nrows, len(rows))
+    expected = [ numpy.nan if lists['RT'][i] is None else lists['RT'][i] for i in rows ]
+    numpy.testing.assert_array_equal(store['RT'], expected)
+    for v in CATEGORICAL:
+      col = store[v]
+      self.assertTrue(isinstance(col, djdata.CodedColumn))
+      self.assertEqual(list(col.levels), sorted(set([ lists[v][i] for i in rows ]) - set([None])))
+      self.assertEqual(list(col.values()), [ lists[v][i] for i in rows ])
+
+  def testsav(self):
+    for chunksize in (djdata.CHUNKSIZE, 100, 7):
+      store = djdata.readcolumns(SAVFILE, VARIABLES, numeric=['RT'], chunksize=chunksize)
+      self.checkcolumns(store, self.lists, range(len(self.lists['RT'])))
+
+  def testsavlistwise(self):
+    store = djdata.readcolumns(SAVFILE, VARIABLES, numeric=['rt'], listwise=True, chunksize=100)
+    self.checkcolumns(store, self.lists, complete(self.lists, VARIABLES))
+
+  def testcsv(self):
+    for listwise in (False, True):
+      rows = complete(self.csvlists, VARIABLES) if listwise else range(len(self.csvlists['RT']))
+      store = djdata.readcolumns(self.csvfile, VARIABLES, numeric=['RT'], listwise=listwise,
+                                 chunksize=100)
+      self.checkcolumns(store, self.csvlists, rows)
+
+  def teststatistics(self):
+    for (filename, lists) in ((SAVFILE, self.lists), (self.csvfile, self.csvlists)):
+      stats = djdata.readstatistics(filename, ['RT', 'Priming', 'Participant'], numeric=['RT'],
+                                    chunksize=50)
+      rows = complete(lists, ['RT', 'Priming', 'Participant'])
+      groups = dict()
+      for i in rows:
+        key = (lists['Priming'][i], lists['Participant'][i])
+        (count, total) = groups.get(key, (0, 0.0))
+        groups[key] = (count + 1, total + lists['RT'][i])
+      self.assertEqual(stats.ncases, len(rows))
+      self.assertEqual(stats.nrows, len(groups))
+      found = zip(stats['Priming'].values(), stats['Participant'].values(), stats.counts,
+                  stats['RT'])
+      self.assertEqual(sorted(groups.keys()), sorted([ (a, b) for (a, b, n, s) in found ]))
+      for (a, b, n, s) in found:
+        self.assertEqual(n, groups[(a, b)][0])
+        self.assertAlmostEqual(s, groups[(a, b)][1], places=6)
+      self.assertAlmostEqual(stats.squares['RT'] / sum([ lists['RT'][i] ** 2 for i in rows ]),
+                             1.0, places=12)
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,71 @@
+# test_djdf.py
+#
+# Satterthwaite and Kenward-Roger df on a balanced split plot design,
+# where the F tests are exact: 24 participants, B between them and A
+# (4 levels, 3 replications) within.  The df are those of the ANOVA,
+# 24 - 2 = 22 for the intercept and B, 288 - 24 - 6 = 258 for A and
+# A*B, and Kenward-Roger leaves F as it is.
+#
+# $Revision$
+
+import os, sys, unittest
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+
+import numpy
+import djnative, djdf
+
+EXACT = {'Intercept': 22, 'B': 22, 'A': 258, 'A * B': 258}
+
+
+def splitplot(seed=1):
+  randomstate = numpy.random.RandomState(seed)
+  (pp, a, b) = numpy.indices((24, 4, 3)).reshape(3, -1)
+  b = pp % 2
+  y = 0.3 * a + 0.5 * b + randomstate.normal(0, 1, 24)[pp] + randomstate.normal(0, 1, len(pp))
+  return dict(pp=[ 'p%02d' % i for i in pp ], A=list(a), B=list(b), y=list(y))
+
+
+class BalancedTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.columns = splitplot()
+
+  def fit(self, dfmethod):
+    return djnative.fitmixedmodel(self.columns, 'y', ['A', 'B', 'A', '*', 'B'], 'pp', None,
+                                  method='REML', dfmethod=dfmethod)
+
+  def testsatterthwaite(self):
+    m = self.fit('satterthwaite')
+    tests = m.typeIIItests()
+    self.assertEqual(sorted([ t[0] for t in tests ]), sorted(EXACT.keys()))
+    for (label, r, ddf, F, p) in tests:
+      self.assertAlmostEqual(ddf / EXACT[label], 1, places=4)
+    self.assertEqual(m.dfs.method, 'satterthwaite')
+
+  def testcontrastdf(self):
+    """every row of a batch by itself, as test does it"""
+    m = self.fit('satterthwaite')
+    L = numpy.random.RandomState(2).normal(size=(5, m.design.p))
+    numpy.testing.assert_allclose(m.dfs.contrastdf(L),
+                                  [ m.dfs.test(l, m.beta)[2] for l in L ], rtol=1e-10)
+
+  def testkenwardroger(self):
+    satterthwaite = self.fit('satterthwaite').typeIIItests()
+    m = self.fit('kenwardroger')
+    self.assertEqual(m.dfs.method, 'kenwardroger')
+    for ((label, r, ddf, F, p), expected) in zip(m.typeIIItests(), satterthwaite):
+      self.assertAlmostEqual(ddf / EXACT[label], 1, places=4)
+      self.assertAlmostEqual(F / expected[3], 1, places=4)
+
+  def testdfmethodname(self):
+    self.assertEqual(djdf.dfmethodname('KenwardRoger'), 'kenwardroger')
+    self.assertEqual(djdf.dfmethodname(None), 'satterthwaite')
+    self.assertRaises(djdf.DfError, djdf.dfmethodname, 'residual')
+
+
+
+if __name__ == '__main__':
+  unittest.main()
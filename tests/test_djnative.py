@@ -0,0 +1,103 @@
+# test_djnative.py
+#
+# The native fits against a dense evaluation of the (restricted)
+# likelihood, with V = sum Z G Z' + sigma2 I built and inverted in
+# full, and against the -2LL that SPSS reports for tw-set1d-spss.sav.
+#
+# Run from the top directory with: python -m unittest discover -s tests
+#
+# $Revision$
+
+import os, sys, unittest
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+
+import numpy, scipy.linalg
+import djdata, djnative
+
+SAVFILE = os.path.join(TOP, 'tw-set1d-spss.sav')
+VARIABLES = ['RT', 'Priming', 'Morph', 'Participant', 'Word']
+FULLFACTORIAL = ['Priming', 'Morph', 'Priming', '*', 'Morph']
+
+
+def densedeviance(m):
+  """-2LL (or -2RLL) of model m at its phi, from the dense V"""
+  X = m.design.cells[m.data.cell]
+  y = numpy.asarray(m.data.y, dtype=float)
+  (n, p) = X.shape
+  V = m.phi[-1] * numpy.eye(n)
+  for (t, phi) in zip(m.terms, m.splitterms(m.phi)):
+    Z = t.Z.toarray()
+    V += numpy.dot(numpy.dot(Z, numpy.kron(numpy.eye(t.nlevels), t.covariance(phi))), Z.T)
+  C = scipy.linalg.cho_factor(V)
+  (ViX, Viy) = (scipy.linalg.cho_solve(C, X), scipy.linalg.cho_solve(C, y))
+  XtViX = numpy.dot(X.T, ViX)
+  beta = numpy.linalg.solve(XtViX, numpy.dot(X.T, Viy))
+  # y'Py = y'V^-1 y - beta'X'V^-1 y
+  res = 2 * numpy.log(numpy.diag(C[0])).sum() + numpy.dot(y, Viy) \
+        - numpy.dot(beta, numpy.dot(X.T, Viy))
+  if m.reml:
+    res += numpy.linalg.slogdet(XtViX)[1] + (n - p) * numpy.log(2 * numpy.pi)
+  else:
+    res += n * numpy.log(2 * numpy.pi)
+  return res, beta, numpy.linalg.inv(XtViX)
+
+
+class DenseTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.columns = djdata.readcolumns(SAVFILE, VARIABLES, numeric=['RT'], listwise=True)
+
+  def fit(self, method, randomslopes=None, predictors=FULLFACTORIAL):
+    return djnative.fitmixedmodel(self.columns, 'RT', predictors, 'Participant', 'Word',
+                                  method=method, randomslopes=randomslopes)
+
+  def checkdense(self, m):
+    (deviance, beta, covbeta) = densedeviance(m)
+    self.assertAlmostEqual(m.m2ll, deviance, places=4)
+    numpy.testing.assert_allclose(m.beta, beta, rtol=1e-8, atol=1e-8)
+    numpy.testing.assert_allclose(m.covbeta, covbeta, rtol=1e-6)
+
+  def testinterceptspss(self):
+    self.assertAlmostEqual(self.fit('ML').m2ll, 25399.164, places=3)
+    self.assertAlmostEqual(self.fit('REML').m2ll, 25372.338, places=3)
+
+  def testinterceptdense(self):
+    for method in ('ML', 'REML'):
+      self.checkdense(self.fit(method))
+
+  def testslopesdense(self):
+    for (method, slopecov) in (('REML', 'UN'), ('ML', 'DIAG')):
+      m = djnative.fitmixedmodel(self.columns, 'RT', ['Priming', 'Morph'], 'Participant', 'Word',
+                                 method=method, randomslopes=['Priming'], slopecov=slopecov)
+      self.checkdense(m)
+
+  def testparameters(self):
+    """covariance parameters are counted like SPSS, with all levels"""
+    m = djnative.fitmixedmodel(self.columns, 'RT', ['Priming', 'Morph'], 'Participant', 'Word',
+                               randomslopes=['Priming', 'Morph', '|'])
+    counts = m.output.texts('Model Dimension', row='Random Effects', col='Number of Parameters')
+    # 1 + 2 + 2 random effects by participant under UN, an intercept by word
+    self.assertEqual(counts, ['15', '1'])
+    self.assertEqual(m.nparameters(), 3 + 15 + 1 + 1)
+    self.assertEqual(m.terms[0].statistic(m.terms[0].ntheta - 1), 'UN (4,4)')
+
+  def testoptimum(self):
+    """phi is a minimum of the dense deviance, not just any point"""
+    m = self.fit('REML', ['Priming', '|'], ['Priming', 'Morph'])
+    (deviance, beta, covbeta) = densedeviance(m)
+    for k in m.free:
+      for step in (-0.01, 0.01):
+        phi = m.phi.copy()
+        m.phi[k] *= 1 + step
+        try:
+          self.assertTrue(densedeviance(m)[0] > deviance - 1e-6)
+        finally:
+          m.phi = phi
+
+
+
+if __name__ == '__main__':
+  unittest.main()